@@ -0,0 +1,106 @@
+"""
+Compares peak memory (max RSS) of downloading large documents with MediaConverter: the whole response
+read into memory before it is written (as before) and the chunked stream, written in a thread.
+Documents are served by a local server, downloads run concurrently (config.vk.max_non_video_workers).
+Every mode runs in its own process, since the peak RSS of a process never decreases.
+
+Run: python -m benchmarks.bench_downloads [--documents N] [--size-mb M] [--chunk-size-kb K]
+"""
+import argparse
+import asyncio
+import logging
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from aiohttp import StreamReader, web
+
+import vk_exporter.types as vk
+from config import Config
+from vk_tg_converter.converters.media_converter import MediaConverter
+
+_BLOCK = bytes(range(256)) * 256  # 64 KB
+
+
+class BufferedMediaConverter(MediaConverter):
+    """Reads the whole response, as the converter did before streaming"""
+
+    async def _write_stream(self, stream: StreamReader, file_path: Path) -> None:
+        with file_path.open("xb") as dst:
+            dst.write(await stream.read())
+
+
+def serve(port: int, size_bytes: int, started: threading.Event) -> None:
+    async def handle(request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Length": str(size_bytes)})
+        await response.prepare(request)
+        for _ in range(size_bytes // len(_BLOCK)):
+            await response.write(_BLOCK)
+        return response
+
+    async def run() -> None:
+        app = web.Application()
+        app.router.add_get("/{name}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        started.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+def max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Kilobytes on linux
+
+
+def run_client(mode: str, port: int, documents: int, chunk_size_kb: int) -> None:
+    config = Config()
+    config.vk.download_chunk_size_kb = chunk_size_kb
+    converter_class = BufferedMediaConverter if mode == "buffered" else MediaConverter
+    no_network: Any = None  # Neither vk api nor video downloader are used
+    attachments: list[vk.Attachment] = [
+        vk.Document(f"http://127.0.0.1:{port}/{i}.bin", f"doc {i}", "bin", 1) for i in range(documents)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        converter = converter_class(no_network, no_network, logging.getLogger("bench"), Path(tmp_dir), config, True)
+        rss_before = max_rss_mb()
+        start = time.perf_counter()
+        results = asyncio.run(converter.try_convert(attachments))
+        elapsed = time.perf_counter() - start
+    assert all(results), "Some documents were not downloaded"
+    print(f"{mode:>10}{rss_before:>16.0f}{max_rss_mb():>12.0f}{elapsed:>11.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=20, help="Number of documents")
+    parser.add_argument("--size-mb", type=int, default=50, help="Size of every document")
+    parser.add_argument("--chunk-size-kb", type=int, default=Config().vk.download_chunk_size_kb,
+                        help="config.vk.download_chunk_size_kb")
+    parser.add_argument("--port", type=int, default=18765, help="Port of the local server")
+    parser.add_argument("--client", choices=["buffered", "streamed"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.client is not None:
+        run_client(args.client, args.port, args.documents, args.chunk_size_kb)
+        return
+
+    started = threading.Event()
+    threading.Thread(target=serve, args=(args.port, args.size_mb * 2 ** 20, started), daemon=True).start()
+    started.wait()
+    print(f"{args.documents} documents, {args.size_mb} MB each, {Config().vk.max_non_video_workers} workers, "
+          f"chunks of {args.chunk_size_kb} KB")
+    print(f"{'mode':>10}{'RSS before, MB':>16}{'peak, MB':>12}{'seconds':>11}")
+    for mode in ["buffered", "streamed"]:
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_downloads", "--client", mode,
+                        "--documents", str(args.documents), "--chunk-size-kb", str(args.chunk_size_kb),
+                        "--port", str(args.port)], check=True)
+
+
+if __name__ == "__main__":
+    main()
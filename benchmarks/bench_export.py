@@ -0,0 +1,95 @@
+"""
+Measures export throughput against a local stand-in for vk api: no account or network is needed.
+Requests go through VkClient, so its rate limiter and retries are measured too.
+Reports messages per second and api calls per 10k messages for get_raw_history and the full export_history path.
+
+Run: python -m benchmarks.bench_export [--messages N] [--latency SECONDS] [--rps N] [--workers N ...]
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import vk_api
+
+from common.vk_client import VkClient
+from config import Config
+from vk_exporter.service import VkExporterService
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import FakeVkApi
+from vk_exporter.vk_service import VkService
+
+CHAT_ID = 2_000_000_001
+
+
+class _FakeTransport(vk_api.VkApi):
+    fake_api: FakeVkApi
+
+    def method(self, method: str, values: Optional[dict[str, Any]] = None, **kwargs: Any) -> Any:
+        return self.fake_api.method(method, values, **kwargs)
+
+
+class FakeVkClient(VkClient, _FakeTransport):
+    """VkClient.method calls super().method, which is _FakeTransport.method here instead of a network request"""
+
+    def __init__(self, config: Config.Vk, fake_api: FakeVkApi) -> None:
+        self.fake_api = fake_api
+        super().__init__(config, token="token")
+
+
+def run_scenario(name: str, config: Config.Vk, args: argparse.Namespace, workers: int,
+                 action: Callable[[VkService], None]) -> None:
+    api = FakeVkApi(latency=args.latency, max_requests_per_second_opt=args.server_rps, error_rate=args.error_rate)
+    api.add_chat(CHAT_ID, args.messages, text_size=args.text_size)
+    client = FakeVkClient(config, api)
+    start = time.perf_counter()
+    action(VkService(client.get_api(), workers))
+    elapsed = time.perf_counter() - start
+
+    per_10k = 10_000 / args.messages
+    calls = sum(client.method_calls.values())
+    sub_calls = sum(api.calls.values()) - calls  # Requests made inside execute
+    retries = sum(client.method_retries.values())
+    print(f"{name:<16}{workers:>8}{elapsed:>9.2f}{args.messages / elapsed:>12.0f}"
+          f"{calls * per_10k:>12.1f}{sub_calls * per_10k:>14.1f}{retries:>9}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=50_000, help="Size of the chat")
+    parser.add_argument("--text-size", type=int, default=100, help="Length of every message text")
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds every request takes")
+    parser.add_argument("--rps", type=float, default=3, help="Client rate limit, requests per second")
+    parser.add_argument("--server-rps", type=float, default=None,
+                        help="Server rate limit: faster requests fail with error 6. Not limited by default")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests failing with error 10")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="Values of max_history_workers")
+    args = parser.parse_args()
+
+    os.environ.setdefault("VK_API_ID", "0")  # VkClient requires it, but it is not used with a token
+    config = Config(config_file_path=None).vk
+    config.max_requests_per_second = args.rps
+    config.api_retry_base_delay = 0.1
+
+    def get_raw_history(service: VkService) -> None:
+        for _ in service.get_raw_history(CHAT_ID, None, disable_progress_bar=True).raw_messages:
+            pass
+
+    def export_history(service: VkService) -> None:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            VkExporterService(service, VkHistoryStorage()).export_history(
+                CHAT_ID, None, True, Path(tmp_dir) / "history.history")
+
+    print(f"{args.messages} messages, latency {args.latency}s, client limit {args.rps} rps, "
+          f"server limit {args.server_rps} rps, error rate {args.error_rate}")
+    print(f"{'scenario':<16}{'workers':>8}{'seconds':>9}{'messages/s':>12}{'calls/10k':>12}"
+          f"{'sub-calls/10k':>14}{'retries':>9}")
+    for workers in args.workers:
+        run_scenario("get_raw_history", config, args, workers, get_raw_history)
+        run_scenario("export_history", config, args, workers, export_history)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares the binary history format with pickle, which was used before it.
+Reports file size, save time, time to open a file, to decode every message and to read one field of every message,
+and time to read 100 messages at random positions.
+
+Run: python -m benchmarks.bench_history_format [--messages N]
+"""
+import argparse
+import gc
+import pickle
+import random
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import vk_exporter.types as vk
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import make_raw_message
+
+
+def make_history(messages_count: int) -> vk.ChatHistory:
+    messages = []
+    for i in range(1, messages_count + 1):
+        raw_message = make_raw_message(i, from_id=i % 50, text=f"message {i} " * 5)
+        if i % 5 == 0:
+            raw_message["attachments"] = [{"type": "photo", "photo": {
+                "sizes": [{"type": "x", "url": f"https://example.com/{i}.jpg", "width": 604, "height": 480}]}}]
+        if i % 20 == 0:
+            raw_message["reply_message"] = make_raw_message(i - 1, from_id=i % 50, text="reply")
+        messages.append(vk.Message.parse(raw_message))
+    return vk.ChatHistory(messages=messages, title_opt="title", photo_opt=None)
+
+
+def measure(action: Callable[[], Any]) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="Size of the chat")
+    args = parser.parse_args()
+
+    history = make_history(args.messages)
+    storage = VkHistoryStorage()
+    indices = random.Random(0).sample(range(args.messages), 100)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path, binary_path = Path(tmp_dir) / "history.pickle", Path(tmp_dir) / "history.history"
+
+        def save_pickle() -> None:
+            with pickle_path.open("wb") as f:
+                pickle.dump(history, f)
+
+        def load_pickle() -> vk.ChatHistory:
+            with pickle_path.open("rb") as f:
+                loaded: vk.ChatHistory = pickle.load(f)
+                return loaded
+
+        print(f"{args.messages} messages")
+        print(f"{'format':<8}{'MB':>8}{'save, s':>10}{'open, s':>10}{'all, s':>10}{'from_id, s':>12}{'random, s':>11}")
+        for name, path, save, load in [
+            ("pickle", pickle_path, save_pickle, load_pickle),
+            ("binary", binary_path,
+             lambda: storage.save_history(history, binary_path), lambda: storage.load_history(binary_path)),
+        ]:
+            save_time = measure(save)
+            open_time = measure(load)
+            all_time = measure(lambda: list(load().messages))
+            field_time = measure(lambda: {message.from_id for message in load().messages})
+            random_time = measure(lambda: [messages[i] for messages in [load().messages] for i in indices])
+            print(f"{name:<8}{path.stat().st_size / 2 ** 20:>8.1f}{save_time:>10.2f}{open_time:>10.3f}"
+                  f"{all_time:>10.2f}{field_time:>12.2f}{random_time:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
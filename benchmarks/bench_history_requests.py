@@ -0,0 +1,56 @@
+"""
+Compares how many requests GET_HISTORY_SCRIPT makes and how much data it returns
+with the previous version of the script, which always made 25 requests of 200 messages.
+
+Run: python -m benchmarks.bench_history_requests
+"""
+from typing import Any, Optional
+
+from vk_exporter.fake_vk_api import FakeVkApi
+from vk_exporter.vk_service import VkService
+
+CHAT_ID = 2_000_000_001
+
+
+class LegacyScriptFakeVkApi(FakeVkApi):
+    def _execute_get_history_script(self, values: dict[str, Any]) -> list[dict[str, Any]]:
+        messages: list[dict[str, Any]] = []
+        offset = int(values["offset"])
+        for _ in range(25):
+            self.calls["messages.getHistory"] += 1
+            messages += self._get_history({
+                "peer_id": values["peer_id"],
+                "start_message_id": values["start_message_id"],
+                "offset": offset,
+                "count": 200,
+            })["items"]
+            offset += 200
+        return messages
+
+
+def measure(api: FakeVkApi, messages_count: int, max_messages: Optional[int]) -> tuple[int, int]:
+    api.add_chat(CHAT_ID, messages_count)
+    history = VkService(api.get_api()).get_raw_history(CHAT_ID, max_messages, disable_progress_bar=True)
+    for _ in history.raw_messages:
+        pass
+    sub_calls = api.calls["messages.getHistory"] - 1  # Do not count the request for the total number of messages
+    return sub_calls, api.response_bytes
+
+
+def main() -> None:
+    scenarios = [
+        ("-n 50 of 100k", 100_000, 50),
+        ("-n 1000 of 100k", 100_000, 1000),
+        ("5001 messages", 5001, None),
+        ("10001 messages", 10_001, None),
+        ("12345 messages", 12_345, None),
+    ]
+    print(f"{'scenario':<18}{'sub-calls before':>18}{'after':>8}{'KB before':>12}{'after':>10}")
+    for name, messages_count, max_messages in scenarios:
+        calls_before, bytes_before = measure(LegacyScriptFakeVkApi(), messages_count, max_messages)
+        calls_after, bytes_after = measure(FakeVkApi(), messages_count, max_messages)
+        print(f"{name:<18}{calls_before:>18}{calls_after:>8}{bytes_before // 1024:>12}{bytes_after // 1024:>10}")
+
+
+if __name__ == "__main__":
+    main()
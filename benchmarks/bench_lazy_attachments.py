@@ -0,0 +1,79 @@
+"""
+Measures a metadata-only workload (senders and dates of all messages, like 'contacts prepare' does) with attachments
+parsed eagerly and lazily (MessageParser with lazy_attachments), and the same workload on a saved history file,
+where attachments are decoded on first access. Every third message has photos with all sizes, as vk returns them.
+
+Run: python -m benchmarks.bench_lazy_attachments [--messages N]
+"""
+import argparse
+import gc
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import vk_exporter.types as vk
+from vk_exporter.fake_vk_api import make_raw_message
+from vk_exporter.parser import MessageParser
+from vk_exporter.storage import VkHistoryStorage
+
+
+def make_raw_messages(messages_count: int) -> list[dict[str, Any]]:
+    raw_messages = []
+    for i in range(1, messages_count + 1):
+        raw_message = make_raw_message(i, from_id=i % 50, text=f"message {i} " * 5)
+        if i % 3 == 0:
+            sizes = [{"type": size_type, "url": f"https://example.com/{i}/{size_type}.jpg", "width": 100 * j,
+                      "height": 75 * j} for j, size_type in enumerate("smxopqryzw", start=1)]
+            raw_message["attachments"] = [{"type": "photo", "photo": {"sizes": sizes}}] * 2
+        raw_messages.append(raw_message)
+    return raw_messages
+
+
+def collect_metadata(messages: Iterable[vk.Message]) -> None:
+    from_ids, dates = set(), []
+    for message in messages:
+        from_ids.add(message.from_id)
+        dates.append(message.date)
+
+
+def collect_attachments(messages: Iterable[vk.Message]) -> None:
+    for message in messages:
+        list(message.attachments)
+
+
+def measure(action: Callable[[], Any]) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="Size of the chat")
+    args = parser.parse_args()
+
+    raw_messages = make_raw_messages(args.messages)
+    print(f"{args.messages} messages")
+    print(f"{'':>40}{'seconds':>9}")
+
+    def parse(lazy_attachments: bool) -> list[vk.Message]:
+        return MessageParser(lazy_attachments).parse_all(raw_messages)
+
+    print(f"{'parse, metadata (eager attachments)':>40}{measure(lambda: collect_metadata(parse(False))):>9.2f}")
+    print(f"{'parse, metadata (lazy attachments)':>40}{measure(lambda: collect_metadata(parse(True))):>9.2f}")
+    print(f"{'parse, all attachments (lazy)':>40}{measure(lambda: collect_attachments(parse(True))):>9.2f}")
+
+    storage = VkHistoryStorage()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "history.history"
+        storage.save_history(vk.ChatHistory(parse(False), None, None), path)
+        metadata_time = measure(lambda: collect_metadata(storage.load_history(path).messages))
+        attachments_time = measure(lambda: collect_attachments(storage.load_history(path).messages))
+    print(f"{'history file, metadata':>40}{metadata_time:>9.2f}")
+    print(f"{'history file, all attachments':>40}{attachments_time:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
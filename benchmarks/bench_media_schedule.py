@@ -0,0 +1,84 @@
+"""
+Compares wall-clock time of MediaConverter downloading photos and videos one kind after the other (--sequential-media)
+and simultaneously. Photos are served by a local server with a delay, like a remote server with latency;
+videos are "downloaded" by a fake downloader which sleeps. Limits of workers and connections are from config.py.
+
+Run: python -m benchmarks.bench_media_schedule [--photos N] [--videos N] [--photo-delay-ms MS] [--video-seconds S]
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from pathlib import Path, PurePath
+from typing import Any, Optional
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import vk_exporter.types as vk
+from config import Config
+from vk_tg_converter.converters.media_converter import MediaConverter
+from vk_tg_converter.converters.video_downloader import IVideoDownloader
+
+
+class FakeVideoApi:
+    class video:
+        @staticmethod
+        async def get(videos: str) -> dict[str, Any]:
+            return {"items": [{"player": f"https://vk.com/video_ext.php?{videos}"}]}
+
+
+class SleepingVideoDownloader(IVideoDownloader):
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+
+    def try_download_video(self, player_url: str, output_template: str) -> Optional[PurePath]:
+        time.sleep(self.seconds)
+        path = Path(output_template.replace("%%", "%") % {"title": "video", "ext": "mp4"})
+        path.write_bytes(b"video")
+        return path
+
+
+async def measure(args: argparse.Namespace, sequential: bool) -> float:
+    async def serve_photo(request: web.Request) -> web.Response:
+        await asyncio.sleep(args.photo_delay_ms / 1000)
+        return web.Response(body=b"photo" * 1000)
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_photo)
+    async with TestServer(app) as server:
+        attachments: list[vk.Attachment] = [vk.Photo(str(server.make_url(f"/{i}.jpg")), 1, 1)
+                                            for i in range(args.photos)]
+        attachments += [vk.Video(f"video {i}", i, 1, 640, 480, 10, False, str(server.make_url(f"/thumb{i}.jpg")), None)
+                        for i in range(args.videos)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            converter = MediaConverter(FakeVideoApi(), SleepingVideoDownloader(args.video_seconds),  # type: ignore
+                                       logging.getLogger("bench"), Path(tmp_dir), Config(), True,
+                                       sequential=sequential)
+            start = time.perf_counter()
+            results = await converter.try_convert(attachments)
+            elapsed = time.perf_counter() - start
+    assert all(results), "Some media were not downloaded"
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=1000, help="Number of photos")
+    parser.add_argument("--videos", type=int, default=20, help="Number of videos")
+    parser.add_argument("--photo-delay-ms", type=int, default=50, help="Time to serve a photo")
+    parser.add_argument("--video-seconds", type=float, default=1.0, help="Time to download a video")
+    args = parser.parse_args()
+
+    vk_config = Config().vk
+    print(f"{args.photos} photos ({args.photo_delay_ms} ms each), {args.videos} videos ({args.video_seconds} s each); "
+          f"{vk_config.max_non_video_workers} + {vk_config.max_video_workers} workers, "
+          f"{vk_config.max_media_connections} connections")
+    print(f"{'mode':>14}{'seconds':>9}")
+    for mode, sequential in [("sequential", True), ("simultaneous", False)]:
+        print(f"{mode:>14}{asyncio.run(measure(args, sequential)):>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
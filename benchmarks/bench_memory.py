@@ -0,0 +1,95 @@
+"""
+Measures memory taken by parsed messages (vk_exporter.types) with tracemalloc: after Message.parse
+and after decoding every message of a saved history file, before and after attachments are accessed
+(they are decoded on first access). Reports bytes per message.
+The synthetic chat repeats things the way real chats do: short replies, stickers, links and documents.
+
+Run: python -m benchmarks.bench_memory [--messages N]
+"""
+import argparse
+import gc
+import json
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+import vk_exporter.types as vk
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import make_raw_message
+
+_SHORT_TEXTS = ["ok", "+", "да", "спасибо", ")))", "привет", "ага", "понял"]
+
+
+def make_raw_messages(messages_count: int) -> list[dict[str, Any]]:
+    raw_messages = []
+    for i in range(1, messages_count + 1):
+        text = _SHORT_TEXTS[i % len(_SHORT_TEXTS)] if i % 2 else f"message {i} " * 5
+        raw_message = make_raw_message(i, from_id=i % 50, text=text)
+        match i % 10:
+            case 1:
+                raw_message["attachments"] = [{"type": "photo", "photo": {"sizes": [
+                    {"type": "x", "url": f"https://example.com/{i}.jpg", "width": 604, "height": 480}]}}]
+            case 3:
+                sticker_id = i % 30
+                raw_message["attachments"] = [{"type": "sticker", "sticker": {"images": [
+                    {"url": f"https://vk.com/sticker/1-{sticker_id}-512", "width": 512, "height": 512}]}}]
+            case 5:
+                raw_message["attachments"] = [{"type": "link", "link": {
+                    "url": f"https://example.com/news/{i % 100}", "title": f"News {i % 100}"}}]
+            case 7:
+                raw_message["attachments"] = [{"type": "doc", "doc": {
+                    "url": f"https://vk.com/doc{i}", "title": "image.png", "ext": "png", "type": 4}}]
+            case 9:
+                raw_message["reply_message"] = make_raw_message(i - 1, from_id=(i - 1) % 50, text=text)
+        raw_messages.append(raw_message)
+    return raw_messages
+
+
+def measure(build: Callable[[], Any]) -> int:
+    """Bytes allocated by the result of build() which are still alive"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def load_with_attachments(storage: VkHistoryStorage, path: Path) -> list[vk.Message]:
+    messages = list(storage.load_history(path).messages)
+    for message in messages:
+        tuple(message.attachments)
+    return messages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="Size of the chat")
+    args = parser.parse_args()
+
+    raw_messages = make_raw_messages(args.messages)
+    # Raw messages are decoded while measuring, so parsed messages don't share their strings with the raw ones
+    lines = list(map(json.dumps, raw_messages))
+    parsed_size = measure(lambda: [vk.Message.parse(json.loads(line)) for line in lines])
+
+    storage = VkHistoryStorage()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "history.history"
+        history = vk.ChatHistory(list(map(vk.Message.parse, raw_messages)), None, None)
+        storage.save_history(history, path)
+        del history
+        loaded_size = measure(lambda: list(storage.load_history(path).messages))
+        decoded_size = measure(lambda: load_with_attachments(storage, path))
+
+    print(f"{args.messages} messages")
+    print(f"{'':>30}{'MB':>9}{'bytes/message':>15}")
+    for name, size in [("parsed", parsed_size), ("loaded", loaded_size),
+                       ("loaded, attachments accessed", decoded_size)]:
+        print(f"{name:>30}{size / 2 ** 20:>9.1f}{size / args.messages:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
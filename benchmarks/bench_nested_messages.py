@@ -0,0 +1,67 @@
+"""
+Compares parsing of a reply-heavy chat with and without sharing copies of nested messages (Message.parse
+and MessageParser). Every other message replies to one of a few popular messages, which have an attachment
+and forwarded messages themselves. Reports parse time and memory taken by parsed messages (tracemalloc).
+
+Run: python -m benchmarks.bench_nested_messages [--messages N] [--popular N]
+"""
+import argparse
+import gc
+import json
+import time
+from typing import Any, Callable
+
+import vk_exporter.types as vk
+from benchmarks.bench_memory import measure
+from vk_exporter.fake_vk_api import make_raw_message
+from vk_exporter.parser import MessageParser
+
+
+def make_raw_messages(messages_count: int, popular_count: int) -> list[dict[str, Any]]:
+    photo = {"type": "photo", "photo": {"sizes": [
+        {"type": "x", "url": "https://example.com/1.jpg", "width": 604, "height": 480}]}}
+    popular_messages = []
+    for i in range(1, popular_count + 1):
+        forwarded = [make_raw_message(-j, from_id=j, text=f"forwarded {j} " * 5) for j in range(3)]
+        popular_messages.append({**make_raw_message(i, text=f"popular {i} " * 10),
+                                 "attachments": [photo], "fwd_messages": forwarded})
+    raw_messages = []
+    for i in range(popular_count + 1, messages_count + 1):
+        raw_message = make_raw_message(i, from_id=i % 50, text=f"message {i} " * 5)
+        if i % 2:
+            raw_message["reply_message"] = popular_messages[i % popular_count]
+        raw_messages.append(raw_message)
+    return raw_messages
+
+
+def make_parse(share: bool) -> Callable[[list[dict[str, Any]]], list[vk.Message]]:
+    def parse(raw_messages: list[dict[str, Any]]) -> list[vk.Message]:
+        if share:
+            return MessageParser().parse_all(raw_messages)
+        return [vk.Message.parse(raw_message) for raw_message in raw_messages]
+
+    return parse
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="Size of the chat")
+    parser.add_argument("--popular", type=int, default=100, help="Number of messages which are replied to")
+    args = parser.parse_args()
+
+    raw_messages = make_raw_messages(args.messages, args.popular)
+    lines = list(map(json.dumps, raw_messages))
+    print(f"{len(raw_messages)} messages, half of them reply to {args.popular} messages")
+    print(f"{'':>14}{'seconds':>9}{'MB':>8}{'bytes/message':>15}")
+    for name, parse in [("copies", make_parse(share=False)), ("shared", make_parse(share=True))]:
+        gc.collect()
+        start = time.perf_counter()
+        parse(raw_messages)
+        elapsed = time.perf_counter() - start
+        # Raw messages are decoded while measuring, so parsed messages don't share their strings with the raw ones
+        size = measure(lambda: parse([json.loads(line) for line in lines]))
+        print(f"{name:>14}{elapsed:>9.2f}{size / 2 ** 20:>8.1f}{size / len(raw_messages):>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
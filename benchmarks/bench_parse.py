@@ -0,0 +1,66 @@
+"""
+Measures how fast a raw history file is parsed and saved (export --raw-input) with different numbers
+of parsing processes. Messages have attachments and nested forwards, like in large real chats.
+
+Run: python -m benchmarks.bench_parse [--messages N] [--depth N] [--workers N ...]
+"""
+import argparse
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from vk_exporter.service import VkExporterService
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import FakeVkApi, make_raw_message
+from vk_exporter.types import ChatRawHistory
+from vk_exporter.vk_service import VkService
+
+
+def make_raw_messages(messages_count: int, depth: int) -> list[dict[str, Any]]:
+    size = {"type": "x", "url": "https://example.com/1.jpg", "width": 604, "height": 480}
+    photo = {"type": "photo", "photo": {"sizes": [size]}}
+    raw_messages = []
+    for i in range(1, messages_count + 1):
+        raw_message = make_raw_message(i, from_id=i % 50, text=f"message {i} " * 5)
+        if i % 5 == 0:
+            raw_message["attachments"] = [photo]
+        if i % 10 == 0:
+            nested = make_raw_message(i - 1, text="forwarded")
+            for _ in range(depth):
+                nested = {**make_raw_message(i - 1, text="forwarded"), "fwd_messages": [nested], "attachments": [photo]}
+            raw_message["fwd_messages"] = [nested]
+        raw_messages.append(raw_message)
+    return raw_messages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300_000, help="Size of the chat")
+    parser.add_argument("--depth", type=int, default=5, help="Depth of forwarded messages")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="Numbers of parsing processes")
+    args = parser.parse_args()
+
+    raw_messages = make_raw_messages(args.messages, args.depth)
+    print(f"{args.messages} messages, forward depth {args.depth}, {os.cpu_count()} CPUs")
+    # CPU time of the main process is the part which is not parallelized, so it limits the speedup
+    print(f"{'workers':>8}{'seconds':>9}{'messages/s':>12}{'speedup':>9}{'main CPU, s':>13}{'max speedup':>13}")
+    base_time = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage = VkHistoryStorage()
+        raw_path = Path(tmp_dir) / "raw.json"
+        storage.save_raw_history(ChatRawHistory(raw_messages, None, None, None), raw_path)
+        for workers in args.workers:
+            service = VkExporterService(VkService(FakeVkApi().get_api()), storage, workers)
+            export_path = Path(tmp_dir) / f"history_{workers}.history"
+            start, start_cpu = time.perf_counter(), time.process_time()
+            service.export_history_from_raw_input(raw_path, export_path)
+            elapsed, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+            base_time = base_time or elapsed
+            print(f"{workers:>8}{elapsed:>9.2f}{args.messages / elapsed:>12.0f}{base_time / elapsed:>9.2f}"
+                  f"{cpu:>13.2f}{base_time / cpu:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
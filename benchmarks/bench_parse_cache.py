@@ -0,0 +1,47 @@
+"""
+Measures export from a raw history file (export --raw-input) without the parse cache, with an empty cache
+(the history is parsed and saved to the cache) and with the history already cached (vk_exporter/parse_cache.py).
+
+Run: python -m benchmarks.bench_parse_cache [--messages N] [--depth N]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from benchmarks.bench_parse import make_raw_messages
+from vk_exporter.parse_cache import IParsedHistoryCache, ParsedHistoryCache
+from vk_exporter.service import VkExporterService
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import FakeVkApi
+from vk_exporter.types import ChatRawHistory
+from vk_exporter.vk_service import VkService
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300_000, help="Size of the chat")
+    parser.add_argument("--depth", type=int, default=5, help="Depth of forwarded messages")
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, forward depth {args.depth}")
+    print(f"{'':>14}{'seconds':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage = VkHistoryStorage()
+        raw_path = Path(tmp_dir) / "raw.json"
+        storage.save_raw_history(ChatRawHistory(make_raw_messages(args.messages, args.depth), None, None, None),
+                                 raw_path)
+        cache = ParsedHistoryCache(storage, Path(tmp_dir) / "cache", 2 ** 40)
+        runs: list[tuple[str, Optional[IParsedHistoryCache]]] = [
+            ("no cache", None), ("empty cache", cache), ("cached", cache),
+        ]
+        for i, (name, cache_opt) in enumerate(runs):
+            service = VkExporterService(VkService(FakeVkApi().get_api()), storage, parse_cache_opt=cache_opt)
+            start = time.perf_counter()
+            service.export_history_from_raw_input(raw_path, Path(tmp_dir) / f"history_{i}.history")
+            print(f"{name:>14}{time.perf_counter() - start:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
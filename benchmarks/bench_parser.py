@@ -0,0 +1,48 @@
+"""
+Compares Message.parse with MessageParser (vk_exporter/parser.py) on synthetic chats: an ordinary chat with
+forwards, a chat with photos in all sizes and a chat where half of the messages are replies. Best of 3 runs.
+
+Run: python -m benchmarks.bench_parser [--messages N]
+"""
+import argparse
+import gc
+import time
+from typing import Any, Callable
+
+import benchmarks.bench_lazy_attachments
+import benchmarks.bench_nested_messages
+import benchmarks.bench_parse
+from vk_exporter.parser import MessageParser
+from vk_exporter.types import Message
+
+
+def measure(action: Callable[[], Any], repeat: int = 3) -> float:
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        action()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100_000, help="Size of the chats")
+    args = parser.parse_args()
+
+    chats = [
+        ("forwards", benchmarks.bench_parse.make_raw_messages(args.messages, depth=5)),
+        ("photos", benchmarks.bench_lazy_attachments.make_raw_messages(args.messages)),
+        ("replies", benchmarks.bench_nested_messages.make_raw_messages(args.messages, popular_count=100)),
+    ]
+    print(f"{args.messages} messages")
+    print(f"{'chat':>10}{'Message.parse, s':>18}{'MessageParser, s':>18}{'speedup':>9}")
+    for name, raw_messages in chats:
+        parse_time = measure(lambda: [Message.parse(raw_message) for raw_message in raw_messages])
+        parser_time = measure(lambda: MessageParser().parse_all(raw_messages))
+        print(f"{name:>10}{parse_time:>18.2f}{parser_time:>18.2f}{parse_time / parser_time:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
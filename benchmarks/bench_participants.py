@@ -0,0 +1,46 @@
+"""
+Measures how fast 'contacts prepare' gets participants of a saved history: by loading all messages
+(as it did before) and by reading the participant index saved next to the history (vk_exporter/storage.py).
+
+Run: python -m benchmarks.bench_participants [--messages N]
+"""
+import argparse
+import gc
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from benchmarks.bench_parse import make_raw_messages
+from vk_exporter.parser import MessageParser
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.types import ChatHistory
+
+
+def measure(action: Callable[[], Any]) -> float:
+    gc.collect()
+    start = time.perf_counter()
+    action()
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300_000, help="Size of the chat")
+    args = parser.parse_args()
+
+    messages = MessageParser().parse_all(make_raw_messages(args.messages, depth=5))
+    storage = VkHistoryStorage()
+    print(f"{args.messages} messages")
+    print(f"{'':>24}{'ms':>9}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "history.history"
+        storage.save_history(ChatHistory(messages, None, None), path)
+        all_messages_time = measure(lambda: {msg.from_id for msg in storage.load_history(path).messages})
+        index_time = measure(lambda: storage.load_participants(path).get_all_ids())
+    print(f"{'load all messages':>24}{all_messages_time * 1000:>9.1f}")
+    print(f"{'participant index':>24}{index_time * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compares json codecs of raw history files (vk_exporter/storage.py): time to save a raw history and to read
+all its messages back, with every installed codec. Messages have cyrillic texts, attachments and forwards.
+
+Run: python -m benchmarks.bench_raw_json [--messages N] [--suffix .json|.json.gz|.json.zst]
+"""
+import argparse
+import gc
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+from benchmarks.bench_parse import make_raw_messages
+from common.json_codec import IJsonCodec, MsgspecJsonCodec, OrjsonCodec, StdlibJsonCodec
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.types import ChatRawHistory
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000, help="Size of the chat")
+    parser.add_argument("--suffix", default=".json", help="Suffix of the file, it chooses compression")
+    args = parser.parse_args()
+
+    raw_messages = make_raw_messages(args.messages, depth=2)
+    for i, raw_message in enumerate(raw_messages):
+        raw_message["text"] = f"Сообщение номер {i}, привет! 👋 " * 3
+    codec_classes: list[Callable[[], IJsonCodec]] = [StdlibJsonCodec, OrjsonCodec, MsgspecJsonCodec]
+
+    print(f"{args.messages} messages, {args.suffix}")
+    print(f"{'codec':>18}{'MB':>8}{'save, s':>9}{'load, s':>9}{'load, MB/s':>12}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for codec_class in codec_classes:
+            try:
+                storage = VkHistoryStorage(codec_class())
+            except ImportError:
+                print(f"{getattr(codec_class, '__name__'):>18}  not installed")
+                continue
+            path = Path(tmp_dir) / f"raw_{getattr(codec_class, '__name__')}{args.suffix}"
+            gc.collect()
+            start = time.perf_counter()
+            storage.save_raw_history(ChatRawHistory(raw_messages, "Чат", None, None), path)
+            save_time = time.perf_counter() - start
+            gc.collect()
+            start = time.perf_counter()
+            for _ in storage.load_raw_history(path).raw_messages:
+                pass
+            load_time = time.perf_counter() - start
+            size = path.stat().st_size / 2 ** 20
+            print(f"{getattr(codec_class, '__name__'):>18}{size:>8.1f}{save_time:>9.2f}{load_time:>9.2f}"
+                  f"{size / load_time:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Compares sticker conversion of MediaConverter: .png encoded to .webp in the event loop from a downloaded file
+(as before) and in image processes from the downloaded bytes. Reports the total time and the longest stall
+of the event loop, during which no other download makes progress. Stickers are served by a local server.
+
+Run: python -m benchmarks.bench_stickers [--stickers N] [--size PX]
+"""
+import argparse
+import asyncio
+import io
+import logging
+import tempfile
+import time
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, Optional
+
+import PIL.Image
+import PIL.ImageDraw
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+import tg_importer.types as tg
+import vk_exporter.types as vk
+from config import Config
+from vk_tg_converter.converters.media_converter import MediaConverter
+
+
+class InLoopMediaConverter(MediaConverter):
+    """Converts stickers as the converter did before image processes"""
+
+    async def _try_convert_sticker(self, sticker: vk.Sticker, session: ClientSession,
+                                   image_executor: Executor) -> Optional[tg.Sticker]:
+        if file_opt := await self._try_download_file(sticker.image_url, session):
+            new_path = file_opt.with_suffix(".webp")
+            with PIL.Image.open(file_opt) as image:
+                image.save(new_path, format="webp")
+            file_opt.unlink()
+            return tg.Sticker(path=new_path)
+        return None
+
+
+def make_png(size: int) -> bytes:
+    """Flat shapes with transparency, like real stickers"""
+    image = PIL.Image.new("RGBA", (size, size))
+    draw = PIL.ImageDraw.Draw(image)
+    for i in range(0, size // 2, 8):
+        draw.ellipse((i, i, size - i, size - i // 2), fill=(i % 256, 120, 255 - i % 256, 255))
+    draw.text((size // 4, size // 2), "Привет!", fill=(0, 0, 0, 255))
+    output = io.BytesIO()
+    image.save(output, format="png")
+    return output.getvalue()
+
+
+async def measure(converter_class: type[MediaConverter], stickers: int, png: bytes) -> tuple[float, float]:
+    async def serve_sticker(request: web.Request) -> web.Response:
+        return web.Response(body=png)
+
+    max_stall = 0.0
+
+    async def watch_loop() -> None:
+        nonlocal max_stall
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - start - 0.001)
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_sticker)
+    async with TestServer(app) as server:
+        attachments: list[vk.Attachment] = [vk.Sticker(str(server.make_url(f"/{i}.png"))) for i in range(stickers)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            no_network: Any = None  # Neither vk api nor video downloader are used
+            converter = converter_class(no_network, no_network, logging.getLogger("bench"), Path(tmp_dir),
+                                        Config(), True)
+            watcher = asyncio.create_task(watch_loop())
+            start = time.perf_counter()
+            results = await converter.try_convert(attachments)
+            elapsed = time.perf_counter() - start
+            watcher.cancel()
+    assert all(results), "Some stickers were not converted"
+    return elapsed, max_stall
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stickers", type=int, default=300, help="Number of stickers")
+    parser.add_argument("--size", type=int, default=512, help="Width and height of a sticker")
+    args = parser.parse_args()
+
+    png = make_png(args.size)
+    print(f"{args.stickers} stickers of {args.size}x{args.size} ({len(png) // 1024} KB), "
+          f"{Config().vk.max_image_workers} image processes")
+    print(f"{'conversion':>12}{'seconds':>9}{'max stall, ms':>15}")
+    for name, converter_class in [("in loop", InLoopMediaConverter), ("processes", MediaConverter)]:
+        elapsed, max_stall = asyncio.run(measure(converter_class, args.stickers, png))
+        print(f"{name:>12}{elapsed:>9.2f}{max_stall * 1000:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
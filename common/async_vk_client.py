@@ -0,0 +1,92 @@
+import asyncio
+from collections import Counter
+from types import TracebackType
+from typing import Any, Optional
+
+import vk_api
+from aiohttp import ClientSession, TCPConnector
+
+from common.rate_limiter import TokenBucket
+from common.vk_client import RETRIABLE_ERROR_CODES
+from config import Config
+
+
+class AsyncVkApiMethod:
+    """Same as vk_api.VkApiMethod, but calls return coroutines: 'await api.users.get(user_ids=[1, 2])'"""
+
+    def __init__(self, client: "AsyncVkClient", method: Optional[str] = None) -> None:
+        self._client = client
+        self._method = method
+
+    def __getattr__(self, method: str) -> "AsyncVkApiMethod":
+        if "_" in method:  # The same as in vk_api: 'get_by_id' -> 'getById'
+            parts = method.split("_")
+            method = parts[0] + "".join(part.title() for part in parts[1:])
+        return AsyncVkApiMethod(self._client, (self._method + "." if self._method else "") + method)
+
+    async def __call__(self, **kwargs: Any) -> Any:
+        assert self._method is not None, "Method is not specified"
+        for key, value in kwargs.items():
+            if isinstance(value, (list, tuple)):
+                kwargs[key] = ",".join(str(x) for x in value)
+        return await self._client.method(self._method, kwargs)
+
+
+class AsyncVkClient:
+    """
+    Makes vk api requests without blocking the event loop. All requests share one connection pool.
+    Use it as an async context manager: 'async with AsyncVkClient(...) as client'
+    """
+    API_URL = "https://api.vk.com/method/"
+
+    def __init__(self, config: Config.Vk, token: str, rate_limiter_opt: Optional[TokenBucket] = None,
+                 api_url: str = API_URL) -> None:
+        self.token = token
+        self.api_version = config.api_version
+        self.api_url = api_url
+        # Pass the limiter of the synchronous client, so requests of both clients stay within one limit
+        self.rate_limiter = rate_limiter_opt or TokenBucket(config.max_requests_per_second,
+                                                            config.max_requests_per_second)
+        self.max_retries = config.max_api_retries
+        self.retry_base_delay = config.api_retry_base_delay
+        self.max_connections = config.max_api_connections
+        self.session_opt: Optional[ClientSession] = None
+        self.method_calls: Counter[str] = Counter()
+        self.method_retries: Counter[str] = Counter()
+
+    async def __aenter__(self) -> "AsyncVkClient":
+        self.session_opt = ClientSession(connector=TCPConnector(limit=self.max_connections))
+        return self
+
+    async def __aexit__(self, exc_type: Optional[type[BaseException]], exc: Optional[BaseException],
+                        traceback: Optional[TracebackType]) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.session_opt is not None:
+            await self.session_opt.close()
+            self.session_opt = None
+
+    def get_api(self) -> AsyncVkApiMethod:
+        return AsyncVkApiMethod(self)
+
+    async def method(self, method: str, values: Optional[dict[str, Any]] = None) -> Any:
+        """Raises vk_api.ApiError, like vk_api.VkApi.method does"""
+        assert self.session_opt is not None, "Client is not opened. Use 'async with'"
+        values = dict(values or {})
+        params = {"v": self.api_version, **values, "access_token": self.token}
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_async()
+            self.method_calls[method] += 1
+            async with self.session_opt.post(self.api_url + method, data=params) as resp:
+                resp.raise_for_status()
+                response = await resp.json(content_type=None)
+            if "error" not in response:
+                return response["response"]
+            error = response["error"]
+            if error["error_code"] not in RETRIABLE_ERROR_CODES or attempt >= self.max_retries:
+                raise vk_api.ApiError(self, method, values, response, error)
+            self.method_retries[method] += 1
+            await asyncio.sleep(self.retry_base_delay * 2 ** attempt)  # Exponential backoff
+            attempt += 1
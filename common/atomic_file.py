@@ -0,0 +1,24 @@
+import contextlib
+from pathlib import Path
+from typing import Iterator
+
+
+def get_tmp_path(path: Path) -> Path:
+    """'<stem>.part<suffix>': the file is written there first, so the suffix still tells its format"""
+    return path.with_name(path.stem + ".part" + path.suffix)
+
+
+def is_tmp_path(path: Path) -> bool:
+    return ".part" in path.suffixes
+
+
+@contextlib.contextmanager
+def write_aside(path: Path) -> Iterator[Path]:
+    """
+    Yields the temporary path to write the file to. It replaces the given path if the block succeeds,
+    so a failed write never leaves a broken file, and the old file can be read while the new one is written
+    """
+    tmp_path = get_tmp_path(path)
+    tmp_path.unlink(missing_ok=True)
+    yield tmp_path
+    tmp_path.replace(path)
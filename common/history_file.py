@@ -0,0 +1,446 @@
+import collections.abc
+import dataclasses
+import functools
+import hashlib
+import io
+import itertools
+import mmap
+import struct
+import sys
+import types
+import typing
+import uuid
+from array import array
+from datetime import datetime, timedelta, timezone
+from pathlib import Path, PurePath
+from typing import IO, Any, Callable, Iterable, Iterator, Mapping, Optional, Sequence, TypeVar, Union
+
+from common.json_codec import IJsonCodec, get_json_codec
+from common.lazy_sequence import ChainedSequence, IndexedSequence, LazySequence
+
+T = TypeVar("T")
+
+_MAGIC = b"VKTGHIST"
+_HEADER = struct.Struct("<8sH")  # magic, version
+_RECORD_LENGTH = struct.Struct("<I")
+_TRAILER = struct.Struct("<QQ8s")  # offset of the index, offset of the footer, magic
+
+# Values that are not plain data are encoded as json arrays starting with a tag.
+# Non-negative tags are indices of classes in the schema
+_LIST_TAG = -1
+_DATETIME_TAG = -2
+_PATH_TAG = -3
+_PURE_PATH_TAG = -4
+_DICT_TAG = -5
+_TUPLE_TAG = -6
+_PLAIN_TYPES = frozenset({str, int, float, bool, type(None)})
+_MAX_CACHED_DATES = 1 << 10
+
+
+@dataclasses.dataclass(frozen=True)
+class Interned:
+    """
+    Marks string fields which are interned when they are decoded, as parsing interns them:
+    typing.Annotated[str, Interned()]. If max_length_opt is set, longer strings are not interned
+    """
+    max_length_opt: Optional[int] = None
+
+
+class HistoryFileFormat:
+    """
+    Binary history format. Every message is a separate length-prefixed record, the index holds offsets
+    of the records, the footer holds chat info, the schema (names of the classes and their fields)
+    and a random id of the write. Layout:
+        header: magic (8 bytes), version (uint16)
+        records: length (uint32), payload
+        index: offsets of the records and the end of the last one (uint64 each)
+        footer: payload
+        trailer: offset of the index (uint64), offset of the footer (uint64), magic
+    Numbers are little-endian. Payloads are compact json in utf-8 (written by the fastest installed json codec),
+    so the format does not depend on the python version, and, unlike pickle, it can't create objects
+    of arbitrary classes. Objects are stored as
+    [class index, field values...], other values which are not plain json are [negative tag, ...].
+    Fields are matched by name, so fields of a class may be reordered or added.
+    Messages are read lazily: loading takes constant time, a message is decoded when it is accessed
+    """
+    VERSION = 2  # Version 1 stored payloads with marshal
+
+    def __init__(self, classes: Iterable[type], json_codec_opt: Optional[IJsonCodec] = None) -> None:
+        self.classes = {self._get_class_name(cls): cls for cls in classes}
+        self.json_codec = json_codec_opt or get_json_codec()
+
+    @staticmethod
+    def for_module(module: types.ModuleType) -> "HistoryFileFormat":
+        """Allows all classes defined in the module, including nested ones"""
+        classes: set[type] = set()
+
+        def add_classes(namespace: Mapping[str, Any]) -> None:
+            for cls in namespace.values():
+                if isinstance(cls, type) and cls.__module__ == module.__name__ and cls not in classes:
+                    classes.add(cls)
+                    add_classes(vars(cls))
+
+        add_classes(vars(module))
+        return HistoryFileFormat(classes)
+
+    def make_encoder(self, schema_opt: Optional[list[tuple[str, tuple[str, ...]]]] = None) -> "HistoryEncoder":
+        return HistoryEncoder(self, schema_opt)
+
+    def make_decoder(self, schema: list[tuple[str, tuple[str, ...]]]) -> "HistoryDecoder":
+        return HistoryDecoder(self, schema)
+
+    @staticmethod
+    def is_history_file(path: Path) -> bool:
+        with path.open("rb") as f:
+            return f.read(len(_MAGIC)) == _MAGIC
+
+    @staticmethod
+    def get_fingerprint(path: Path) -> str:
+        """
+        Identifies the file without reading records: a hash of the index of records and the footer,
+        which holds a random id of the write. So every write of a history gives a new fingerprint,
+        while touching or copying the file keeps it. Raises ValueError if it is not a history file
+        """
+        with path.open("rb") as f:
+            size = f.seek(0, io.SEEK_END)
+            if size < _HEADER.size + _TRAILER.size:
+                raise ValueError(f"Not a history file or the file is truncated: {path}")
+            f.seek(size - _TRAILER.size)
+            index_offset, _, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+            if magic != _MAGIC or not _HEADER.size <= index_offset < size:
+                raise ValueError(f"Not a history file or the file is truncated: {path}")
+            f.seek(index_offset)
+            return hashlib.blake2b(f.read()).hexdigest()[:32]
+
+    def get_fixed_schema(self) -> list[tuple[str, tuple[str, ...]]]:
+        """
+        Schema with all allowed dataclasses. Messages encoded with it by different encoders
+        (e.g. in different processes) can be joined
+        """
+        return sorted((name, _get_dataclass_field_names(cls))
+                      for name, cls in self.classes.items() if dataclasses.is_dataclass(cls))
+
+    def encode_messages(self, messages: Iterable[Any]) -> tuple[bytes, "array[int]"]:
+        """Encodes messages in memory with the fixed schema. Pass encoded parts to 'join_messages'"""
+        f = io.BytesIO()
+        offsets = self._write_records(f, self.make_encoder(self.get_fixed_schema()), messages, 0)
+        return f.getvalue(), offsets
+
+    def join_messages(self, parts: Iterable[tuple[bytes, "array[int]"]]) -> "LazyMessages[Any]":
+        buffer = bytearray()
+        offsets = array("Q")
+        for part_buffer, part_offsets in parts:
+            shift = len(buffer)
+            offsets.extend(offset + shift for offset in itertools.islice(part_offsets, len(part_offsets) - 1))
+            buffer += part_buffer
+        offsets.append(len(buffer))
+        # Not copied to bytes: it would take as much memory once again
+        return LazyMessages(buffer, offsets, self.make_decoder(self.get_fixed_schema()))
+
+    def write(self, f: IO[bytes], chat_info: dict[str, Any], messages: Iterable[Any]) -> None:
+        """Messages of ChainedSequence are written part by part, so records of the first part can be copied too"""
+        position = f.write(_HEADER.pack(_MAGIC, self.VERSION))
+        parts: Sequence[Iterable[Any]] = messages.parts if isinstance(messages, ChainedSequence) else [messages]
+        encoder_opt = self._try_make_encoder_for_records(parts[0]) if parts else None
+        if encoder_opt is not None:  # Messages are encoded already, their records are copied without decoding
+            assert isinstance(parts[0], LazyMessages)
+            encoder = encoder_opt
+            offsets = parts[0].write_records(f, position)
+            position = offsets.pop()  # Records of other parts follow, the encoder keeps indices of copied classes
+            parts = parts[1:]
+        else:
+            encoder = self.make_encoder()
+            offsets = array("Q")
+        offsets.extend(self._write_records(f, encoder, itertools.chain.from_iterable(parts), position))
+        footer = {
+            "chat_info": {key: encoder.encode(value) for key, value in chat_info.items()},
+            "schema": encoder.schema,
+            "write_id": uuid.uuid4().hex,  # Makes fingerprints of files differ even if their records look alike
+        }
+        index_offset = offsets[-1]
+        footer_offset = index_offset + f.write(_offsets_to_bytes(offsets))
+        f.write(self.json_codec.dumps(footer))
+        f.write(_TRAILER.pack(index_offset, footer_offset, _MAGIC))
+
+    def read(self, path: Path) -> tuple[dict[str, Any], "LazyMessages[Any]"]:
+        """Returns chat info and lazily loaded messages. The file is mapped to memory until messages are deleted"""
+        with path.open("rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < _HEADER.size + _TRAILER.size:
+            raise ValueError(f"Not a history file or the file is truncated: {path}")
+        magic, version = _HEADER.unpack_from(buffer, 0)
+        index_offset, footer_offset, trailer_magic = _TRAILER.unpack_from(buffer, len(buffer) - _TRAILER.size)
+        if magic != _MAGIC or trailer_magic != _MAGIC:
+            raise ValueError(f"Not a history file or the file is truncated: {path}")
+        if version != self.VERSION:
+            raise ValueError(f"Unsupported history file version: {version}. Export the history again")
+        footer = self.json_codec.loads(buffer[footer_offset:len(buffer) - _TRAILER.size])
+        decoder = self.make_decoder(footer["schema"])
+        offsets = _offsets_from_bytes(buffer[index_offset:footer_offset])
+        chat_info = {key: decoder.decode(value) for key, value in footer["chat_info"].items()}
+        return chat_info, LazyMessages(buffer, offsets, decoder)
+
+    def _try_make_encoder_for_records(self, messages: Iterable[Any]) -> Optional["HistoryEncoder"]:
+        """Records of messages can be copied if they have the same classes, as the encoder will write them"""
+        if not isinstance(messages, LazyMessages) or messages.decoder.file_format.classes != self.classes:
+            return None
+        try:
+            return self.make_encoder(messages.decoder.schema)
+        except ValueError:  # Classes have changed since the messages were encoded
+            return None
+
+    @staticmethod
+    def _write_records(f: IO[bytes], encoder: "HistoryEncoder", messages: Iterable[Any],
+                       position: int) -> "array[int]":
+        """Returns offsets of the records"""
+        offsets = array("Q")
+        for message in messages:
+            payload = encoder.dumps(message)
+            offsets.append(position)
+            position += f.write(_RECORD_LENGTH.pack(len(payload)))
+            position += f.write(payload)
+        offsets.append(position)  # The end of the last record, so a record always ends where the next one starts
+        return offsets
+
+    @staticmethod
+    def _get_class_name(cls: type) -> str:
+        return f"{cls.__module__}.{cls.__qualname__}"
+
+
+class LazyMessages(IndexedSequence[T]):
+    """Decodes a message every time it is accessed. Convert to list if messages are accessed many times"""
+
+    def __init__(self, buffer: mmap.mmap | bytes | bytearray, offsets: "array[int]",
+                 decoder: "HistoryDecoder") -> None:
+        self.decoder = decoder
+        self._buffer = buffer
+        self._offsets = offsets
+        self._decode: Callable[[Any], T] = decoder.decode_record
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __iter__(self) -> Iterator[T]:
+        buffer, decode = self._buffer, self._decode
+        for start, end in zip(self._offsets, itertools.islice(self._offsets, 1, None)):
+            yield decode(buffer[start + _RECORD_LENGTH.size:end])
+
+    def write_records(self, f: IO[bytes], position: int) -> "array[int]":
+        """Writes all records as they are. Returns their offsets in the file"""
+        start, end = self._offsets[0], self._offsets[-1]
+        with memoryview(self._buffer) as view:
+            f.write(view[start:end])
+        return array("Q", (offset + position - start for offset in self._offsets))
+
+    def _load(self, index: int) -> T:
+        return self._decode(self._buffer[self._offsets[index] + _RECORD_LENGTH.size:self._offsets[index + 1]])
+
+
+class HistoryEncoder:
+    """Converts objects of allowed classes to builtin values. Collects the schema needed to decode them"""
+
+    def __init__(self, file_format: HistoryFileFormat,
+                 schema_opt: Optional[list[tuple[str, tuple[str, ...]]]] = None) -> None:
+        """Classes of the given schema get the same indices, so records encoded with it stay valid"""
+        self.file_format = file_format
+        self._json_dumps = file_format.json_codec.dumps
+        self.schema: list[tuple[str, tuple[str, ...]]] = []  # Class name and names of its fields
+        self.class_indices: dict[type, int] = {}
+        for name, field_names in schema_opt or []:
+            cls = file_format.classes.get(name)
+            if cls is None or (dataclasses.is_dataclass(cls) and _get_dataclass_field_names(cls) != tuple(field_names)):
+                raise ValueError(f"Schema doesn't match class {name}")
+            self.class_indices[cls] = len(self.schema)
+            self.schema.append((name, tuple(field_names)))
+
+    def dumps(self, value: Any) -> bytes:
+        return self._json_dumps(self.encode(value))
+
+    def encode(self, value: Any) -> Any:
+        """Converts the value to plain json values"""
+        if type(value) in _PLAIN_TYPES:
+            return value
+        if (index_opt := self.class_indices.get(type(value))) is not None:  # The most common case
+            return self._encode_object(value, index_opt)
+        if isinstance(value, (tuple, LazySequence)):
+            return [_TUPLE_TAG, *map(self.encode, value)]
+        if isinstance(value, list):
+            return [_LIST_TAG, *map(self.encode, value)]
+        if isinstance(value, dict):  # E.g. raw data of unsupported actions. Keys may be not strings
+            return [_DICT_TAG, *([self.encode(key), self.encode(item)] for key, item in value.items())]
+        if isinstance(value, datetime):
+            offset_opt = value.utcoffset()
+            return [_DATETIME_TAG, _compact_number(value.timestamp()),
+                    None if offset_opt is None else _compact_number(offset_opt.total_seconds())]
+        if isinstance(value, Path):
+            return [_PATH_TAG, str(value)]
+        if isinstance(value, PurePath):
+            return [_PURE_PATH_TAG, str(value)]
+        return self._encode_object(value, self._add_class(value))
+
+    def _encode_object(self, obj: Any, index: int) -> list[Any]:
+        field_values = map(getattr, itertools.repeat(obj), self.schema[index][1])
+        return [index, *map(self.encode, field_values)]
+
+    def _add_class(self, obj: Any) -> int:
+        """Returns index of the class in the schema"""
+        cls = type(obj)
+        name = self.file_format._get_class_name(cls)
+        if self.file_format.classes.get(name) is not cls:
+            raise TypeError(f"Class is not allowed in history file: {name}")
+        self.class_indices[cls] = len(self.schema)
+        # Plain classes store everything they need in attributes set by __init__
+        field_names = _get_dataclass_field_names(cls) if dataclasses.is_dataclass(cls) else tuple(vars(obj))
+        self.schema.append((name, field_names))
+        return self.class_indices[cls]
+
+
+class HistoryDecoder:
+    def __init__(self, file_format: HistoryFileFormat, schema: list[tuple[str, tuple[str, ...]]]) -> None:
+        self.file_format = file_format
+        self.schema = schema
+        self._json_loads = file_format.json_codec.loads
+        self.timezones: dict[Optional[float], Optional[timezone]] = {None: None}
+        # Messages sent in the same second share the date, as they do after parsing
+        self.dates: dict[tuple[float, Optional[float]], datetime] = {}
+        self.object_decoders: list[Callable[[list[Any]], Any]] = []
+        for name, field_names in schema:
+            if name not in file_format.classes:
+                raise ValueError(f"Unknown class in history file: {name}")
+            self.object_decoders.append(self._make_object_decoder(file_format.classes[name], tuple(field_names)))
+
+    def loads(self, data: bytes) -> Any:
+        return self.decode(self._json_loads(data))
+
+    def decode_record(self, record: bytes) -> Any:
+        value = self._json_loads(record)
+        return self.object_decoders[value[0]](value)  # Records are always objects
+
+    def decode(self, value: Any) -> Any:
+        if type(value) is not list:
+            return value
+        tag = value[0]
+        if tag >= 0:
+            return self.object_decoders[tag](value)
+        if tag == _TUPLE_TAG:
+            return tuple(map(self.decode, itertools.islice(value, 1, None)))
+        if tag == _LIST_TAG:
+            return list(map(self.decode, itertools.islice(value, 1, None)))
+        if tag == _DATETIME_TAG:
+            return datetime.fromtimestamp(value[1], self._get_timezone(value[2]))
+        if tag == _PATH_TAG:
+            return Path(value[1])
+        if tag == _PURE_PATH_TAG:
+            return PurePath(value[1])
+        if tag == _DICT_TAG:
+            return {self.decode(key): self.decode(item) for key, item in itertools.islice(value, 1, None)}
+        raise ValueError(f"Unknown tag in history file: {tag}")
+
+    def _get_timezone(self, offset_opt: Optional[float]) -> Optional[timezone]:
+        if offset_opt not in self.timezones:
+            assert offset_opt is not None
+            self.timezones[offset_opt] = timezone(timedelta(seconds=offset_opt))
+        return self.timezones[offset_opt]
+
+    def _make_object_decoder(self, cls: type, field_names: tuple[str, ...]) -> Callable[[list[Any]], Any]:
+        """Creates the object from its record: [class index, field values...]. The record is decoded in place"""
+        decoded_fields = [(i, decode_field) for i, name in enumerate(field_names, start=1)
+                          if (decode_field := self._make_field_decoder(_get_field_type(cls, name))) is not None]
+        new, set_attribute = object.__new__, object.__setattr__
+
+        def decode_fields(value: list[Any]) -> Iterator[Any]:
+            for i, decode_field in decoded_fields:
+                value[i] = decode_field(value[i])
+            return itertools.islice(value, 1, None)
+
+        if dataclasses.is_dataclass(cls) and set(field_names) != set(_get_dataclass_field_names(cls)):
+            # Fields have changed since the file was written. Let the constructor fill in the defaults
+            def decode_object(value: list[Any]) -> Any:
+                return cls(**dict(zip(field_names, decode_fields(value))))
+        elif "__slots__" in vars(cls):
+            def decode_object(value: list[Any]) -> Any:
+                obj: Any = new(cls)
+                for _ in map(set_attribute, itertools.repeat(obj), field_names, decode_fields(value)):
+                    pass
+                return obj
+        else:  # Like pickle: the object is restored as it was, without calling the constructor
+            def decode_object(value: list[Any]) -> Any:
+                obj: Any = new(cls)
+                obj.__dict__.update(zip(field_names, decode_fields(value)))
+                return obj
+        return decode_object
+
+    def _make_field_decoder(self, hint: Any) -> Optional[Callable[[Any], Any]]:
+        """
+        None if the value is taken as it is: numbers, strings and None.
+        Fields annotated as Sequence (e.g. attachments of messages) are decoded on first access
+        """
+        if typing.get_origin(hint) is typing.Annotated:
+            interned_opt = next((item for item in hint.__metadata__ if isinstance(item, Interned)), None)
+            if interned_opt is not None:
+                return _make_intern(interned_opt.max_length_opt)
+            return self._make_field_decoder(typing.get_args(hint)[0])
+        if _is_plain_type(hint):
+            return None
+        if hint is datetime:  # The most common object, so it is decoded in place
+            fromtimestamp, get_timezone, dates = datetime.fromtimestamp, self._get_timezone, self.dates
+
+            def decode_date(value: list[Any]) -> datetime:
+                key = (value[1], value[2])
+                date = dates.get(key)
+                if date is None:
+                    if len(dates) == _MAX_CACHED_DATES:
+                        dates.clear()
+                    date = dates[key] = fromtimestamp(value[1], get_timezone(value[2]))
+                return date
+
+            return decode_date
+        if typing.get_origin(hint) is collections.abc.Sequence:
+            decode = self.decode
+            return lambda value: LazySequence(functools.partial(decode, value)) if len(value) > 1 else ()
+        return self.decode
+
+
+def _get_field_type(cls: type, name: str) -> Any:
+    try:
+        return typing.get_type_hints(cls, include_extras=True).get(name)
+    except NameError:  # Unresolvable forward reference
+        return None
+
+
+def _make_intern(max_length_opt: Optional[int]) -> Callable[[Optional[str]], Optional[str]]:
+    intern = sys.intern
+    if max_length_opt is None:
+        return lambda value: None if value is None else intern(value)
+    max_length = max_length_opt
+    return lambda value: intern(value) if value is not None and len(value) <= max_length else value
+
+
+def _is_plain_type(hint: Any) -> bool:
+    """Whether it is a number or a string (maybe optional), so the value doesn't need decoding"""
+    return hint in _PLAIN_TYPES or (typing.get_origin(hint) in (Union, types.UnionType)
+                                    and set(typing.get_args(hint)) <= _PLAIN_TYPES)
+
+
+def _compact_number(value: float) -> float | int:
+    """Integers take less space in json"""
+    return int(value) if value.is_integer() else value
+
+
+def _get_dataclass_field_names(cls: type) -> tuple[str, ...]:
+    return tuple(field.name for field in dataclasses.fields(cls))
+
+
+def _offsets_to_bytes(offsets: "array[int]") -> bytes:
+    if sys.byteorder == "big":
+        offsets = array("Q", offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def _offsets_from_bytes(data: bytes) -> "array[int]":
+    offsets = array("Q")
+    offsets.frombytes(data)
+    if sys.byteorder == "big":
+        offsets.byteswap()
+    return offsets
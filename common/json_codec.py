@@ -0,0 +1,69 @@
+import abc
+import json
+from typing import Any, cast
+
+
+class IJsonCodec(abc.ABC):
+    """
+    Converts raw messages and history records to json and back. All codecs write the same compact utf-8 json
+    (non-ascii characters are not escaped; only floats in exponent notation may be written differently),
+    so files written with one codec are read by any other
+    """
+
+    @abc.abstractmethod
+    def dumps(self, value: Any) -> bytes: ...
+
+    @abc.abstractmethod
+    def loads(self, data: bytes | str) -> Any:
+        """Raises ValueError if the data is not valid json"""
+
+
+class StdlibJsonCodec(IJsonCodec):
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, data: bytes | str) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(IJsonCodec):
+    """Requires 'orjson' package. Several times faster than the standard library"""
+
+    def __init__(self) -> None:
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, value: Any) -> bytes:
+        return self._orjson.dumps(value)
+
+    def loads(self, data: bytes | str) -> Any:
+        return self._orjson.loads(data)  # Its errors are ValueErrors
+
+
+class MsgspecJsonCodec(IJsonCodec):
+    """Requires 'msgspec' package"""
+
+    def __init__(self) -> None:
+        import msgspec
+        self._decode_error = msgspec.DecodeError
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, value: Any) -> bytes:
+        return cast(bytes, self._encoder.encode(value))
+
+    def loads(self, data: bytes | str) -> Any:
+        try:
+            return self._decoder.decode(data)
+        except self._decode_error as e:
+            raise ValueError(str(e)) from e
+
+
+def get_json_codec() -> IJsonCodec:
+    """The fastest installed codec: orjson, msgspec or the standard library"""
+    for codec_class in (OrjsonCodec, MsgspecJsonCodec):
+        try:
+            return codec_class()
+        except ImportError:
+            pass
+    return StdlibJsonCodec()
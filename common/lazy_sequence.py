@@ -0,0 +1,115 @@
+import abc
+import bisect
+import itertools
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence, TypeVar, overload
+
+T = TypeVar("T")
+
+
+class LazySequence(Sequence[T]):
+    """
+    Tuple which is built by 'load' on first access and then cached. The data 'load' needs is released after that.
+    Compares equal to tuples with the same items and is pickled as a tuple
+    """
+    __slots__ = ("_load_opt", "_items_opt")
+
+    def __init__(self, load: Callable[[], tuple[T, ...]]) -> None:
+        self._load_opt: Optional[Callable[[], tuple[T, ...]]] = load
+        self._items_opt: Optional[tuple[T, ...]] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._items_opt is not None
+
+    def __len__(self) -> int:
+        return len(self._get_items())
+
+    @overload
+    def __getitem__(self, index: int) -> T: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> tuple[T, ...]: ...
+
+    def __getitem__(self, index: int | slice) -> T | tuple[T, ...]:
+        return self._get_items()[index]
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._get_items())
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, LazySequence):
+            other = other._get_items()
+        if not isinstance(other, tuple):
+            return NotImplemented
+        return self._get_items() == other
+
+    def __hash__(self) -> int:
+        return hash(self._get_items())
+
+    def __repr__(self) -> str:
+        return f"LazySequence({self._get_items() if self.is_loaded else '<not loaded>'})"
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return tuple, (self._get_items(),)
+
+    def _get_items(self) -> tuple[T, ...]:
+        if self._items_opt is None:
+            assert self._load_opt is not None
+            self._items_opt = self._load_opt()
+            self._load_opt = None
+        return self._items_opt
+
+
+class IndexedSequence(Sequence[T]):
+    """
+    Base of sequences which load an item every time it is accessed, e.g. from a file or a database.
+    Slices are loaded to lists. Compares equal to any sequence with the same items
+    """
+
+    @abc.abstractmethod
+    def __len__(self) -> int: ...
+
+    @abc.abstractmethod
+    def _load(self, index: int) -> T:
+        """The index is in range"""
+
+    @overload
+    def __getitem__(self, index: int) -> T: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[T]: ...
+
+    def __getitem__(self, index: int | slice) -> T | list[T]:
+        if isinstance(index, slice):
+            return [self._load(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._load(index)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(<{len(self)} items>)"
+
+
+class ChainedSequence(IndexedSequence[T]):
+    """Items of the parts one after another. Parts are not copied, so lazy ones stay lazy"""
+
+    def __init__(self, parts: Iterable[Sequence[T]]) -> None:
+        self.parts = tuple(parts)
+        self._starts = list(itertools.accumulate((len(part) for part in self.parts), initial=0))
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    def __iter__(self) -> Iterator[T]:
+        return itertools.chain.from_iterable(self.parts)
+
+    def _load(self, index: int) -> T:
+        part_index = bisect.bisect_right(self._starts, index) - 1  # Empty parts are skipped
+        return self.parts[part_index][index - self._starts[part_index]]
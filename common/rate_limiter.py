@@ -0,0 +1,43 @@
+import asyncio
+import threading
+import time
+from typing import Callable
+
+
+class TokenBucket:
+    """
+    Allows 'rate' requests per second on average and bursts of up to 'capacity' requests.
+    Thread-safe: all threads share one budget
+    """
+
+    def __init__(self, rate: float, capacity: float,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep) -> None:
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"Invalid token bucket parameters: {rate=}, {capacity=}")
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = capacity
+        self.last_update = clock()
+
+    def reserve(self) -> float:
+        """Takes one token. Returns how many seconds the caller must wait before making the request"""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+            self.last_update = now
+            self.tokens -= 1  # Can go below zero: later callers will wait longer
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        if delay := self.reserve():
+            self.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        """Does not block the event loop while waiting. Shares the budget with acquire()"""
+        if delay := self.reserve():
+            await asyncio.sleep(delay)
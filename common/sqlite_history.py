@@ -0,0 +1,60 @@
+import itertools
+import sqlite3
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Iterable, Iterator, Optional, TypeVar
+
+from common.lazy_sequence import IndexedSequence
+
+T = TypeVar("T")
+
+SQLITE_SUFFIXES = (".sqlite", ".db")
+
+
+def is_sqlite_path(path: Path) -> bool:
+    """Histories are stored in SQLite databases if the file has one of SQLITE_SUFFIXES"""
+    return path.suffix in SQLITE_SUFFIXES
+
+
+def connect(path: Path, read_only: bool = False) -> sqlite3.Connection:
+    if read_only:  # Fails if the file doesn't exist instead of creating an empty database
+        return sqlite3.connect(path.absolute().as_uri() + "?mode=ro", uri=True)
+    return sqlite3.connect(path)
+
+
+def write_info(connection: sqlite3.Connection, info: dict[str, Any]) -> None:
+    """Key-value table with information about the chat and the database itself. Values are numbers, strings or bytes"""
+    connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value)")
+    connection.executemany("INSERT INTO info VALUES (?, ?)", info.items())
+
+
+def read_info(connection: sqlite3.Connection) -> dict[str, Any]:
+    return dict(connection.execute("SELECT key, value FROM info"))
+
+
+def iter_chunks(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class SqliteSequence(IndexedSequence[T]):
+    """
+    Items read from the database every time they are accessed. The sequence owns the connection:
+    close it, or use the sequence as a context manager, when the items are not needed anymore
+    """
+
+    def __init__(self, connection: sqlite3.Connection, chunk_size: int) -> None:
+        self._connection = connection
+        self._chunk_size = chunk_size  # Rows are fetched in chunks of this size while the items are iterated over
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "SqliteSequence[T]":
+        return self
+
+    def __exit__(self, exc_type: Optional[type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.close()
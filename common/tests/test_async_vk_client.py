@@ -0,0 +1,65 @@
+import pytest
+import vk_api
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from common.async_vk_client import AsyncVkClient
+from config import Config
+
+
+class FakeVkServer:
+    """Answers every request with the next queued response and records requests"""
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        self.url = ""
+
+    async def handle(self, request):
+        self.requests.append((request.match_info["method"], dict(await request.post())))
+        return web.json_response(self.responses.pop(0))
+
+
+@pytest.fixture
+async def server():
+    fake_server = FakeVkServer()
+    app = web.Application()
+    app.router.add_post("/method/{method}", fake_server.handle)
+    async with TestServer(app) as test_server:
+        fake_server.url = str(test_server.make_url("/method/"))
+        yield fake_server
+
+
+@pytest.fixture
+def config():
+    config = Config(config_file_path=None).vk
+    config.max_requests_per_second = 1000
+    config.api_retry_base_delay = 0
+    return config
+
+
+async def test_method_call(server, config):
+    server.responses.append({"response": [{"id": 1}]})
+    async with AsyncVkClient(config, "token", api_url=server.url) as client:
+        assert await client.get_api().users.get(user_ids=[1, 2]) == [{"id": 1}]
+        server.responses.append({"response": {"count": 0}})
+        await client.get_api().groups.get_by_id(group_ids=3)
+
+    assert server.requests[0] == ("users.get", {"user_ids": "1,2", "v": config.api_version, "access_token": "token"})
+    assert server.requests[1][0] == "groups.getById"
+
+
+async def test_retries(server, config):
+    server.responses += [
+        {"error": {"error_code": 6, "error_msg": "Too many requests per second"}},
+        {"response": 1},
+        {"error": {"error_code": 15, "error_msg": "Access denied"}},
+    ]
+    async with AsyncVkClient(config, "token", api_url=server.url) as client:
+        assert await client.get_api().execute(code="return 1;") == 1
+        with pytest.raises(vk_api.ApiError) as exc_info:
+            await client.get_api().video.get(videos="1_2")
+
+    assert exc_info.value.code == 15
+    assert client.method_calls == {"execute": 2, "video.get": 1}
+    assert client.method_retries == {"execute": 1}
@@ -0,0 +1,199 @@
+import dataclasses
+import pickle
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path, PurePath
+from typing import Any, Optional
+
+import pytest
+
+import tg_importer.types as tg
+import vk_exporter.types as vk
+from common.history_file import HistoryFileFormat
+from common.json_codec import OrjsonCodec, StdlibJsonCodec
+from common.lazy_sequence import ChainedSequence, LazySequence
+from tg_importer.storage import TgHistoryStorage
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import make_raw_message
+
+
+def make_vk_messages():
+    raw_messages = [make_raw_message(i, from_id=i % 3, text=f"text {i}") for i in range(1, 101)]
+    raw_messages[0]["attachments"] = [
+        {"type": "photo", "photo": {"sizes": [{"type": "x", "url": "https://x/1.jpg", "width": 1, "height": 2}]}},
+        {"type": "poll", "poll": {"question": "?", "anonymous": True, "multiple": False, "answers": [
+            {"text": "yes", "votes": 1, "rate": 100.0}, {"text": "no", "votes": 0, "rate": 0.0},
+        ]}},
+    ]
+    raw_messages[1]["fwd_messages"] = [make_raw_message(7, text="forwarded")]
+    raw_messages[2]["reply_message"] = make_raw_message(1)
+    raw_messages[3]["action"] = {"type": "chat_title_update", "text": "new title"}
+    raw_messages[4]["action"] = {"type": "chat_unknown", "items": [1, {"key": ["value"]}]}  # UnsupportedAction
+    return [vk.Message.parse(raw_message) for raw_message in raw_messages]
+
+
+def test_vk_history(tmp_path):
+    messages = make_vk_messages()
+    history = vk.ChatHistory(messages=messages, title_opt="title", photo_opt=vk.Photo("https://x/2.jpg", 3, 4))
+    path = tmp_path / "vk_history.pickle"
+    VkHistoryStorage().save_history(history, path)
+
+    loaded = VkHistoryStorage().load_history(path)
+    assert HistoryFileFormat.is_history_file(path)
+    assert loaded == history
+    assert len(loaded.messages) == 100
+    assert loaded.messages[-1] == messages[-1]
+    assert not hasattr(loaded.messages[0], "__dict__")
+    attachments = loaded.messages[0].attachments
+    assert isinstance(attachments, LazySequence)
+    is_loaded_before = attachments.is_loaded
+    assert attachments == messages[0].attachments
+    assert (is_loaded_before, attachments.is_loaded) == (False, True)
+    assert loaded.messages[10:20] == messages[10:20]
+    assert loaded.messages[::-1] == messages[::-1]
+    with pytest.raises(IndexError):
+        loaded.messages[100]
+
+
+def test_chained_messages(tmp_path, monkeypatch):
+    messages = make_vk_messages()
+    base_path, path = tmp_path / "base.history", tmp_path / "history.history"
+    VkHistoryStorage().save_history(vk.ChatHistory(messages=messages[:60], title_opt=None, photo_opt=None), base_path)
+    base_messages = VkHistoryStorage().load_history(base_path).messages
+
+    chained = ChainedSequence([base_messages, [], messages[60:]])
+    assert (len(chained), chained[59], chained[60], chained[-1]) == (100, messages[59], messages[60], messages[-1])
+    assert chained == messages
+    monkeypatch.setattr(base_messages, "_decode", None)  # Records of the base history are copied without decoding
+    participants = vk.ParticipantIndex.collect(messages)
+    VkHistoryStorage().save_history(vk.ChatHistory(chained, None, None, participants), path)
+    assert VkHistoryStorage().load_history(path).messages == messages
+
+
+def test_strings_and_dates_are_shared(tmp_path):
+    date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    sticker = vk.Sticker("https://vk.com/sticker/1-2-512")
+    messages = [vk.Message(i, 1, date, "".join(["o", "k"]), attachments=(sticker,)) for i in range(1, 3)]
+    path = tmp_path / "history.history"
+    VkHistoryStorage().save_history(vk.ChatHistory(messages, None, None), path)
+
+    first, second = VkHistoryStorage().load_history(path).messages
+    assert first.text == "ok" and first.text is second.text
+    assert first.date is second.date
+    [first_sticker], [second_sticker] = first.attachments, second.attachments
+    assert isinstance(first_sticker, vk.Sticker) and isinstance(second_sticker, vk.Sticker)
+    assert first_sticker.image_url is second_sticker.image_url
+
+
+def test_tg_history(tmp_path):
+    ts = datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=3)))
+    messages = [
+        tg.Message(ts, "user", "text"),
+        tg.Message(ts, "user", "", tg.Sticker(PurePath("media/sticker.webp"))),
+        tg.Message(ts, "user", "caption", tg.Video(Path("video.mp4"), "title", 1, 2, 3, Path("thumb.jpg"))),
+    ]
+    history = tg.ChatHistory(messages=messages, title_opt=None, photo_opt=tg.Photo(Path("photo.jpg")))
+    path = tmp_path / "tg_history.pickle"
+    TgHistoryStorage().save_history(history, path)
+
+    loaded = TgHistoryStorage().load_history(path)
+    assert loaded.messages[0] == messages[0]
+    assert loaded.messages[0].ts.utcoffset() == timedelta(hours=3)
+    sticker, video = loaded.messages[1].attachment, loaded.messages[2].attachment
+    assert isinstance(sticker, tg.Sticker) and sticker.path == PurePath("media/sticker.webp")
+    assert isinstance(video, tg.Video) and vars(video) == vars(messages[2].attachment)
+    assert isinstance(video.path, Path)
+    assert isinstance(loaded.photo_opt, tg.Photo) and loaded.photo_opt.path == Path("photo.jpg")
+
+
+def test_legacy_pickle(tmp_path):
+    history = vk.ChatHistory(messages=make_vk_messages(), title_opt=None, photo_opt=None)
+    path = tmp_path / "vk_history.pickle"
+    path.write_bytes(pickle.dumps(history))
+    assert VkHistoryStorage().load_history(path) == history
+
+
+class PickledWithoutSlots:
+    """Pickles the dataclass as it was pickled before it got slots: fields are in a dict"""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __reduce__(self):
+        return object.__new__, (type(self.obj),), {field.name: getattr(self.obj, field.name)
+                                                   for field in dataclasses.fields(self.obj)}
+
+
+def test_legacy_pickle_without_slots(tmp_path):
+    message = make_vk_messages()[0]
+    legacy_message = dataclasses.replace(message, attachments=tuple(map(PickledWithoutSlots, message.attachments)))
+    legacy_messages: list[Any] = [PickledWithoutSlots(legacy_message)]
+    path = tmp_path / "vk_history.pickle"
+    path.write_bytes(pickle.dumps(vk.ChatHistory(legacy_messages, None, None)))
+    assert VkHistoryStorage().load_history(path).messages == [message]
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+OldPoint = Point
+
+
+@dataclass
+class Point:  # type: ignore[no-redef]  # Pretend the class has changed since the file was written
+    y: int
+    x: int
+    label_opt: Optional[str] = None
+
+
+NewPoint = Point
+
+
+def test_class_fields_changed(tmp_path):
+    path = tmp_path / "history"
+    with path.open("wb") as f:
+        HistoryFileFormat([OldPoint]).write(f, {}, [OldPoint(1, 2)])
+    _, points = HistoryFileFormat([NewPoint]).read(path)
+    assert list(points) == [NewPoint(x=1, y=2)]
+
+
+def test_unknown_class(tmp_path):
+    path = tmp_path / "history"
+    with path.open("wb") as f:
+        with pytest.raises(TypeError):
+            HistoryFileFormat([]).write(f, {}, [OldPoint(1, 2)])
+        f.seek(0)
+        f.truncate()
+        HistoryFileFormat([OldPoint]).write(f, {}, [OldPoint(1, 2)])
+    with pytest.raises(ValueError):
+        HistoryFileFormat([]).read(path)
+
+
+def test_truncated_file(tmp_path):
+    path = tmp_path / "history"
+    with path.open("wb") as f:
+        HistoryFileFormat([OldPoint]).write(f, {}, [OldPoint(1, 2)])
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        HistoryFileFormat([OldPoint]).read(path)
+
+
+@dataclass
+class Box:
+    items: Any
+
+
+def test_records_are_json(tmp_path):
+    path = tmp_path / "history"
+    with path.open("wb") as f:
+        HistoryFileFormat([Box], StdlibJsonCodec()).write(f, {}, [Box([(2.5, "тест"), None])])
+    data = path.read_bytes()
+    record_start = 8 + 2 + 4  # Magic, version and length of the record
+    assert data[record_start:data.index(b"]]") + 2] == '[0,[-1,[-6,2.5,"тест"],null]]'.encode("utf-8")
+
+    pytest.importorskip("orjson")
+    _, boxes = HistoryFileFormat([Box], OrjsonCodec()).read(path)  # Any codec reads it
+    assert list(boxes) == [Box([(2.5, "тест"), None])]
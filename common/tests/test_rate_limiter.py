@@ -0,0 +1,101 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import vk_api
+
+from common.rate_limiter import TokenBucket
+from common.vk_client import VkClient
+from config import Config
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    assert [bucket.reserve() for _ in range(2)] == [0, 0]  # Burst
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+    clock.now = 10  # Tokens are restored, but not above capacity
+    assert [bucket.reserve() for _ in range(2)] == [0, 0]
+    bucket.acquire()
+    assert clock.now == pytest.approx(10.5)
+
+
+@pytest.fixture
+def vk_client(monkeypatch):
+    config = Config(config_file_path=None).vk
+    config.max_requests_per_second = 1000
+    config.api_retry_base_delay = 0
+    monkeypatch.setenv("VK_API_ID", "1")
+    return VkClient(config, token="token")
+
+
+def make_error(client, code):
+    return vk_api.ApiError(client, "messages.getHistory", {}, False, {"error_code": code, "error_msg": ""})
+
+
+def test_retry_too_many_requests(vk_client, monkeypatch):
+    responses = [make_error(vk_client, 6), make_error(vk_client, 10), {"count": 1}]
+
+    def fake_method(self, method, values=None, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(vk_api.VkApi, "method", fake_method)
+    assert vk_client.get_api().messages.getHistory(peer_id=1, count=0) == {"count": 1}
+    assert vk_client.method_calls == {"messages.getHistory": 3}
+    assert vk_client.method_retries == {"messages.getHistory": 2}
+
+
+def test_do_not_retry_other_errors(vk_client, monkeypatch):
+    def fake_method(self, method, values=None, **kwargs):
+        raise make_error(vk_client, 15)  # Access denied
+
+    monkeypatch.setattr(vk_api.VkApi, "method", fake_method)
+    with pytest.raises(vk_api.ApiError):
+        vk_client.get_api().messages.getHistory(peer_id=1, count=0)
+    assert vk_client.method_calls == {"messages.getHistory": 1}
+
+
+def test_give_up_after_retries(vk_client, monkeypatch):
+    def fake_method(self, method, values=None, **kwargs):
+        raise make_error(vk_client, 6)
+
+    monkeypatch.setattr(vk_api.VkApi, "method", fake_method)
+    with pytest.raises(vk_api.ApiError):
+        vk_client.get_api().users.get()
+    assert vk_client.method_calls == {"users.get": vk_client.max_retries + 1}
+
+
+def test_requests_overlap(vk_client, monkeypatch):
+    both_requests_started = threading.Barrier(2, timeout=5)  # Broken if vk_api serializes requests again
+
+    class FakeResponse:
+        ok = True
+
+        @staticmethod
+        def json():
+            return {"response": 1}
+
+    def fake_post(url, values, **kwargs):
+        both_requests_started.wait()
+        return FakeResponse()
+
+    monkeypatch.setattr(vk_client.http, "post", fake_post)
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(lambda _: vk_client.method("users.get"), range(2)))
+    assert results == [1, 1]
@@ -1,11 +1,23 @@
+import contextlib
 import json
+import threading
+import time
+from collections import Counter
 from typing import Any, Callable, Optional
 
 import jconfig.memory
 import vk_api
 
+from common.rate_limiter import TokenBucket
 from config import Config
 
+# https://dev.vk.com/reference/errors
+RETRIABLE_ERROR_CODES = {
+    6,  # Too many requests per second
+    9,  # Flood control
+    10,  # Internal server error
+}
+
 
 class VkClient(vk_api.VkApi):
     def __init__(
@@ -22,6 +34,13 @@ class VkClient(vk_api.VkApi):
             raise ValueError("Provide all: login, password, auth_handler and captcha_handler")
 
         self.name = config.client_name
+        # All requests of this client (including ones made from several threads) share this limit
+        self.rate_limiter = TokenBucket(config.max_requests_per_second, config.max_requests_per_second)
+        self.max_retries = config.max_api_retries
+        self.retry_base_delay = config.api_retry_base_delay
+        self.stats_lock = threading.Lock()
+        self.method_calls: Counter[str] = Counter()
+        self.method_retries: Counter[str] = Counter()
         if token is not None:
             super().__init__(token=token, app_id=config.api_id, api_version=config.api_version)
         elif login is not None:
@@ -39,6 +58,30 @@ class VkClient(vk_api.VkApi):
             if token is None:
                 raise ValueError(f"Failed to load token from {self.name}.session file. Did you login before?")
             super().__init__(token=token, app_id=config.api_id, api_version=config.api_version)
+        # vk_api has its own fixed delay between requests and holds the lock during the whole request to keep it.
+        # rate_limiter keeps the pace instead, so requests from different threads can overlap.
+        # vk_api has no public way to disable the lock, so it is replaced. This relies on VkApi.method taking
+        # 'self.lock' around the http request, as in the version pinned in Pipfile.
+        # test_requests_overlap (common/tests/test_rate_limiter.py) fails if an upgrade breaks it
+        self.RPS_DELAY = 0
+        self.lock = contextlib.nullcontext()
+
+    def method(self, method: str, values: Optional[dict[str, Any]] = None, **kwargs: Any) -> Any:
+        """Every request goes through this method, including ones made by VkApiMethod and VkFunction"""
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            with self.stats_lock:
+                self.method_calls[method] += 1
+            try:
+                return super().method(method, values, **kwargs)
+            except vk_api.ApiError as e:
+                if e.code not in RETRIABLE_ERROR_CODES or attempt >= self.max_retries:
+                    raise
+            with self.stats_lock:
+                self.method_retries[method] += 1
+            time.sleep(self.retry_base_delay * 2 ** attempt)  # Exponential backoff
+            attempt += 1
 
     def check_token(self) -> bool:
         return self._check_token() or False  # _check_token can return None
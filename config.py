@@ -1,3 +1,5 @@
+import os
+
 import envparse
 from datetime import datetime, tzinfo
 from pathlib import PurePath, Path
@@ -22,8 +24,11 @@ class Config:
         self.vk = Config.Vk(env)
         self.vk_default_raw_export_file = Path("vk_raw_history.json")
         self.vk_default_export_file = Path("vk_history.pickle")
+        self.vk_default_export_dir = Path("vk_exports")  # Used when several chats are exported at once
         self.tg_default_export_file = Path("tg_history.pickle")
         self.tg_default_media_export_dir = Path("exported_media")
+        # Media downloaded by the converter is kept here for the next runs
+        self.default_media_cache_dir = Path("media_cache")
         self.default_contacts_mapping_file = Path("contacts_mapping.yaml")
 
     class Telegram:
@@ -50,9 +55,31 @@ class Config:
             self.scope: int = VkUserPermissions.MESSAGES | VkUserPermissions.VIDEO
             self.api_version = "5.131"
             self.timezone = _get_local_timezone()
+            # vk allows user tokens to make 3 requests per second. execute counts as one request
+            self.max_requests_per_second = 3
+            self.max_api_retries = 5  # If vk asks to slow down or fails internally
+            self.api_retry_base_delay = 1.0  # In seconds. It doubles after every retry
+            self.max_api_connections = 10  # Connections kept open by the async client
+            # Batches of history are loaded simultaneously, because network latency takes most of the time
+            self.max_history_workers = 4
+            # Processes which parse raw messages of large histories. Parsing is CPU bound
+            self.max_parse_workers = os.cpu_count() or 1
+            # Parsed raw histories are cached in this directory next to the raw file (see vk_exporter/parse_cache.py)
+            self.parse_cache_dir_name = ".vk_parse_cache"
+            self.max_parse_cache_size_mb = 2048
             # workers which download media files
             self.max_non_video_workers = 10
+            # Files are downloaded in chunks of this size. A download holds at most about 3 chunks in memory:
+            # the one being written and up to 2 buffered by aiohttp
+            self.download_chunk_size_kb = 256
             self.max_video_workers = 5
+            # Processes which convert stickers to .webp. Encoding is CPU bound, but stickers are small, while every
+            # process takes about 2 s and 90 MB to start
+            self.max_image_workers = min(2, os.cpu_count() or 1)
+            # Videos and other files are downloaded simultaneously, but all together use at most this many connections
+            self.max_media_connections = 12
+            # Least recently used files are removed from the media cache when it grows larger
+            self.max_media_cache_size_mb = 20 * 1024
 
             self.max_video_download_retries = 5
             self.max_video_size_mb = 50
@@ -41,7 +41,7 @@ async def run_module(args: MainArguments, config: Config, tg_history_storage: IT
     if isinstance(args, cast(UnionType, LoginArguments)):
         return await login.main(args, config)  # type: ignore[arg-type]
     if isinstance(args, VkExporterArguments):
-        return vk_exporter.main(args, vk_client())
+        return vk_exporter.main(args, config.vk, vk_client())
     if isinstance(args, cast(UnionType, ContactsArguments)):
         return await vk_tg_converter.contacts.main(args, vk_client(), tg_client())  # type: ignore[arg-type]
     if isinstance(args, ConverterArguments):
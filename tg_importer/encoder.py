@@ -1,5 +1,6 @@
 import abc
 import datetime
+from itertools import pairwise
 
 from tg_importer.types import Message, ChatHistory
 
@@ -17,7 +18,7 @@ class WhatsAppAndroidEncoder(IEncoder):
     def encode(self, history: ChatHistory) -> str:
         if not history.messages:
             raise ValueError("No messages provided")
-        if not all(history.messages[i - 1].ts <= history.messages[i].ts for i in range(1, len(history.messages))):
+        if not all(prev.ts <= msg.ts for prev, msg in pairwise(history.messages)):
             raise ValueError("Messages must be sorted by timestamp")
         if not history.is_group and 2 < (users_count := len(set(msg.user for msg in history.messages))):
             raise ValueError(f"Private chat contains too many users: {users_count}")
@@ -0,0 +1,128 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import tg_importer.types as tg
+from common.atomic_file import write_aside
+from common.history_file import HistoryDecoder, HistoryFileFormat
+from common.sqlite_history import SqliteSequence, connect, iter_chunks, read_info, write_info
+from tg_importer.storage import ITgHistoryStorage
+
+_SCHEMA = """
+CREATE TABLE messages (
+    position INTEGER PRIMARY KEY,  -- Index of the message in the history
+    ts REAL NOT NULL,  -- Unix time
+    utc_offset INTEGER,  -- Seconds. NULL if the time is naive
+    user TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX messages_ts ON messages (ts);
+CREATE INDEX messages_user ON messages (user);
+
+CREATE TABLE attachments (
+    message_position INTEGER PRIMARY KEY,  -- Telegram messages have at most one attachment
+    type TEXT NOT NULL,  -- Name of the class: 'Photo', 'Video', ...
+    path TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX attachments_type ON attachments (type);
+"""
+
+_SELECT_MESSAGES = """
+SELECT m.position, m.ts, m.utc_offset, m.user, m.text, a.data
+FROM messages m LEFT JOIN attachments a ON a.message_position = m.position
+"""
+
+
+class SqliteTgHistoryStorage(ITgHistoryStorage):
+    """
+    Stores histories in SQLite databases, so they can be queried without loading everything.
+    Attachments are encoded as in common/history_file.py. Loaded messages are read from the database in chunks
+    while they are being iterated over
+    """
+    _FORMAT_VERSION = 2  # Version 1 stored attachments with marshal
+    _HISTORY_FORMAT = HistoryFileFormat.for_module(tg)
+    _CHUNK_SIZE = 1000  # Messages are written and read in chunks of this size
+
+    def save_history(self, history: tg.ChatHistory, path: Path) -> None:
+        if path.exists():
+            raise FileExistsError(path)
+        encoder = self._HISTORY_FORMAT.make_encoder()
+        with write_aside(path) as tmp_path, closing(connect(tmp_path)) as connection:
+            with connection:
+                connection.executescript(_SCHEMA)
+                for chunk_index, chunk in enumerate(iter_chunks(history.messages, self._CHUNK_SIZE)):
+                    first = chunk_index * self._CHUNK_SIZE
+                    connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", [
+                        (first + i, msg.ts.timestamp(), _get_utc_offset(msg.ts), msg.user, msg.text)
+                        for i, msg in enumerate(chunk)
+                    ])
+                    connection.executemany("INSERT INTO attachments VALUES (?, ?, ?, ?)", [
+                        (first + i, type(msg.attachment).__name__, str(msg.attachment.path),
+                         encoder.dumps(msg.attachment))
+                        for i, msg in enumerate(chunk) if msg.attachment is not None
+                    ])
+                write_info(connection, {
+                    "version": self._FORMAT_VERSION,
+                    "title_opt": history.title_opt,
+                    "photo_opt": encoder.dumps(history.photo_opt),
+                    "schema": json.dumps(encoder.schema),
+                })
+
+    def load_history(self, path: Path) -> tg.ChatHistory:
+        """Messages keep the database open: close them when they are not needed anymore (see SqliteSequence)"""
+        connection = connect(path, read_only=True)
+        try:
+            info = read_info(connection)
+            if info["version"] != self._FORMAT_VERSION:
+                raise ValueError(f"Unsupported history database version: {info['version']}")
+            decoder = self._HISTORY_FORMAT.make_decoder(json.loads(info["schema"]))
+            return tg.ChatHistory(
+                messages=SqliteMessages(connection, decoder, self._CHUNK_SIZE),
+                title_opt=info["title_opt"],
+                photo_opt=decoder.loads(info["photo_opt"]),
+            )
+        except Exception:
+            connection.close()
+            raise
+
+
+class SqliteMessages(SqliteSequence[tg.Message]):
+    """Messages of the history stored in a database. They are read every time they are accessed"""
+
+    def __init__(self, connection: sqlite3.Connection, decoder: HistoryDecoder, chunk_size: int) -> None:
+        super().__init__(connection, chunk_size)
+        self._decoder = decoder
+        self._length: int = connection.execute("SELECT count(*) FROM messages").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[tg.Message]:
+        cursor = self._connection.execute(_SELECT_MESSAGES + "ORDER BY m.position")
+        while rows := cursor.fetchmany(self._chunk_size):
+            yield from map(self._make_message, rows)
+
+    def _load(self, index: int) -> tg.Message:
+        row = self._connection.execute(_SELECT_MESSAGES + "WHERE m.position = ?", (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        return self._make_message(row)
+
+    def _make_message(self, row: tuple[Any, ...]) -> tg.Message:
+        _, ts, utc_offset_opt, user, text, attachment_opt = row
+        tz_opt = None if utc_offset_opt is None else timezone(timedelta(seconds=utc_offset_opt))
+        return tg.Message(
+            ts=datetime.fromtimestamp(ts, tz_opt),  # Naive time is local, as datetime.timestamp() assumes
+            user=user,
+            text=text,
+            attachment=None if attachment_opt is None else self._decoder.loads(attachment_opt),
+        )
+
+
+def _get_utc_offset(ts: datetime) -> Optional[int]:
+    offset_opt = ts.utcoffset()
+    return None if offset_opt is None else int(offset_opt.total_seconds())
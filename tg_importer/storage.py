@@ -2,6 +2,9 @@ import abc
 import pickle
 from pathlib import Path
 
+import tg_importer.types
+from common.history_file import HistoryFileFormat
+from common.sqlite_history import is_sqlite_path
 from tg_importer.types import ChatHistory
 
 
@@ -14,11 +17,35 @@ class ITgHistoryStorage(abc.ABC):
 
 
 class TgHistoryStorage(ITgHistoryStorage):
+    """
+    History is stored in the binary format (see common/history_file.py), messages are loaded lazily.
+    Files with '.sqlite' or '.db' suffix are SQLite databases (see SqliteTgHistoryStorage)
+    """
+    _HISTORY_FORMAT = HistoryFileFormat.for_module(tg_importer.types)
+
     def save_history(self, history: ChatHistory, path: Path) -> None:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().save_history(history, path)
+        chat_info = {"title_opt": history.title_opt, "photo_opt": history.photo_opt}
         with path.open("xb") as f:
-            pickle.dump(history, f)
+            self._HISTORY_FORMAT.write(f, chat_info, history.messages)
 
     def load_history(self, path: Path) -> ChatHistory:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().load_history(path)
+        if not HistoryFileFormat.is_history_file(path):
+            return self._load_legacy_history(path)
+        chat_info, messages = self._HISTORY_FORMAT.read(path)
+        return ChatHistory(messages=messages, **chat_info)
+
+    @staticmethod
+    def _get_sqlite_storage() -> ITgHistoryStorage:
+        from tg_importer.sqlite_storage import SqliteTgHistoryStorage  # It depends on this module
+        return SqliteTgHistoryStorage()
+
+    @staticmethod
+    def _load_legacy_history(path: Path) -> ChatHistory:
+        """Pickled ChatHistory. It was used before the binary format"""
         with path.open("rb") as f:
             history = pickle.load(f)
         assert isinstance(history, ChatHistory)
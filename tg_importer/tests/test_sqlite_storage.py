@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import tg_importer.types as tg
+from tg_importer.storage import TgHistoryStorage
+
+
+def test_round_trip(tmp_path):
+    start = datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=3)))
+    messages = [tg.Message(start + timedelta(minutes=i), f"user {i % 2}", f"text {i}") for i in range(2500)]
+    messages[1] = tg.Message(start, "user", "", tg.Sticker(Path("sticker.webp")))
+    messages[2] = tg.Message(start, "user", "caption", tg.Document(Path("file.zip"), "title.zip"))
+    path = tmp_path / "tg_history.sqlite"
+    TgHistoryStorage().save_history(tg.ChatHistory(messages, "title", tg.Photo(Path("photo.jpg"))), path)
+
+    history = TgHistoryStorage().load_history(path)
+    assert history.title_opt == "title"
+    assert isinstance(history.photo_opt, tg.Photo) and history.photo_opt.path == Path("photo.jpg")
+    assert len(history.messages) == 2500
+    loaded = list(history.messages)
+    assert [(msg.ts, msg.user, msg.text) for msg in loaded] == [(msg.ts, msg.user, msg.text) for msg in messages]
+    assert loaded[0].ts.utcoffset() == timedelta(hours=3)
+    assert loaded[0].attachment is None
+    assert isinstance(loaded[1].attachment, tg.Sticker) and loaded[1].attachment.path == Path("sticker.webp")
+    assert isinstance(history.messages[2].attachment, tg.Document)
+    assert vars(history.messages[2].attachment) == vars(messages[2].attachment)
+    assert history.messages[-1].text == "text 2499"
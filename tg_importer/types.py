@@ -2,7 +2,7 @@ import abc
 import datetime
 from dataclasses import dataclass
 from pathlib import PurePath
-from typing import Optional
+from typing import Optional, Sequence
 
 from pyrogram import Client
 from pyrogram.errors import FilePartMissing
@@ -16,7 +16,7 @@ from pyrogram.raw.types import (
 
 @dataclass
 class ChatHistory:
-    messages: list["Message"]
+    messages: Sequence["Message"]  # Can be lazy: messages loaded from a file are decoded when accessed
     # Only valid for chats (not private messages):
     title_opt: Optional[str]  # All chats have title
     photo_opt: Optional["Photo"]  # If available
@@ -1,6 +1,7 @@
 import argparse
 import urllib.parse
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
 
@@ -15,24 +16,65 @@ class VkExporterArguments:
     raw_import_file: Optional[Path]
     chat_id: Optional[int]
     messages_count: Optional[int]
+    is_resume: bool
+    checkpoint_file: Path  # Export progress is saved here, so it can be resumed after a failure
+    since_export_file: Optional[Path]  # Only messages newer than the ones in this export are loaded
+    after_cmid: int  # Only messages with greater conversation_message_id are loaded
+    date_from_opt: Optional[datetime]  # Only messages sent within [date_from, date_to) are loaded
+    date_to_opt: Optional[datetime]
+    chat_ids: list[int]  # Batch mode: several chats are exported at once, one file per chat
+    export_dir: Path  # Batch mode saves files here
+    parse_workers: int  # Processes which parse raw messages
+    parse_cache_dir_opt: Optional[Path]  # Parsed raw input is cached here. None disables the cache
 
 
 class VkExporterArgumentsParser:
     @staticmethod
     def fill_parser(parser: argparse.ArgumentParser, config: Config) -> "VkExporterArgumentsParser":
         parser.add_argument("--export-file", type=Path, metavar="PATH",
-                            help="File where history will be dumped (in pickle format)")
+                            help="File where history will be dumped")
+        parser.add_argument("--parse-workers", type=int, metavar="N", default=config.vk.max_parse_workers,
+                            help="Number of processes which parse messages of large histories. "
+                                 "Default is the number of CPUs")
 
         group1 = parser.add_argument_group("Import data from raw history file")
         group1.add_argument("--raw-input", nargs="?", type=Path,
                             const=config.vk_default_raw_export_file, metavar="PATH", dest="raw_input_path",
                             help="File containing raw history data. If PATH is not provided, use default one")
+        cache_group = group1.add_mutually_exclusive_group()
+        cache_group.add_argument("--parse-cache-dir", type=Path, metavar="PATH",
+                                 help="Directory where parsed histories are cached, so an unchanged raw file is "
+                                      f"parsed only once. Default is '{config.vk.parse_cache_dir_name}' "
+                                      "next to the raw file")
+        cache_group.add_argument("--no-parse-cache", action="store_true", help="Parse raw file even if it is cached")
 
         group2 = parser.add_argument_group("Import data from vk")
         group2.add_argument("--chat", type=str, metavar="ID/LINK", help="Id of the chat or a link to it")
         group2.add_argument("-n", type=int, metavar="N", help="Export only N last messages")
         group2.add_argument("--raw-export", action="store_true", help="Export only raw messages data")
         group2.add_argument("--no-progress-bar", action="store_true")
+        group2.add_argument("--resume", action="store_true",
+                            help="Continue the interrupted export from the last saved batch")
+        delta_group = group2.add_mutually_exclusive_group()
+        delta_group.add_argument("--since-export", type=Path, metavar="PATH", dest="since_export_path",
+                                 help="Load only messages newer than the ones in this export and add them to it. "
+                                      "The export is updated in place unless --export-file is provided")
+        delta_group.add_argument("--after-cmid", type=int, default=0, metavar="N",
+                                 help="Load only messages with conversation_message_id greater than N")
+        group2.add_argument("--from", type=str, metavar="DATE", dest="date_from",
+                            help="Load only messages sent since DATE (inclusive), e.g. 2021-01-01 or 2021-01-01T12:00. "
+                                 "Time is in UTC unless the offset is provided")
+        group2.add_argument("--to", type=str, metavar="DATE", dest="date_to",
+                            help="Load only messages sent before DATE (exclusive)")
+
+        group3 = parser.add_argument_group("Import data from several vk chats at once",
+                                           "Options of the previous group are applied to every chat")
+        group3.add_argument("--chats", nargs="+", type=str, metavar="ID/LINK", default=[],
+                            help="Ids of the chats or links to them")
+        group3.add_argument("--chats-file", type=Path, metavar="PATH",
+                            help="File with an id or a link on every line")
+        group3.add_argument("--export-dir", type=Path, metavar="PATH", default=config.vk_default_export_dir,
+                            help="Directory where histories will be dumped, one file per chat")
 
         return VkExporterArgumentsParser(parser, config)
 
@@ -53,10 +95,40 @@ class VkExporterArgumentsParser:
         assert chat_id is None or isinstance(chat_id, int)
         messages_count = namespace.n
         assert messages_count is None or isinstance(messages_count, int)
+        is_resume = namespace.resume
+        assert isinstance(is_resume, bool)
+        since_export_file = namespace.since_export_path
+        assert since_export_file is None or isinstance(since_export_file, Path)
+        after_cmid = namespace.after_cmid
+        assert isinstance(after_cmid, int)
+        date_from_opt = None if namespace.date_from is None else self._parse_date(namespace.date_from)
+        assert date_from_opt is None or isinstance(date_from_opt, datetime)
+        date_to_opt = None if namespace.date_to is None else self._parse_date(namespace.date_to)
+        assert date_to_opt is None or isinstance(date_to_opt, datetime)
+        chat_ids: list[int] = [self._get_chat_id(chat) for chat in namespace.chats]
+        chats_file = namespace.chats_file
+        assert chats_file is None or isinstance(chats_file, Path)
+        if chats_file is not None:
+            chat_ids += [self._get_chat_id(chat) for chat in self._read_chats_file(chats_file)]
+        export_dir = namespace.export_dir
+        assert isinstance(export_dir, Path)
+        parse_workers = namespace.parse_workers
+        assert isinstance(parse_workers, int)
+        parse_cache_dir_opt = namespace.parse_cache_dir
+        assert parse_cache_dir_opt is None or isinstance(parse_cache_dir_opt, Path)
+        is_no_parse_cache = namespace.no_parse_cache
+        assert isinstance(is_no_parse_cache, bool)
+        if parse_cache_dir_opt is None and not is_no_parse_cache and raw_import_file is not None:
+            parse_cache_dir_opt = raw_import_file.parent / self.config.vk.parse_cache_dir_name
+        if chat_ids and (arg_export_file is not None or is_resume):
+            self.parser.error("Do not use --export-file and --resume with several chats. "
+                              "Files are saved to --export-dir, interrupted exports are resumed automatically")
 
         export_file: Path
         if arg_export_file is not None:
             export_file = arg_export_file
+        elif since_export_file is not None:
+            export_file = since_export_file
         elif is_raw_export:
             export_file = self.config.vk_default_raw_export_file
         else:
@@ -69,10 +141,36 @@ class VkExporterArgumentsParser:
             raw_import_file=raw_import_file,
             chat_id=chat_id,
             messages_count=messages_count,
+            is_resume=is_resume,
+            checkpoint_file=export_file.with_name(export_file.name + ".checkpoint"),
+            since_export_file=since_export_file,
+            after_cmid=after_cmid,
+            date_from_opt=date_from_opt,
+            date_to_opt=date_to_opt,
+            chat_ids=chat_ids,
+            export_dir=export_dir,
+            parse_workers=parse_workers,
+            parse_cache_dir_opt=parse_cache_dir_opt,
         )
         self._validate(args)
         return args
 
+    def _parse_date(self, input_str: str) -> datetime:
+        try:
+            date = datetime.fromisoformat(input_str)
+        except ValueError:
+            self.parser.error(f"Can't parse date '{input_str}', use YYYY-MM-DD format")
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)  # Message dates are in UTC as well
+        return date
+
+    def _read_chats_file(self, path: Path) -> list[str]:
+        """Empty lines and lines starting with '#' are skipped"""
+        if not path.is_file():
+            self.parser.error(f"Chats file does not exist: {path}")
+        lines = (line.strip() for line in path.read_text(encoding="utf-8").splitlines())
+        return [line for line in lines if line and not line.startswith("#")]
+
     def _get_chat_id(self, input_str: str) -> int:
         try:
             return int(input_str)
@@ -97,15 +195,55 @@ class VkExporterArgumentsParser:
             self.parser.error(f"Can't extract chat id from url '{link}'")
 
     def _validate(self, args: VkExporterArguments) -> None:
-        if args.export_file.exists():
+        if args.export_file.exists() and args.export_file != args.since_export_file and not args.chat_ids:
             self.parser.error(f"Export file already exists: {args.export_file}")
-        if (args.chat_id is None) == (args.raw_import_file is None):
-            self.parser.error("Provide either '--chat ID' or '--raw-input [PATH]'")
+        if [args.chat_id is not None, args.raw_import_file is not None, bool(args.chat_ids)].count(True) != 1:
+            self.parser.error("Provide either '--chat ID', '--chats ID...' (or '--chats-file PATH') "
+                              "or '--raw-input [PATH]'")
+        if len(set(args.chat_ids)) != len(args.chat_ids):
+            self.parser.error("Some chats are listed more than once")
+        if args.chat_ids and (args.since_export_file is not None or args.after_cmid != 0):
+            self.parser.error("--since-export and --after-cmid can only be used with --chat")
+        if args.parse_workers < 1:
+            self.parser.error("--parse-workers must be positive")
+        if args.export_dir.exists() and not args.export_dir.is_dir():
+            self.parser.error(f"Export directory path does not point to a directory: {args.export_dir}")
         if args.raw_import_file is not None:
             if not args.raw_import_file.exists():
                 self.parser.error(f"Import file does not exist: {args.raw_import_file}")
             if not args.raw_import_file.is_file():
                 self.parser.error(f"Import file path does not point to a file: {args.raw_import_file}")
+        if args.parse_cache_dir_opt is not None:
+            if args.raw_import_file is None:
+                self.parser.error("--parse-cache-dir can only be used with --raw-input")
+            if args.parse_cache_dir_opt.exists() and not args.parse_cache_dir_opt.is_dir():
+                self.parser.error(f"Parse cache path does not point to a directory: {args.parse_cache_dir_opt}")
         if args.is_raw_export and args.raw_import_file is not None:
             self.parser.error("You are trying to save raw data while reading raw data: "
                               "do not use both --raw-export and --raw-input")
+        if args.chat_id is not None:
+            if args.is_resume and not args.checkpoint_file.exists():
+                self.parser.error(f"Nothing to resume, checkpoint file does not exist: {args.checkpoint_file}")
+            if not args.is_resume and args.checkpoint_file.exists():
+                self.parser.error(f"There is an interrupted export: {args.checkpoint_file}. "
+                                  "Use --resume to continue it or delete the file to start from scratch")
+        elif args.is_resume:
+            self.parser.error("--resume can only be used with --chat")
+        if args.since_export_file is not None:
+            if args.chat_id is None:
+                self.parser.error("--since-export can only be used with --chat")
+            if not args.since_export_file.is_file():
+                self.parser.error(f"Previous export does not exist: {args.since_export_file}")
+        if args.after_cmid != 0:
+            if args.chat_id is None:
+                self.parser.error("--after-cmid can only be used with --chat")
+            if args.after_cmid < 0:
+                self.parser.error("--after-cmid must not be negative")
+        if args.date_from_opt is not None or args.date_to_opt is not None:
+            if args.chat_id is None and not args.chat_ids:
+                self.parser.error("--from and --to can only be used with --chat or --chats")
+            if args.since_export_file is not None:
+                self.parser.error("--from and --to can't be used with --since-export")
+            if args.date_from_opt is not None and args.date_to_opt is not None \
+                    and args.date_from_opt >= args.date_to_opt:
+                self.parser.error("--from date must be earlier than --to date")
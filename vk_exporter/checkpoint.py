@@ -0,0 +1,93 @@
+import abc
+import json
+import os
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+
+
+@dataclass
+class CheckpointHeader:
+    peer_id: int
+    last_message_id: int  # Offsets are counted from this message, so they stay valid if new messages arrive
+    total_messages: int
+    title_opt: Optional[str]
+    photo_url_opt: Optional[str]
+    photo_size_opt: Optional[int]
+    after_cmid: int = 0  # Only messages with greater conversation_message_id are exported
+    skip_messages: int = 0  # This many newest messages are skipped, offsets start from it
+    date_from_opt: Optional[int] = None  # Unix time. Only messages sent within [date_from, date_to) are exported
+    date_to_opt: Optional[int] = None
+
+
+class IExportCheckpoint(abc.ABC):
+    @abc.abstractmethod
+    def load_header(self) -> Optional[CheckpointHeader]: ...
+
+    @abc.abstractmethod
+    def iter_batches(self) -> Iterator[tuple[int, list[dict]]]: ...
+
+    @abc.abstractmethod
+    def start(self, header: CheckpointHeader) -> None: ...
+
+    @abc.abstractmethod
+    def append_batch(self, offset: int, messages: list[dict]) -> None: ...
+
+    @abc.abstractmethod
+    def remove(self) -> None: ...
+
+
+class ExportCheckpoint(IExportCheckpoint):
+    """
+    Checkpoint is a json-lines file. The first line is a header, every next line is a batch of raw messages.
+    Each line is flushed to disk as soon as it is written, so an interrupted export loses at most one batch
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def load_header(self) -> Optional[CheckpointHeader]:
+        if not self.path.exists():
+            return None
+        header: Optional[CheckpointHeader] = None
+        valid_size = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # The last line could be written partially if the process was killed
+                    break
+                if header is None:
+                    header = CheckpointHeader(**record)
+                valid_size += len(line)
+        if header is None:  # Nothing useful was saved
+            self.remove()
+        elif valid_size != self.path.stat().st_size:
+            os.truncate(self.path, valid_size)  # Drop the broken tail, so the next batch starts from a new line
+        return header
+
+    def iter_batches(self) -> Iterator[tuple[int, list[dict]]]:
+        if not self.path.exists():
+            return
+        with self.path.open("rb") as f:
+            f.readline()  # Skip the header
+            for line in f:
+                record = json.loads(line)
+                yield record["offset"], record["messages"]
+
+    def start(self, header: CheckpointHeader) -> None:
+        with self.path.open("x") as f:
+            self._write_line(f, asdict(header))
+
+    def append_batch(self, offset: int, messages: list[dict]) -> None:
+        with self.path.open("a") as f:
+            self._write_line(f, {"offset": offset, "messages": messages})
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _write_line(f: TextIO, record: dict) -> None:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
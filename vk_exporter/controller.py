@@ -1,4 +1,7 @@
+from typing import Optional
+
 from vk_exporter.arguments import VkExporterArguments
+from vk_exporter.checkpoint import ExportCheckpoint, IExportCheckpoint
 from vk_exporter.service import IVkExporterService
 
 
@@ -9,11 +12,41 @@ class VkExporterController:
     def __call__(self, args: VkExporterArguments) -> None:
         if args.raw_import_file is not None:
             self.service.export_history_from_raw_input(args.raw_import_file, args.export_file)
+        elif args.chat_ids:
+            self._export_several_chats(args)
+        elif args.since_export_file is not None:
+            assert args.chat_id is not None
+            update = self.service.update_raw_history if args.is_raw_export else self.service.update_history
+            update(args.chat_id, args.messages_count, args.is_disable_progress_bar,
+                   args.since_export_file, args.export_file, ExportCheckpoint(args.checkpoint_file))
         elif args.is_raw_export:
             assert args.chat_id is not None
             self.service.export_raw_history(args.chat_id, args.messages_count, args.is_disable_progress_bar,
-                                            args.export_file)
+                                            args.export_file, ExportCheckpoint(args.checkpoint_file),
+                                            args.after_cmid, args.date_from_opt, args.date_to_opt)
         else:
             assert args.chat_id is not None
             self.service.export_history(args.chat_id, args.messages_count, args.is_disable_progress_bar,
-                                        args.export_file)
+                                        args.export_file, ExportCheckpoint(args.checkpoint_file), args.after_cmid,
+                                        args.date_from_opt, args.date_to_opt)
+
+    def _export_several_chats(self, args: VkExporterArguments) -> None:
+        suffix = ".json" if args.is_raw_export else ".pickle"
+        peer_ids, export_paths = [], []
+        for peer_id in args.chat_ids:
+            export_path = args.export_dir / f"{peer_id}{suffix}"
+            if export_path.exists():  # Exported during the previous run
+                print(f"Skip chat {peer_id}, it is already exported: {export_path}")
+                continue
+            peer_ids.append(peer_id)
+            export_paths.append(export_path)
+        if not peer_ids:
+            return
+        args.export_dir.mkdir(parents=True, exist_ok=True)
+        # Interrupted exports are resumed from their checkpoints
+        checkpoints: list[Optional[IExportCheckpoint]] = [
+            ExportCheckpoint(path.with_name(path.name + ".checkpoint")) for path in export_paths
+        ]
+        export = self.service.export_raw_histories if args.is_raw_export else self.service.export_histories
+        export(peer_ids, args.messages_count, args.is_disable_progress_bar, export_paths, checkpoints,
+               args.date_from_opt, args.date_to_opt)
@@ -0,0 +1,154 @@
+import json
+import random
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Optional
+
+import vk_api
+from vk_api.vk_api import VkApiMethod
+
+from vk_exporter.vk_service import GET_CHATS_INFO_SCRIPT, GET_HISTORY_SCRIPT
+
+
+def make_raw_message(conversation_message_id: int, from_id: int = 1, text: str = "") -> dict[str, Any]:
+    return {
+        "id": conversation_message_id,  # In vk they differ, but it doesn't matter here
+        "conversation_message_id": conversation_message_id,
+        "from_id": from_id,
+        "date": 1_600_000_000 + 60 * conversation_message_id,
+        "text": text or f"Message {conversation_message_id}",
+    }
+
+
+class FakeVkApi:
+    """
+    Stands in for vk_api.VkApi in tests and benchmarks: serves chats from memory.
+    Use get_api() where VkApiMethod is expected.
+    'execute' only runs the scripts this application sends. Requests made inside execute are counted in 'calls' too.
+    It can imitate the network: every request takes 'latency' seconds, requests above the limit
+    and a random share of requests fail like they do in vk. Thread-safe
+    """
+
+    def __init__(self, latency: float = 0.0, max_requests_per_second_opt: Optional[float] = None,
+                 error_rate: float = 0.0, seed: int = 0) -> None:
+        self.chats: dict[int, list[dict[str, Any]]] = {}  # peer_id -> messages in chronological order
+        self.titles: dict[int, str] = {}
+        self.calls: Counter[str] = Counter()
+        self.errors: Counter[int] = Counter()  # error code -> how many times it was returned
+        self.response_bytes = 0  # Size of all responses sent "over the network"
+        self.latency = latency
+        self.max_requests_per_second_opt = max_requests_per_second_opt  # Error 6 if requests come faster
+        self.error_rate = error_rate  # Share of requests that fail with error 10 (internal server error)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_times: deque[float] = deque()  # Requests within the last second
+
+    def add_chat(self, peer_id: int, messages_count: int, title_opt: Optional[str] = None, text_size: int = 0) -> None:
+        """text_size makes messages heavier: every text is padded up to this many characters"""
+        self.chats[peer_id] = [make_raw_message(i, text=f"Message {i} ".ljust(text_size, "x") if text_size else "")
+                               for i in range(1, messages_count + 1)]
+        if title_opt is not None:
+            self.titles[peer_id] = title_opt
+
+    def get_api(self) -> VkApiMethod:
+        return VkApiMethod(self)
+
+    def method(self, method: str, values: Optional[dict[str, Any]] = None, **kwargs: Any) -> Any:
+        values = values or {}
+        with self.lock:
+            self.calls[method] += 1
+            error_code_opt = self._pick_error_code()
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if error_code_opt is not None:
+            error = {"error_code": error_code_opt, "error_msg": "Fake error"}
+            raise vk_api.ApiError(self, method, values, {"error": error}, error)
+        with self.lock:
+            response: Any
+            match method:
+                case "messages.getConversationsById":
+                    response = self._get_conversations_by_id(values)
+                case "messages.getHistory":
+                    response = self._get_history(values)
+                case "execute" if values["code"] == GET_HISTORY_SCRIPT:
+                    response = self._execute_get_history_script(values)
+                case "execute" if values["code"] == GET_CHATS_INFO_SCRIPT:
+                    response = self._execute_get_chats_info_script(values)
+                case _:
+                    raise NotImplementedError(method)
+            self.response_bytes += len(json.dumps(response, ensure_ascii=False).encode())
+        return response
+
+    def _pick_error_code(self) -> Optional[int]:
+        if self.max_requests_per_second_opt is not None:
+            now = time.monotonic()
+            while self.request_times and self.request_times[0] <= now - 1:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.max_requests_per_second_opt:
+                self.errors[6] += 1
+                return 6  # Too many requests per second
+            self.request_times.append(now)
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.errors[10] += 1
+            return 10  # Internal server error
+        return None
+
+    def _get_conversations_by_id(self, values: dict[str, Any]) -> dict[str, Any]:
+        items = []
+        for peer_id in map(int, str(values["peer_ids"]).split(",")):
+            messages = self.chats[peer_id]
+            conversation: dict[str, Any] = {
+                "peer": {"id": peer_id, "type": "chat" if peer_id > 2_000_000_000 else "user"},
+                "last_message_id": messages[-1]["id"] if messages else 0,
+            }
+            if peer_id > 2_000_000_000:
+                conversation["chat_settings"] = {"title": self.titles.get(peer_id, f"Chat {peer_id}")}
+            items.append(conversation)
+        return {"count": len(items), "items": items}
+
+    def _get_history(self, values: dict[str, Any]) -> dict[str, Any]:
+        """Newest messages go first. Offset is counted backwards from 'start_message_id' (or the last message)"""
+        messages = self.chats[int(values["peer_id"])]
+        count = int(values.get("count", 20))
+        offset = int(values.get("offset", 0))
+        assert 0 <= count <= 200, count
+        end = len(messages)
+        if "start_message_id" in values:
+            end = next(i + 1 for i, msg in enumerate(messages) if msg["id"] == int(values["start_message_id"]))
+        end = max(end - offset, 0)
+        begin = max(end - count, 0)
+        return {"count": len(messages), "items": messages[begin:end][::-1]}
+
+    def _execute_get_history_script(self, values: dict[str, Any]) -> list[dict[str, Any]]:
+        """Does the same as GET_HISTORY_SCRIPT"""
+        batch_size, max_iter = 200, 25
+        count = int(values["count"])
+        messages: list[dict[str, Any]] = []
+        offset = int(values["offset"])
+        i = 0
+        while i < max_iter and len(messages) < count:
+            size = min(count - len(messages), batch_size)
+            self.calls["messages.getHistory"] += 1
+            items = self._get_history({
+                "peer_id": values["peer_id"],
+                "start_message_id": values["start_message_id"],
+                "offset": offset,
+                "count": size,
+            })["items"]
+            messages += items
+            offset += size
+            i += 1
+            if len(items) < size:
+                i = max_iter
+        return messages
+
+    def _execute_get_chats_info_script(self, values: dict[str, Any]) -> dict[str, Any]:
+        """Does the same as GET_CHATS_INFO_SCRIPT"""
+        peer_ids = str(values["peer_ids"]).split(",")
+        self.calls["messages.getConversationsById"] += 1
+        self.calls["messages.getHistory"] += len(peer_ids)
+        return {
+            "conversations": self._get_conversations_by_id({"peer_ids": values["peer_ids"]})["items"],
+            "counts": [self._get_history({"peer_id": peer_id, "count": 0})["count"] for peer_id in peer_ids],
+        }
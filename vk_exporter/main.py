@@ -1,15 +1,24 @@
 from common.vk_client import VkClient
+from config import Config
 from vk_exporter.arguments import VkExporterArguments
 from vk_exporter.controller import VkExporterController
+from vk_exporter.parse_cache import ParsedHistoryCache
 from vk_exporter.service import VkExporterService
 from vk_exporter.storage import VkHistoryStorage
 from vk_exporter.vk_service import VkService
 
 
-def main(args: VkExporterArguments, vk_client: VkClient) -> None:
+def main(args: VkExporterArguments, vk_config: Config.Vk, vk_client: VkClient) -> None:
+    storage = VkHistoryStorage()
+    parse_cache_opt = None
+    if args.parse_cache_dir_opt is not None:
+        parse_cache_opt = ParsedHistoryCache(storage, args.parse_cache_dir_opt,
+                                             vk_config.max_parse_cache_size_mb * 2 ** 20)
     service = VkExporterService(
-        VkService(vk_client.get_api()),
-        VkHistoryStorage(),
+        VkService(vk_client.get_api(), vk_config.max_history_workers),
+        storage,
+        args.parse_workers,
+        parse_cache_opt,
     )
     controller = VkExporterController(service)
     controller(args)
@@ -0,0 +1,88 @@
+import abc
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional
+
+import vk_exporter.types
+from common.history_file import HistoryFileFormat
+from vk_exporter.parser import MessageParser
+from vk_exporter.storage import IVkHistoryStorage
+from vk_exporter.types import ChatHistory
+
+
+class IParsedHistoryCache(abc.ABC):
+    @abc.abstractmethod
+    def get_key(self, raw_input_path: Path) -> str:
+        """Identifies the raw history with its content. It reads the whole file, so get it once for load and save"""
+
+    @abc.abstractmethod
+    def load(self, key: str) -> Optional[ChatHistory]:
+        """Returns None if the raw history was not parsed yet, or it has changed since then"""
+
+    @abc.abstractmethod
+    def save(self, key: str, history: ChatHistory) -> ChatHistory:
+        """Returns the same history. If it was cached, its messages are read lazily from the cache"""
+
+
+class ParsedHistoryCache(IParsedHistoryCache):
+    """
+    Parsed histories are saved to the cache directory in the binary history format, one file per raw history.
+    File name is a hash of the raw file content, the parser version, the history file version and the schema
+    of vk types, so a changed raw file, parser, format or type is never read from the cache:
+    such files are just not used anymore.
+    Every read touches the file. When the directory grows over max_size_bytes, least recently used files are removed
+    """
+    _SUFFIX = ".history"
+    _READ_SIZE = 1 << 20  # Raw files are hashed in chunks of this size
+
+    def __init__(self, storage: IVkHistoryStorage, cache_dir: Path, max_size_bytes: int) -> None:
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+
+    def get_key(self, raw_input_path: Path) -> str:
+        digest = hashlib.blake2b()
+        with raw_input_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(self._READ_SIZE), b""):
+                digest.update(chunk)
+        versions = f"{MessageParser.VERSION}:{_HISTORY_FORMAT.VERSION}:{_HISTORY_FORMAT.get_fixed_schema()}"
+        digest.update(versions.encode("utf-8"))
+        return digest.hexdigest()[:32]
+
+    def load(self, key: str) -> Optional[ChatHistory]:
+        path = self._get_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return self.storage.load_history(path)
+
+    def save(self, key: str, history: ChatHistory) -> ChatHistory:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._get_path(key)
+        self.storage.save_history(history, path, overwrite=True)
+        self._evict()
+        if not path.exists():  # It is larger than the whole cache
+            return history
+        return self.storage.load_history(path)  # Messages are not encoded again when the history is saved
+
+    def _get_path(self, key: str) -> Path:
+        return self.cache_dir / (key + self._SUFFIX)
+
+    def _evict(self) -> None:
+        files = []
+        for path in self.cache_dir.glob("*" + self._SUFFIX):
+            stat = path.stat()
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size_bytes:
+                break
+            path.unlink(missing_ok=True)
+            for sidecar_path in self.cache_dir.glob(path.name + ".*"):  # Participant index of the history
+                sidecar_path.unlink(missing_ok=True)
+            total_size -= size
+
+
+_HISTORY_FORMAT = HistoryFileFormat.for_module(vk_exporter.types)
@@ -1,54 +1,226 @@
 import abc
+import itertools
+import multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Iterable, Iterator, Optional, Sequence
 
+import vk_exporter.types
+from common.history_file import HistoryFileFormat
+from common.lazy_sequence import ChainedSequence
+from vk_exporter.checkpoint import IExportCheckpoint
+from vk_exporter.parse_cache import IParsedHistoryCache
+from vk_exporter.parser import MessageParser
 from vk_exporter.storage import IVkHistoryStorage
-from vk_exporter.types import ChatHistory, Message, Photo, ChatRawHistory
+from vk_exporter.types import ChatHistory, Message, ParticipantIndex, Photo, ChatRawHistory
 from vk_exporter.vk_service import IVkService
 
 
 class IVkExporterService(abc.ABC):
     @abc.abstractmethod
-    def export_history(self, peer_id: int, max_messages: None | int,
-                       disable_progress_bar: bool, export_path: Path) -> None: ...
+    def export_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                       export_path: Path, checkpoint_opt: None | IExportCheckpoint = None, after_cmid: int = 0,
+                       date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None: ...
 
     @abc.abstractmethod
-    def export_raw_history(self, peer_id: int, max_messages: None | int,
-                           disable_progress_bar: bool, export_path: Path) -> None: ...
+    def export_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                           export_path: Path, checkpoint_opt: None | IExportCheckpoint = None,
+                           after_cmid: int = 0,
+                           date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None: ...
+
+    @abc.abstractmethod
+    def export_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                         export_paths: list[Path], checkpoints: list[Optional[IExportCheckpoint]],
+                         date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None:
+        """Exports several chats at once: one file per chat"""
+
+    @abc.abstractmethod
+    def export_raw_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                             export_paths: list[Path], checkpoints: list[Optional[IExportCheckpoint]],
+                             date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None: ...
+
+    @abc.abstractmethod
+    def update_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                       base_export_path: Path, export_path: Path,
+                       checkpoint_opt: None | IExportCheckpoint = None) -> None:
+        """Loads only messages newer than the ones in base export and saves them together"""
+
+    @abc.abstractmethod
+    def update_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                           base_export_path: Path, export_path: Path,
+                           checkpoint_opt: None | IExportCheckpoint = None) -> None: ...
 
     @abc.abstractmethod
     def export_history_from_raw_input(self, raw_input_path: Path, export_path: Path) -> None: ...
 
 
 class VkExporterService(IVkExporterService):
-    def __init__(self, vk_service: IVkService, storage: IVkHistoryStorage) -> None:
+    _PARSE_CHUNK_SIZE = 2000  # Messages are sent to parsing processes in chunks of this size
+    _MIN_PARALLEL_PARSE_MESSAGES = 50_000  # Starting processes takes longer than parsing smaller histories
+
+    def __init__(self, vk_service: IVkService, storage: IVkHistoryStorage, parse_workers: int = 1,
+                 parse_cache_opt: Optional[IParsedHistoryCache] = None) -> None:
         self.vk_service = vk_service
         self.storage = storage
+        self.parse_workers = parse_workers
+        self.parse_cache_opt = parse_cache_opt  # Raw input files are parsed once if they don't change
 
-    def export_history(self, peer_id: int, max_messages: None | int,
-                       disable_progress_bar: bool, export_path: Path) -> None:
-        raw_history = self.vk_service.get_raw_history(peer_id, max_messages, disable_progress_bar)
+    def export_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                       export_path: Path, checkpoint_opt: None | IExportCheckpoint = None, after_cmid: int = 0,
+                       date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None:
+        raw_history = self.vk_service.get_raw_history(
+            peer_id, max_messages, disable_progress_bar, checkpoint_opt, after_cmid, date_from_opt, date_to_opt)
         history = self._parse_raw_history(raw_history)
         self.storage.save_history(history, export_path)
+        if checkpoint_opt is not None:  # Export is saved, so the checkpoint is not needed anymore
+            checkpoint_opt.remove()
 
-    def export_raw_history(self, peer_id: int, max_messages: None | int,
-                           disable_progress_bar: bool, export_path: Path) -> None:
-        raw_history = self.vk_service.get_raw_history(peer_id, max_messages, disable_progress_bar)
+    def export_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                           export_path: Path, checkpoint_opt: None | IExportCheckpoint = None,
+                           after_cmid: int = 0,
+                           date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None:
+        raw_history = self.vk_service.get_raw_history(
+            peer_id, max_messages, disable_progress_bar, checkpoint_opt, after_cmid, date_from_opt, date_to_opt)
         self.storage.save_raw_history(raw_history, export_path)
+        if checkpoint_opt is not None:
+            checkpoint_opt.remove()
+
+    def export_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                         export_paths: list[Path], checkpoints: list[Optional[IExportCheckpoint]],
+                         date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None:
+        raw_histories = self.vk_service.get_raw_histories(
+            peer_ids, max_messages, disable_progress_bar, checkpoints, date_from_opt, date_to_opt)
+        # Histories share one loading queue, so they are processed strictly one by one
+        for raw_history, export_path, checkpoint_opt in zip(raw_histories, export_paths, checkpoints):
+            self.storage.save_history(self._parse_raw_history(raw_history), export_path)
+            if checkpoint_opt is not None:
+                checkpoint_opt.remove()
+
+    def export_raw_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                             export_paths: list[Path], checkpoints: list[Optional[IExportCheckpoint]],
+                             date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> None:
+        raw_histories = self.vk_service.get_raw_histories(
+            peer_ids, max_messages, disable_progress_bar, checkpoints, date_from_opt, date_to_opt)
+        for raw_history, export_path, checkpoint_opt in zip(raw_histories, export_paths, checkpoints):
+            self.storage.save_raw_history(raw_history, export_path)
+            if checkpoint_opt is not None:
+                checkpoint_opt.remove()
+
+    def update_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                       base_export_path: Path, export_path: Path,
+                       checkpoint_opt: None | IExportCheckpoint = None) -> None:
+        base_history = self.storage.load_history(base_export_path)
+        # conversation_message_id grows with every message, so only the last one is decoded
+        after_cmid = base_history.messages[-1].conversation_message_id if base_history.messages else 0
+        raw_history = self.vk_service.get_raw_history(
+            peer_id, max_messages, disable_progress_bar, checkpoint_opt, after_cmid)
+        new_history = self._parse_raw_history(raw_history)
+        participants_opt = None  # It is collected from all messages on save if the base export has no index
+        if base_history.participants_opt is not None and new_history.participants_opt is not None:
+            participants_opt = ParticipantIndex.merge([base_history.participants_opt, new_history.participants_opt])
+        history = ChatHistory(
+            # Records of the base export are copied without decoding if both histories are in the binary format
+            messages=ChainedSequence([base_history.messages, new_history.messages]),
+            title_opt=new_history.title_opt,  # Title and photo could have changed since the previous export
+            photo_opt=new_history.photo_opt,
+            participants_opt=participants_opt,
+        )
+        self.storage.save_history(history, export_path, overwrite=(export_path == base_export_path))
+        if checkpoint_opt is not None:
+            checkpoint_opt.remove()
+
+    def update_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                           base_export_path: Path, export_path: Path,
+                           checkpoint_opt: None | IExportCheckpoint = None) -> None:
+        last_raw_message_opt = self.storage.load_last_raw_message_opt(base_export_path)
+        after_cmid = 0 if last_raw_message_opt is None else last_raw_message_opt["conversation_message_id"]
+        new_history = self.vk_service.get_raw_history(
+            peer_id, max_messages, disable_progress_bar, checkpoint_opt, after_cmid)
+        raw_history = ChatRawHistory(
+            raw_messages=itertools.chain(self.storage.load_raw_history(base_export_path).raw_messages,
+                                         new_history.raw_messages),
+            title_opt=new_history.title_opt,
+            photo_url_opt=new_history.photo_url_opt,
+            photo_size_opt=new_history.photo_size_opt,
+        )
+        self.storage.save_raw_history(raw_history, export_path, overwrite=(export_path == base_export_path))
+        if checkpoint_opt is not None:
+            checkpoint_opt.remove()
 
     def export_history_from_raw_input(self, raw_input_path: Path, export_path: Path) -> None:
-        raw_history = self.storage.load_raw_history(raw_input_path)
-        history = self._parse_raw_history(raw_history)
+        if self.parse_cache_opt is None:
+            history = self._parse_raw_history(self.storage.load_raw_history(raw_input_path))
+        else:
+            key = self.parse_cache_opt.get_key(raw_input_path)
+            history_opt = self.parse_cache_opt.load(key)
+            if history_opt is None:
+                history_opt = self.parse_cache_opt.save(
+                    key, self._parse_raw_history(self.storage.load_raw_history(raw_input_path)))
+            history = history_opt
         self.storage.save_history(history, export_path)
 
-    @staticmethod
-    def _parse_raw_history(raw_history: ChatRawHistory) -> ChatHistory:
+    def _parse_raw_history(self, raw_history: ChatRawHistory) -> ChatHistory:
         photo_opt: None | Photo = None
         if raw_history.photo_url_opt is not None:
             assert raw_history.photo_size_opt is not None
             photo_opt = Photo(url=raw_history.photo_url_opt,
                               width=raw_history.photo_size_opt, height=raw_history.photo_size_opt)
+        messages, participants = self._parse_raw_messages(raw_history.raw_messages)
         return ChatHistory(
-            messages=list(map(Message.parse, raw_history.raw_messages)),
+            messages=messages,
             title_opt=raw_history.title_opt,
             photo_opt=photo_opt,
+            participants_opt=participants,
         )
+
+    def _parse_raw_messages(self, raw_messages: Iterable[dict[str, Any]]
+                            ) -> tuple[Sequence[Message], ParticipantIndex]:
+        """
+        Large histories are parsed by several processes. Messages keep their order.
+        Processes return messages encoded: building objects here would take as long as parsing. They are decoded
+        lazily, and the binary history format saves them without decoding at all.
+        So processes collect participants of their messages too
+        """
+        raw_messages = iter(raw_messages)
+        first_raw_messages = list(itertools.islice(raw_messages, self._MIN_PARALLEL_PARSE_MESSAGES))
+        if self.parse_workers == 1 or len(first_raw_messages) < self._MIN_PARALLEL_PARSE_MESSAGES:
+            parsed_messages = MessageParser().parse_all(itertools.chain(first_raw_messages, raw_messages))
+            return parsed_messages, ParticipantIndex.collect(parsed_messages)
+        chunk_participants: list[ParticipantIndex] = []
+
+        def iter_chunks() -> Iterator[list[dict[str, Any]]]:
+            all_raw_messages = itertools.chain(first_raw_messages, raw_messages)
+            while chunk := list(itertools.islice(all_raw_messages, self._PARSE_CHUNK_SIZE)):
+                yield chunk
+
+        def take_result(future: Future[tuple[bytes, "array[int]", ParticipantIndex]]) -> tuple[bytes, "array[int]"]:
+            data, offsets, participants = future.result()
+            chunk_participants.append(participants)
+            return data, offsets
+
+        def iter_parsed_chunks() -> Iterator[tuple[bytes, "array[int]"]]:
+            # Raw messages may be loaded by threads right now, and forking a process with running threads is unsafe
+            with ProcessPoolExecutor(self.parse_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                pending: deque[Future[tuple[bytes, array[int], ParticipantIndex]]] = deque()
+                for chunk in iter_chunks():
+                    pending.append(executor.submit(_parse_messages, chunk))
+                    if len(pending) == 2 * self.parse_workers:  # Do not read raw messages too far ahead
+                        yield take_result(pending.popleft())
+                while pending:
+                    yield take_result(pending.popleft())
+
+        messages = _HISTORY_FORMAT.join_messages(iter_parsed_chunks())
+        return messages, ParticipantIndex.merge(chunk_participants)
+
+
+_HISTORY_FORMAT = HistoryFileFormat.for_module(vk_exporter.types)
+
+
+def _parse_messages(raw_messages: list[dict[str, Any]]) -> tuple[bytes, "array[int]", ParticipantIndex]:
+    """Runs in a parsing process"""
+    messages = MessageParser().parse_all(raw_messages)
+    data, offsets = _HISTORY_FORMAT.encode_messages(messages)
+    return data, offsets, ParticipantIndex.collect(messages)
@@ -0,0 +1,307 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+import vk_exporter.types as vk
+from common.atomic_file import write_aside
+from common.history_file import HistoryDecoder, HistoryEncoder, HistoryFileFormat
+from common.json_codec import IJsonCodec, get_json_codec
+from common.sqlite_history import SqliteSequence, connect, iter_chunks, read_info, write_info
+from vk_exporter.storage import IVkHistoryStorage
+
+_SCHEMA = """
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY,
+    position INTEGER UNIQUE,  -- Index of the message in the history. NULL for replies and forwarded messages
+    root_id INTEGER NOT NULL,  -- The message of the history this one belongs to (itself, if it is not nested)
+    conversation_message_id INTEGER NOT NULL,
+    from_id INTEGER NOT NULL,
+    date INTEGER NOT NULL,  -- Unix time
+    text TEXT NOT NULL,
+    is_expired INTEGER NOT NULL,
+    action BLOB
+);
+CREATE INDEX messages_root_id ON messages (root_id);
+CREATE INDEX messages_conversation_message_id ON messages (conversation_message_id);
+CREATE INDEX messages_date ON messages (date);
+CREATE INDEX messages_from_id ON messages (from_id);
+
+CREATE TABLE links (
+    parent_id INTEGER NOT NULL,
+    child_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,  -- 'reply' or 'fwd'
+    position INTEGER NOT NULL,
+    PRIMARY KEY (parent_id, kind, position)
+);
+
+CREATE TABLE attachments (
+    message_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    type TEXT NOT NULL,  -- Name of the class: 'Photo', 'Video', ...
+    data BLOB NOT NULL,
+    PRIMARY KEY (message_id, position)
+);
+CREATE INDEX attachments_type ON attachments (type);
+"""
+
+_RAW_SCHEMA = """
+CREATE TABLE raw_messages (
+    id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL  -- json
+);
+"""
+
+_MESSAGE_COLUMNS = "id, conversation_message_id, from_id, date, text, is_expired, action"
+
+
+class SqliteVkHistoryStorage(IVkHistoryStorage):
+    """
+    Stores histories in SQLite databases, so they can be queried by sender, date or attachment type
+    without loading everything (see 'iter_messages'). Replies and forwarded messages are rows of the same table,
+    linked with their parents. Attachments and actions are encoded as in common/history_file.py.
+    Loaded messages are read from the database in chunks while they are being iterated over.
+    Raw history is stored as json messages
+    """
+    _FORMAT_VERSION = 2  # Version 1 stored attachments and actions with marshal
+    _HISTORY_FORMAT = HistoryFileFormat.for_module(vk)
+    _CHUNK_SIZE = 500  # Messages are written and read in chunks of this size
+
+    def __init__(self, json_codec_opt: Optional[IJsonCodec] = None) -> None:
+        self.json_codec = json_codec_opt or get_json_codec()
+
+    def save_raw_history(self, raw_history: vk.ChatRawHistory, path: Path, overwrite: bool = False) -> None:
+        info = {
+            "version": self._FORMAT_VERSION,
+            "kind": "raw_history",
+            "title_opt": raw_history.title_opt,
+            "photo_url_opt": raw_history.photo_url_opt,
+            "photo_size_opt": raw_history.photo_size_opt,
+        }
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.executescript(_RAW_SCHEMA)
+            for chunk in iter_chunks(raw_history.raw_messages, self._CHUNK_SIZE):
+                connection.executemany("INSERT INTO raw_messages (data) VALUES (?)",
+                                       [(self.json_codec.dumps(message).decode("utf-8"),) for message in chunk])
+            write_info(connection, info)
+
+        self._write_database(path, overwrite, write)
+
+    def load_raw_history(self, path: Path) -> vk.ChatRawHistory:
+        with closing(connect(path, read_only=True)) as connection:
+            info = self._read_info(connection, path, "raw_history")
+        return vk.ChatRawHistory(
+            raw_messages=self._iter_raw_messages(path),
+            title_opt=info["title_opt"],
+            photo_url_opt=info["photo_url_opt"],
+            photo_size_opt=info["photo_size_opt"],
+        )
+
+    def load_last_raw_message_opt(self, path: Path) -> Optional[dict[str, Any]]:
+        with closing(connect(path, read_only=True)) as connection:
+            self._read_info(connection, path, "raw_history")
+            row_opt = connection.execute("SELECT data FROM raw_messages ORDER BY id DESC LIMIT 1").fetchone()
+        return None if row_opt is None else self.json_codec.loads(row_opt[0])
+
+    def save_history(self, history: vk.ChatHistory, path: Path, overwrite: bool = False) -> None:
+        def write(connection: sqlite3.Connection) -> None:
+            connection.executescript(_SCHEMA)
+            writer = _HistoryWriter(connection, self._HISTORY_FORMAT.make_encoder())
+            for chunk in iter_chunks(history.messages, self._CHUNK_SIZE):
+                writer.write_messages(chunk)
+            write_info(connection, {
+                "version": self._FORMAT_VERSION,
+                "kind": "history",
+                "title_opt": history.title_opt,
+                "photo_opt": writer.encoder.dumps(history.photo_opt),
+                "schema": json.dumps(writer.encoder.schema),
+            })
+
+        self._write_database(path, overwrite, write)
+
+    def load_history(self, path: Path) -> vk.ChatHistory:
+        """Messages keep the database open: close them when they are not needed anymore (see SqliteSequence)"""
+        connection = connect(path, read_only=True)
+        try:
+            info = self._read_info(connection, path, "history")
+            decoder = self._HISTORY_FORMAT.make_decoder(json.loads(info["schema"]))
+            return vk.ChatHistory(
+                messages=SqliteMessages(connection, decoder, self._CHUNK_SIZE),
+                title_opt=info["title_opt"],
+                photo_opt=decoder.loads(info["photo_opt"]),
+            )
+        except Exception:
+            connection.close()
+            raise
+
+    def iter_messages(self, path: Path, from_id_opt: Optional[int] = None, date_from_opt: Optional[datetime] = None,
+                      date_to_opt: Optional[datetime] = None,
+                      attachment_type_opt: Optional[type] = None) -> Iterator[vk.Message]:
+        """
+        Messages of the history (not nested ones) sent by from_id within [date_from, date_to)
+        and having an attachment of the given type (e.g. vk.Photo)
+        """
+        conditions: list[str] = ["position IS NOT NULL"]
+        params: list[Any] = []
+        if from_id_opt is not None:
+            conditions.append("from_id = ?")
+            params.append(from_id_opt)
+        if date_from_opt is not None:
+            conditions.append("date >= ?")
+            params.append(int(date_from_opt.timestamp()))
+        if date_to_opt is not None:
+            conditions.append("date < ?")
+            params.append(int(date_to_opt.timestamp()))
+        if attachment_type_opt is not None:
+            conditions.append("EXISTS (SELECT 1 FROM attachments WHERE message_id = messages.id AND type = ?)")
+            params.append(attachment_type_opt.__name__)
+        with closing(connect(path, read_only=True)) as connection:
+            info = self._read_info(connection, path, "history")
+            decoder = self._HISTORY_FORMAT.make_decoder(json.loads(info["schema"]))
+            messages = SqliteMessages(connection, decoder, self._CHUNK_SIZE)
+            yield from messages.query(" AND ".join(conditions), params)
+
+    def load_participants(self, path: Path) -> vk.ParticipantIndex:
+        """Only from_id column and actions are read"""
+        with closing(connect(path, read_only=True)) as connection:
+            info = self._read_info(connection, path, "history")
+            decoder = self._HISTORY_FORMAT.make_decoder(json.loads(info["schema"]))
+            message_counts: dict[int, int] = dict(connection.execute(
+                "SELECT from_id, COUNT(*) FROM messages WHERE position IS NOT NULL GROUP BY from_id"))
+            referenced_ids = {from_id for [from_id] in connection.execute(
+                "SELECT DISTINCT from_id FROM messages WHERE position IS NULL")}
+            for [data] in connection.execute("SELECT action FROM messages WHERE action IS NOT NULL"):
+                action = decoder.loads(data)
+                if isinstance(action, vk.InviteUserAction):
+                    referenced_ids.add(action.invited_user_id)
+                elif isinstance(action, vk.KickUserAction):
+                    referenced_ids.add(action.kicked_user_id)
+        return vk.ParticipantIndex(message_counts, referenced_ids)
+
+    def _read_info(self, connection: sqlite3.Connection, path: Path, kind: str) -> dict[str, Any]:
+        info = read_info(connection)
+        if info["version"] != self._FORMAT_VERSION:
+            raise ValueError(f"Unsupported history database version: {info['version']}")
+        if info["kind"] != kind:
+            raise ValueError(f"Database {path} contains {info['kind']}, not {kind}")
+        return info
+
+    def _iter_raw_messages(self, path: Path) -> Iterator[dict[str, Any]]:
+        """The database is open while the messages are iterated over"""
+        loads = self.json_codec.loads
+        with closing(connect(path, read_only=True)) as connection:
+            for [data] in connection.execute("SELECT data FROM raw_messages ORDER BY id"):
+                yield loads(data)
+
+    @staticmethod
+    def _write_database(path: Path, overwrite: bool, write: Callable[[sqlite3.Connection], None]) -> None:
+        if path.exists() and not overwrite:
+            raise FileExistsError(path)
+        # The history may be read lazily from the database being replaced. Do not leave a broken file if it fails
+        with write_aside(path) as tmp_path, closing(connect(tmp_path)) as connection:
+            with connection:  # One transaction: much faster than committing every insert
+                write(connection)
+
+
+class _HistoryWriter:
+    def __init__(self, connection: sqlite3.Connection, encoder: HistoryEncoder) -> None:
+        self.connection = connection
+        self.encoder = encoder
+        self.next_id = 1
+        self.next_position = 0
+
+    def write_messages(self, messages: Iterable[vk.Message]) -> None:
+        message_rows: list[tuple[Any, ...]] = []
+        link_rows: list[tuple[Any, ...]] = []
+        attachment_rows: list[tuple[Any, ...]] = []
+
+        def add(msg: vk.Message, root_id_opt: Optional[int]) -> int:
+            message_id = self.next_id
+            self.next_id += 1
+            root_id = message_id if root_id_opt is None else root_id_opt
+            position_opt = None
+            if root_id_opt is None:
+                position_opt = self.next_position
+                self.next_position += 1
+            message_rows.append((
+                message_id, position_opt, root_id, msg.conversation_message_id, msg.from_id,
+                int(msg.date.timestamp()), msg.text, msg.is_expired,
+                None if msg.action is None else self.encoder.dumps(msg.action),
+            ))
+            attachment_rows.extend((message_id, i, type(attachment).__name__, self.encoder.dumps(attachment))
+                                   for i, attachment in enumerate(msg.attachments))
+            if msg.reply_message is not None:
+                link_rows.append((message_id, add(msg.reply_message, root_id), "reply", 0))
+            link_rows.extend((message_id, add(fwd, root_id), "fwd", i) for i, fwd in enumerate(msg.fwd_messages))
+            return message_id
+
+        for message in messages:
+            add(message, None)
+        self.connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", message_rows)
+        self.connection.executemany("INSERT INTO links VALUES (?, ?, ?, ?)", link_rows)
+        self.connection.executemany("INSERT INTO attachments VALUES (?, ?, ?, ?)", attachment_rows)
+
+
+class SqliteMessages(SqliteSequence[vk.Message]):
+    """Messages of the history stored in a database. They are read every time they are accessed"""
+
+    def __init__(self, connection: sqlite3.Connection, decoder: HistoryDecoder, chunk_size: int) -> None:
+        super().__init__(connection, chunk_size)
+        self._decoder = decoder
+        self._length: int = connection.execute("SELECT count(*) FROM messages WHERE position IS NOT NULL").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[vk.Message]:
+        return self.query("position IS NOT NULL", [])
+
+    def query(self, condition: str, params: list[Any]) -> Iterator[vk.Message]:
+        """Messages whose rows match the condition, in the order of the history"""
+        cursor = self._connection.execute(f"SELECT id FROM messages WHERE {condition} ORDER BY position", params)
+        while root_ids := [root_id for [root_id] in cursor.fetchmany(self._chunk_size)]:
+            yield from self._load_roots(root_ids)
+
+    def _load(self, index: int) -> vk.Message:
+        row = self._connection.execute("SELECT id FROM messages WHERE position = ?", (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        [message] = self._load_roots(row)
+        return message
+
+    def _load_roots(self, root_ids: Sequence[int]) -> list[vk.Message]:
+        """Loads messages of the history with all nested ones in three queries"""
+        placeholders = ",".join("?" * len(root_ids))
+        rows = {row[0]: row for row in self._connection.execute(
+            f"SELECT {_MESSAGE_COLUMNS} FROM messages WHERE root_id IN ({placeholders})", root_ids)}
+        attachments: dict[int, list[vk.Attachment]] = {}
+        for message_id, data in self._connection.execute(
+                f"SELECT message_id, data FROM attachments WHERE message_id IN "
+                f"(SELECT id FROM messages WHERE root_id IN ({placeholders})) ORDER BY message_id, position", root_ids):
+            attachments.setdefault(message_id, []).append(self._decoder.loads(data))
+        links: dict[int, list[tuple[str, int]]] = {}
+        for parent_id, child_id, kind in self._connection.execute(
+                f"SELECT parent_id, child_id, kind FROM links WHERE parent_id IN "
+                f"(SELECT id FROM messages WHERE root_id IN ({placeholders})) ORDER BY parent_id, position", root_ids):
+            links.setdefault(parent_id, []).append((kind, child_id))
+
+        def build(message_id: int) -> vk.Message:
+            _, conversation_message_id, from_id, date, text, is_expired, action = rows[message_id]
+            children = links.get(message_id, [])
+            replies = [build(child_id) for kind, child_id in children if kind == "reply"]
+            return vk.Message(
+                conversation_message_id=conversation_message_id,
+                from_id=from_id,
+                date=datetime.fromtimestamp(date, timezone.utc),
+                text=text,
+                is_expired=bool(is_expired),
+                attachments=tuple(attachments.get(message_id, ())),
+                reply_message=replies[0] if replies else None,
+                fwd_messages=tuple(build(child_id) for kind, child_id in children if kind == "fwd"),
+                action=None if action is None else self._decoder.loads(action),
+            )
+
+        return [build(root_id) for root_id in root_ids]
@@ -1,53 +1,233 @@
 import abc
+import collections
+import gzip
+import io
+import os
 import pickle
-import json
 from pathlib import Path
+from typing import IO, Any, Iterator, Optional, cast
 
-from vk_exporter.types import ChatHistory, ChatRawHistory
+import vk_exporter.types
+from common.atomic_file import write_aside
+from common.history_file import HistoryFileFormat
+from common.json_codec import IJsonCodec, get_json_codec
+from common.sqlite_history import is_sqlite_path
+from vk_exporter.types import ChatHistory, ChatRawHistory, ParticipantIndex
 
 
 class IVkHistoryStorage(abc.ABC):
     @abc.abstractmethod
-    def save_raw_history(self, raw_history: ChatRawHistory, path: Path) -> None: ...
+    def save_raw_history(self, raw_history: ChatRawHistory, path: Path, overwrite: bool = False) -> None: ...
 
     @abc.abstractmethod
     def load_raw_history(self, path: Path) -> ChatRawHistory: ...
 
     @abc.abstractmethod
-    def save_history(self, history: ChatHistory, path: Path) -> None: ...
+    def load_last_raw_message_opt(self, path: Path) -> Optional[dict[str, Any]]:
+        """Does not read other messages of the raw history if it can. None if the history is empty"""
+
+    @abc.abstractmethod
+    def save_history(self, history: ChatHistory, path: Path, overwrite: bool = False) -> None: ...
 
     @abc.abstractmethod
     def load_history(self, path: Path) -> ChatHistory: ...
 
+    @abc.abstractmethod
+    def load_participants(self, path: Path) -> ParticipantIndex:
+        """Does not load messages of the history if it can"""
+
 
 class VkHistoryStorage(IVkHistoryStorage):
-    def save_raw_history(self, raw_history: ChatRawHistory, path: Path) -> None:
-        with path.open("x") as f:
-            dct = {
-                "raw_messages": raw_history.raw_messages,
+    """
+    Raw history is stored in json-lines format: the first line is a header with chat info,
+    every next line is a message. Messages are written and read one by one, so the history is never held in memory.
+    Files with '.gz' or '.zst' suffix are compressed (the latter requires 'zstandard' package).
+    Json is converted by the fastest installed codec (see get_json_codec) unless another one is passed.
+    Parsed history is stored in the binary format (see common/history_file.py), messages are loaded lazily.
+    Files with '.sqlite' or '.db' suffix are SQLite databases (see SqliteVkHistoryStorage).
+    Participant index of the history is saved to '<file>.participants' json file. It remembers the fingerprint
+    of the history (see HistoryFileFormat.get_fingerprint), so the index of a history replaced by something else
+    is not used, while touching the history (e.g. by the parse cache) keeps it.
+    With 'overwrite' the history may be read lazily from the file being replaced: the new one is written aside
+    """
+    _RAW_FORMAT_VERSION = 1
+    _PARTICIPANTS_FORMAT_VERSION = 2  # Version 1 remembered modification time of the history, which touching changes
+    _HISTORY_FORMAT = HistoryFileFormat.for_module(vk_exporter.types)
+    _TAIL_READ_SIZE = 1 << 16  # The last raw message is looked for in blocks of this size from the end of the file
+
+    def __init__(self, json_codec_opt: Optional[IJsonCodec] = None) -> None:
+        self.json_codec = json_codec_opt or get_json_codec()
+
+    def save_raw_history(self, raw_history: ChatRawHistory, path: Path, overwrite: bool = False) -> None:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().save_raw_history(raw_history, path, overwrite)
+        if path.exists() and not overwrite:
+            raise FileExistsError(path)
+        # Messages can be loaded from the network while we are writing. Do not leave a broken file if it fails
+        dumps = self.json_codec.dumps
+        with write_aside(path) as tmp_path, self._open(tmp_path, "w") as f:
+            header = {
+                "version": self._RAW_FORMAT_VERSION,
                 "title_opt": raw_history.title_opt,
                 "photo_url_opt": raw_history.photo_url_opt,
                 "photo_size_opt": raw_history.photo_size_opt,
             }
-            json.dump(dct, f, ensure_ascii=False, indent=2)
+            f.write(dumps(header) + b"\n")
+            for message in raw_history.raw_messages:
+                f.write(dumps(message) + b"\n")
 
     def load_raw_history(self, path: Path) -> ChatRawHistory:
-        with path.open() as f:
-            dct = json.load(f)
-        assert isinstance(dct, dict), type(dct)
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().load_raw_history(path)
+        with self._open(path, "r") as f:
+            first_line = f.readline()
+        try:
+            header = self.json_codec.loads(first_line)
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or "raw_messages" in header:
+            return self._load_legacy_raw_history(path)
+        if header["version"] != self._RAW_FORMAT_VERSION:
+            raise ValueError(f"Unsupported raw history version: {header['version']}")
         return ChatRawHistory(
-            raw_messages=dct["raw_messages"],
-            title_opt=dct["title_opt"],
-            photo_url_opt=dct["photo_url_opt"],
-            photo_size_opt=dct["photo_size_opt"],
+            raw_messages=self._iter_raw_messages(path),
+            title_opt=header["title_opt"],
+            photo_url_opt=header["photo_url_opt"],
+            photo_size_opt=header["photo_size_opt"],
         )
 
-    def save_history(self, history: ChatHistory, path: Path) -> None:
-        with path.open("xb") as f:
-            pickle.dump(history, f)
+    def load_last_raw_message_opt(self, path: Path) -> Optional[dict[str, Any]]:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().load_last_raw_message_opt(path)
+        raw_messages = self.load_raw_history(path).raw_messages  # Checks the header. Messages are not read yet
+        if isinstance(raw_messages, list):  # Legacy raw history
+            return raw_messages[-1] if raw_messages else None
+        last_line_opt = self._read_last_message_line_opt(path)
+        return None if last_line_opt is None else self.json_codec.loads(last_line_opt)
+
+    def save_history(self, history: ChatHistory, path: Path, overwrite: bool = False) -> None:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().save_history(history, path, overwrite)
+        if path.exists() and not overwrite:
+            raise FileExistsError(path)
+        # Collected before writing: messages may be read from the file being replaced
+        participants = history.participants_opt or ParticipantIndex.collect(history.messages)
+        # A failed write must not leave a truncated history: batch export skips chats whose files exist
+        with write_aside(path) as tmp_path, tmp_path.open("wb") as f:
+            self._write_history(f, history)
+        self._save_participants(participants, path)
 
     def load_history(self, path: Path) -> ChatHistory:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().load_history(path)
+        if not HistoryFileFormat.is_history_file(path):
+            return self._load_legacy_history(path)
+        chat_info, messages = self._HISTORY_FORMAT.read(path)
+        return ChatHistory(messages=messages, participants_opt=self._load_participants_opt(path), **chat_info)
+
+    def load_participants(self, path: Path) -> ParticipantIndex:
+        if is_sqlite_path(path):
+            return self._get_sqlite_storage().load_participants(path)
+        participants_opt = self._load_participants_opt(path)
+        if participants_opt is None:  # Histories saved before the index was introduced
+            return ParticipantIndex.collect(self.load_history(path).messages)
+        return participants_opt
+
+    def _write_history(self, f: IO[bytes], history: ChatHistory) -> None:
+        chat_info = {"title_opt": history.title_opt, "photo_opt": history.photo_opt}
+        self._HISTORY_FORMAT.write(f, chat_info, history.messages)
+
+    @staticmethod
+    def _load_legacy_history(path: Path) -> ChatHistory:
+        """Pickled ChatHistory. It was used before the binary format"""
         with path.open("rb") as f:
             history = pickle.load(f)
         assert isinstance(history, ChatHistory)
         return history
+
+    def _iter_raw_messages(self, path: Path) -> Iterator[dict[str, Any]]:
+        loads = self.json_codec.loads
+        with self._open(path, "r") as f:
+            f.readline()  # Skip the header
+            for line in f:
+                yield loads(line)
+
+    def _read_last_message_line_opt(self, path: Path) -> Optional[bytes]:
+        """Uncompressed files are read from the end. None if there is only the header"""
+        if path.suffix in (".gz", ".zst"):
+            with self._open(path, "r") as f:
+                f.readline()  # Skip the header
+                last_lines = collections.deque(f, maxlen=1)
+            return last_lines.pop() if last_lines else None
+        with path.open("rb") as f:
+            position = f.seek(0, os.SEEK_END)
+            tail = b""
+            while position > 0 and tail.count(b"\n") < 2:  # Every line ends with a line break
+                step = min(position, self._TAIL_READ_SIZE)
+                position -= step
+                f.seek(position)
+                tail = f.read(step) + tail
+        lines = tail.split(b"\n")
+        if position == 0 and len(lines) <= 2:
+            return None
+        return lines[-2]
+
+    def _load_legacy_raw_history(self, path: Path) -> ChatRawHistory:
+        """Single json object. It was used before json-lines format"""
+        with self._open(path, "r") as f:
+            dct = self.json_codec.loads(f.read())
+        assert isinstance(dct, dict), type(dct)
+        return ChatRawHistory(
+            raw_messages=dct["raw_messages"],
+            title_opt=dct["title_opt"],
+            photo_url_opt=dct["photo_url_opt"],
+            photo_size_opt=dct["photo_size_opt"],
+        )
+
+    def _save_participants(self, participants: ParticipantIndex, history_path: Path) -> None:
+        data = {
+            "version": self._PARTICIPANTS_FORMAT_VERSION,
+            "history_fingerprint": HistoryFileFormat.get_fingerprint(history_path),
+            "message_counts": sorted(participants.message_counts.items()),
+            "referenced_ids": sorted(participants.referenced_ids),
+        }
+        path = self._get_participants_path(history_path)
+        with write_aside(path) as tmp_path:
+            tmp_path.write_bytes(self.json_codec.dumps(data))
+
+    def _load_participants_opt(self, history_path: Path) -> Optional[ParticipantIndex]:
+        """None if there is no index, or it belongs to another version of the history"""
+        try:
+            data = self.json_codec.loads(self._get_participants_path(history_path).read_bytes())
+            if not isinstance(data, dict) or data.get("version") != self._PARTICIPANTS_FORMAT_VERSION \
+                    or data["history_fingerprint"] != HistoryFileFormat.get_fingerprint(history_path):
+                return None
+        except (FileNotFoundError, ValueError):
+            return None
+        return ParticipantIndex(
+            message_counts={from_id: count for from_id, count in data["message_counts"]},
+            referenced_ids=set(data["referenced_ids"]),
+        )
+
+    @staticmethod
+    def _get_participants_path(history_path: Path) -> Path:
+        return history_path.with_name(history_path.name + ".participants")
+
+    def _get_sqlite_storage(self) -> IVkHistoryStorage:
+        from vk_exporter.sqlite_storage import SqliteVkHistoryStorage  # It depends on this module
+        return SqliteVkHistoryStorage(self.json_codec)
+
+    @staticmethod
+    def _open(path: Path, mode: str) -> IO[bytes]:
+        """Raw history files are utf-8 json, they are read and written as bytes"""
+        assert mode in ("r", "w")
+        if path.suffix == ".gz":
+            return cast(IO[bytes], gzip.open(path, mode + "b"))
+        if path.suffix == ".zst":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("Install 'zstandard' package to read and write .zst files") from None
+            f = zstandard.open(path, mode + "b")
+            return cast(IO[bytes], io.BufferedReader(f) if mode == "r" else f)  # Its reader can't read lines
+        return path.open(mode + "b")
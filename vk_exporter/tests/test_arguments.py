@@ -1,4 +1,5 @@
 import argparse
+from datetime import datetime, timezone
 from pathlib import Path
 
 from config import Config
@@ -39,3 +40,43 @@ def test_chat_id_with_link():
 
     args = get_arguments("--chat http://vkontakte.ru/im?sel=c100")
     assert args.chat_id == 2_000_000_100
+
+
+def test_since_export(tmp_path):
+    base_file = tmp_path / "vk_history.pickle"
+    base_file.touch()
+    args = get_arguments(f"--chat 123 --since-export {base_file}")
+    assert args.since_export_file == base_file
+    assert args.export_file == base_file  # Updated in place
+
+    args = get_arguments(f"--chat 123 --since-export {base_file} --export-file {tmp_path / 'new.pickle'}")
+    assert args.export_file == tmp_path / "new.pickle"
+    assert args.after_cmid == 0
+
+
+def test_date_range():
+    args = get_arguments("--chat 123 --from 2021-01-01 --to 2022-01-01T03:00+03:00")
+    assert args.date_from_opt == datetime(2021, 1, 1, tzinfo=timezone.utc)
+    assert args.date_to_opt == datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+
+def test_several_chats(tmp_path):
+    chats_file = tmp_path / "chats.txt"
+    chats_file.write_text("# Customer chats\n2000000005\n\nhttps://vk.com/im?sel=c6\n")
+    args = get_arguments(f"--chats 1 vk.com/im?sel=2 --chats-file {chats_file}")
+    assert args.chat_id is None
+    assert args.chat_ids == [1, 2, 2_000_000_005, 2_000_000_006]
+    assert args.export_dir == Path("vk_exports")
+
+
+def test_parse_workers():
+    assert get_arguments("--chat 123").parse_workers == Config().vk.max_parse_workers
+    assert get_arguments("--raw-input --parse-workers 3").parse_workers == 3
+
+
+def test_parse_cache_dir(tmp_path):
+    raw_file = tmp_path / "raw.json"
+    assert get_arguments(f"--raw-input {raw_file}").parse_cache_dir_opt == tmp_path / ".vk_parse_cache"
+    assert get_arguments(f"--raw-input {raw_file} --parse-cache-dir cache").parse_cache_dir_opt == Path("cache")
+    assert get_arguments(f"--raw-input {raw_file} --no-parse-cache").parse_cache_dir_opt is None
+    assert get_arguments("--chat 123").parse_cache_dir_opt is None
@@ -0,0 +1,38 @@
+from vk_exporter.checkpoint import CheckpointHeader, ExportCheckpoint
+
+
+def make_header(total_messages: int = 5) -> CheckpointHeader:
+    return CheckpointHeader(peer_id=1, last_message_id=100, total_messages=total_messages,
+                            title_opt="Title", photo_url_opt=None, photo_size_opt=None)
+
+
+def test_load_missing(tmp_path):
+    assert ExportCheckpoint(tmp_path / "checkpoint").load_header() is None
+
+
+def test_save_and_load(tmp_path):
+    checkpoint = ExportCheckpoint(tmp_path / "checkpoint")
+    checkpoint.start(make_header())
+    checkpoint.append_batch(3, [{"id": 1}, {"id": 2}])
+    checkpoint.append_batch(0, [{"id": 3}])
+
+    assert checkpoint.load_header() == make_header()
+    assert list(checkpoint.iter_batches()) == [(3, [{"id": 1}, {"id": 2}]), (0, [{"id": 3}])]
+
+    checkpoint.remove()
+    assert checkpoint.load_header() is None
+
+
+def test_broken_tail_is_dropped(tmp_path):
+    checkpoint = ExportCheckpoint(tmp_path / "checkpoint")
+    checkpoint.start(make_header())
+    checkpoint.append_batch(1, [{"id": 1}])
+    with checkpoint.path.open("a") as f:
+        f.write('{"offset": 0, "messa')  # The process was killed while writing
+
+    assert checkpoint.load_header() == make_header()
+    assert list(checkpoint.iter_batches()) == [(1, [{"id": 1}])]
+
+    checkpoint.append_batch(0, [{"id": 2}])
+    assert checkpoint.load_header() == make_header()
+    assert list(checkpoint.iter_batches()) == [(1, [{"id": 1}]), (0, [{"id": 2}])]
@@ -0,0 +1,121 @@
+import os
+
+from vk_exporter.parse_cache import ParsedHistoryCache
+from vk_exporter.parser import MessageParser
+from vk_exporter.service import VkExporterService
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import FakeVkApi, make_raw_message
+from vk_exporter.types import ChatHistory, ChatRawHistory, Message, ParticipantIndex
+from vk_exporter.vk_service import VkService
+
+
+class CountingService(VkExporterService):
+    def __init__(self, cache: ParsedHistoryCache) -> None:
+        super().__init__(VkService(FakeVkApi().get_api()), VkHistoryStorage(), parse_cache_opt=cache)
+        self.parse_calls = 0
+
+    def _parse_raw_history(self, raw_history: ChatRawHistory) -> ChatHistory:
+        self.parse_calls += 1
+        return super()._parse_raw_history(raw_history)
+
+
+def save_raw_history(path, messages_count):
+    raw_messages = [make_raw_message(i) for i in range(1, messages_count + 1)]
+    VkHistoryStorage().save_raw_history(ChatRawHistory(raw_messages, "Чат", None, None), path, overwrite=True)
+    return raw_messages
+
+
+def test_unchanged_raw_file_is_parsed_once(tmp_path):
+    raw_path, cache_dir = tmp_path / "raw.json", tmp_path / "cache"
+    raw_messages = save_raw_history(raw_path, 20)
+    service = CountingService(ParsedHistoryCache(VkHistoryStorage(), cache_dir, 2 ** 20))
+    for i in range(3):
+        service.export_history_from_raw_input(raw_path, tmp_path / f"{i}.pickle")
+        history = VkHistoryStorage().load_history(tmp_path / f"{i}.pickle")
+        assert list(history.messages) == list(map(Message.parse, raw_messages))
+        assert history.title_opt == "Чат"
+    assert service.parse_calls == 1
+    assert len(list(cache_dir.glob("*.history"))) == 1
+
+    raw_messages = save_raw_history(raw_path, 21)
+    service.export_history_from_raw_input(raw_path, tmp_path / "changed.pickle")
+    assert service.parse_calls == 2
+    assert list(VkHistoryStorage().load_history(tmp_path / "changed.pickle").messages) == \
+        list(map(Message.parse, raw_messages))
+
+
+def test_raw_file_is_hashed_once(tmp_path, monkeypatch):
+    raw_path = tmp_path / "raw.json"
+    save_raw_history(raw_path, 20)
+    cache = ParsedHistoryCache(VkHistoryStorage(), tmp_path / "cache", 2 ** 20)
+    key = cache.get_key(raw_path)
+    monkeypatch.setattr(ParsedHistoryCache, "_READ_SIZE", 7)
+    assert cache.get_key(raw_path) == key  # Does not depend on chunks
+
+    hashed_paths = []
+
+    def get_key(self, path):
+        hashed_paths.append(path)
+        return real_get_key(self, path)
+
+    real_get_key = ParsedHistoryCache.get_key
+    monkeypatch.setattr(ParsedHistoryCache, "get_key", get_key)
+    CountingService(cache).export_history_from_raw_input(raw_path, tmp_path / "history.history")
+    assert hashed_paths == [raw_path]
+
+
+def test_cache_hit_keeps_participants(tmp_path, monkeypatch):
+    raw_path = tmp_path / "raw.json"
+    save_raw_history(raw_path, 20)
+    service = CountingService(ParsedHistoryCache(VkHistoryStorage(), tmp_path / "cache", 2 ** 20))
+    service.export_history_from_raw_input(raw_path, tmp_path / "1.history")
+    monkeypatch.setattr(ParticipantIndex, "collect", None)  # Cached messages are not decoded to collect it again
+    for i in range(2, 4):  # Every cache hit touches the cached history
+        service.export_history_from_raw_input(raw_path, tmp_path / f"{i}.history")
+        history = VkHistoryStorage().load_history(tmp_path / f"{i}.history")
+        assert history.participants_opt == ParticipantIndex({1: 20}, set())
+    assert service.parse_calls == 1
+
+
+def test_new_parser_version_invalidates_cache(tmp_path, monkeypatch):
+    raw_path = tmp_path / "raw.json"
+    save_raw_history(raw_path, 5)
+    service = CountingService(ParsedHistoryCache(VkHistoryStorage(), tmp_path / "cache", 2 ** 20))
+    service.export_history_from_raw_input(raw_path, tmp_path / "1.pickle")
+    monkeypatch.setattr(MessageParser, "VERSION", MessageParser.VERSION + 1)
+    service.export_history_from_raw_input(raw_path, tmp_path / "2.pickle")
+    assert service.parse_calls == 2
+
+
+def test_least_recently_used_histories_are_evicted(tmp_path):
+    storage = VkHistoryStorage()
+    raw_paths = [tmp_path / f"raw{i}.json" for i in range(3)]
+    for i, raw_path in enumerate(raw_paths):
+        save_raw_history(raw_path, 10 + i)
+    history = ChatHistory([Message.parse(make_raw_message(i)) for i in range(1, 11)], None, None)
+
+    probe = ParsedHistoryCache(storage, tmp_path / "probe", 2 ** 20)
+    probe.save(probe.get_key(raw_paths[0]), history)
+    entry_size = next((tmp_path / "probe").glob("*.history")).stat().st_size
+    cache = ParsedHistoryCache(storage, tmp_path / "cache", 2 * entry_size)
+    keys = [cache.get_key(raw_path) for raw_path in raw_paths]
+    cache.save(keys[0], history)
+    cache.save(keys[1], history)
+    for path in (tmp_path / "cache").glob("*.history"):
+        os.utime(path, (0, 0))
+    assert cache.load(keys[0]) is not None  # Now the second history is the least recently used one
+
+    cache.save(keys[2], history)
+    assert len(list((tmp_path / "cache").iterdir())) == 4  # Histories and their participant indices
+    assert cache.load(keys[0]) is not None
+    assert cache.load(keys[1]) is None
+    assert cache.load(keys[2]) is not None
+
+
+def test_history_larger_than_cache_is_not_saved(tmp_path):
+    raw_path = tmp_path / "raw.json"
+    raw_messages = save_raw_history(raw_path, 10)
+    cache = ParsedHistoryCache(VkHistoryStorage(), tmp_path / "cache", 10)
+    history = cache.save(cache.get_key(raw_path), ChatHistory(list(map(Message.parse, raw_messages)), None, None))
+    assert len(history.messages) == 10
+    assert cache.load(cache.get_key(raw_path)) is None
@@ -0,0 +1,127 @@
+import random
+from typing import Any
+
+import pytest
+
+import vk_exporter.types
+from common.history_file import HistoryFileFormat
+from vk_exporter.parser import MessageParser
+from vk_exporter.fake_vk_api import make_raw_message
+from vk_exporter.types import Message
+
+
+def make_photo(rng: random.Random) -> dict[str, Any]:
+    sizes = [{"type": size_type, "url": f"https://x/{rng.random()}.jpg", "width": rng.randint(1, 2000),
+              "height": rng.randint(1, 2000)} for size_type in rng.sample("smxopqryzwk", rng.randint(1, 11))]
+    return {"sizes": sizes}
+
+
+def make_attachment(rng: random.Random) -> dict[str, Any]:
+    type_name = rng.choice(["photo", "video", "audio", "audio_message", "doc", "poll", "wall", "sticker", "link",
+                            "gift", "story"])
+    data: dict[str, Any]
+    match type_name:
+        case "photo":
+            data = make_photo(rng)
+        case "video":
+            images = [{"url": f"https://x/{i}.jpg", "width": rng.randint(1, 800), "height": rng.randint(1, 800),
+                       **({"with_padding": 1} if rng.random() < 0.3 else {})} for i in range(rng.randint(1, 4))]
+            data = {"title": rng.choice(["cat", "dog"]), "id": rng.randint(1, 10 ** 6), "owner_id": -5,
+                    "image": images}
+            if rng.random() < 0.2:
+                data["restriction"] = {}
+            else:
+                data.update(width=640, height=480, duration=rng.randint(1, 600))
+            if rng.random() < 0.5:
+                data["access_key"] = "key"
+        case "audio":
+            data = {"id": 1, "owner_id": 2, "artist": "artist", "title": "song", "duration": 200, "url": ""}
+        case "audio_message":
+            data = {"link_ogg": "https://x/1.ogg", "duration": 3}
+            if rng.random() < 0.5:
+                data["transcript"] = "hi"
+        case "doc":
+            data = {"url": "https://x/doc", "title": "file.png", "ext": "png", "type": 4}
+        case "poll":
+            data = {"question": "?", "anonymous": rng.random() < 0.5, "multiple": False, "answers": [
+                {"text": str(i), "votes": i, "rate": 50.0} for i in range(rng.randint(1, 4))]}
+        case "wall":
+            data = {"id": 7, "owner_id": 0, "to_id": -3} if rng.random() < 0.5 else {"id": 7, "owner_id": 8}
+        case "sticker":
+            data = {"images": [{"url": f"https://x/sticker/{size}", "width": size, "height": size}
+                               for size in rng.sample([64, 128, 256, 512], rng.randint(1, 4))]}
+        case "link":
+            data = {"url": "https://example.com", "title": "Example"}
+        case _:
+            data = {"id": 1}
+    return {"type": type_name, type_name: data}
+
+
+def make_action(rng: random.Random) -> dict[str, Any]:
+    return rng.choice([
+        {"type": "chat_create", "text": "chat"},
+        {"type": "chat_title_update", "text": "new title"},
+        {"type": "chat_photo_update"},
+        {"type": "chat_photo_remove"},
+        {"type": "chat_invite_user_by_link"},
+        {"type": "chat_invite_user", "member_id": 5},
+        {"type": "chat_kick_user", "member_id": 6},
+        {"type": "chat_pin_message", "conversation_message_id": 3, "message": "pinned"},
+        {"type": "chat_pin_message", "conversation_message_id": 3},
+        {"type": "chat_unpin_message", "conversation_message_id": 3},
+        {"type": "chat_screenshot"},
+        {"type": "chat_group_call_started"},
+    ])
+
+
+def make_raw_messages(messages_count: int, seed: int) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    raw_messages: list[dict[str, Any]] = []
+
+    def make(cmid: int, depth: int) -> dict[str, Any]:
+        date_step = rng.choice([0, 1, 60])  # Several messages are often sent in the same second
+        raw_message = make_raw_message(cmid, from_id=rng.randint(1, 20), text=rng.choice(["ok", "", "text " * 20]))
+        raw_message["date"] = raw_messages[-1]["date"] + date_step if raw_messages else raw_message["date"]
+        if rng.random() < 0.3:
+            raw_message["attachments"] = [make_attachment(rng) for _ in range(rng.randint(0, 3))]
+        if rng.random() < 0.05:
+            raw_message["geo"] = {"coordinates": {"latitude": 1.5, "longitude": 2.5}, "place": {"title": "Home"}}
+        if rng.random() < 0.05:
+            raw_message["action"] = make_action(rng)
+        if rng.random() < 0.05:
+            raw_message["is_expired"] = True
+        # Nested messages are copies of messages of the chat, or messages without id from other chats
+        if depth < 3 and raw_messages and rng.random() < 0.2:
+            raw_message["reply_message"] = rng.choice(raw_messages)
+        if depth < 3 and raw_messages and rng.random() < 0.1:
+            raw_message["fwd_messages"] = [rng.choice(raw_messages) if rng.random() < 0.5 else make(0, depth + 1)
+                                           for _ in range(rng.randint(1, 3))]
+        return raw_message
+
+    for cmid in range(1, messages_count + 1):
+        raw_messages.append(make(cmid, 0))
+    return raw_messages
+
+
+def encode(messages: list[Message]) -> Any:
+    """Compares classes, time zones and plain classes without __eq__ (some actions) too"""
+    encoder = HistoryFileFormat.for_module(vk_exporter.types).make_encoder()
+    return [encoder.encode(message) for message in messages]
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("lazy_attachments", [False, True])
+def test_same_as_message_parse(seed, lazy_attachments):
+    raw_messages = make_raw_messages(3000, seed)
+    expected = [Message.parse(raw_message) for raw_message in raw_messages]
+    messages = MessageParser(lazy_attachments).parse_all(raw_messages)
+    assert encode(messages) == encode(expected)
+
+
+def test_nested_messages_are_shared():
+    popular = make_raw_message(1, text="popular")
+    raw_messages = [{**make_raw_message(i), "reply_message": popular, "fwd_messages": [make_raw_message(0)]}
+                    for i in range(2, 5)]
+    messages = MessageParser().parse_all(raw_messages)
+    assert messages[0].reply_message is messages[1].reply_message is messages[2].reply_message
+    assert messages[0].fwd_messages[0] is not messages[1].fwd_messages[0]  # Messages without id are not shared
@@ -0,0 +1,108 @@
+import pytest
+
+from vk_exporter.controller import VkExporterController
+from vk_exporter.fake_vk_api import FakeVkApi, make_raw_message
+from vk_exporter.service import VkExporterService
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.tests.test_arguments import get_arguments
+from vk_exporter.types import ChatRawHistory, Message, ParticipantIndex
+from vk_exporter.vk_service import VkService
+
+CHAT_ID = 2_000_000_001
+
+
+def make_service(api: FakeVkApi) -> VkExporterService:
+    return VkExporterService(VkService(api.get_api()), VkHistoryStorage())
+
+
+def test_update_raw_history_in_place(tmp_path):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 300)
+    service = make_service(api)
+    path = tmp_path / "raw.json"
+    service.export_raw_history(CHAT_ID, None, True, path)
+
+    api.chats[CHAT_ID] += [make_raw_message(i) for i in range(301, 351)]
+    api.calls.clear()
+    service.update_raw_history(CHAT_ID, None, True, path, path)
+
+    raw_history = VkHistoryStorage().load_raw_history(path)
+    assert list(raw_history.raw_messages) == [make_raw_message(i) for i in range(1, 351)]
+    assert api.calls["execute"] == 1
+    assert not list(tmp_path.glob("*.part*"))
+
+
+def test_update_history_to_another_file(tmp_path):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 10)
+    service = make_service(api)
+    base_path, path = tmp_path / "base.pickle", tmp_path / "updated.pickle"
+    service.export_history(CHAT_ID, None, True, base_path)
+
+    api.chats[CHAT_ID] += [make_raw_message(i) for i in range(11, 16)]
+    api.titles[CHAT_ID] = "New title"
+    service.update_history(CHAT_ID, None, True, base_path, path)
+
+    history = VkHistoryStorage().load_history(path)
+    assert [msg.conversation_message_id for msg in history.messages] == list(range(1, 16))
+    assert history.title_opt == "New title"
+    assert history.participants_opt == ParticipantIndex({1: 15}, set())  # Index of the base export is updated
+    assert len(VkHistoryStorage().load_history(base_path).messages) == 10
+
+
+def test_export_several_raw_histories(tmp_path):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 10)
+    api.add_chat(CHAT_ID + 1, 5)
+    paths = [tmp_path / "1.json", tmp_path / "2.json"]
+    make_service(api).export_raw_histories([CHAT_ID, CHAT_ID + 1], None, True, paths, [None, None])
+
+    for path, messages_count in zip(paths, [10, 5]):
+        raw_history = VkHistoryStorage().load_raw_history(path)
+        assert list(raw_history.raw_messages) == [make_raw_message(i) for i in range(1, messages_count + 1)]
+
+
+def test_parse_in_several_processes(tmp_path):
+    raw_messages = [make_raw_message(i) for i in range(1, 101)]
+    raw_path, path = tmp_path / "raw.json", tmp_path / "history.pickle"
+    VkHistoryStorage().save_raw_history(ChatRawHistory(raw_messages, None, None, None), raw_path)
+    service = VkExporterService(VkService(FakeVkApi().get_api()), VkHistoryStorage(), parse_workers=2)
+    service._MIN_PARALLEL_PARSE_MESSAGES = 10
+    service._PARSE_CHUNK_SIZE = 7
+    service.export_history_from_raw_input(raw_path, path)
+
+    assert list(VkHistoryStorage().load_history(path).messages) == list(map(Message.parse, raw_messages))
+    assert VkHistoryStorage().load_participants(path) == ParticipantIndex({1: 100}, set())
+
+
+def test_nested_messages_are_shared():
+    popular, old = make_raw_message(1, text="popular"), make_raw_message(0, text="old")
+    raw_messages = [{**make_raw_message(i), "reply_message": popular, "fwd_messages": [old]} for i in range(2, 5)]
+    history = make_service(FakeVkApi())._parse_raw_history(ChatRawHistory(raw_messages, None, None, None))
+
+    assert list(history.messages) == list(map(Message.parse, raw_messages))
+    replies = [msg.reply_message for msg in history.messages]
+    assert replies[0] is replies[1] is replies[2]
+    forwarded = [msg.fwd_messages[0] for msg in history.messages]
+    assert forwarded[0] is not forwarded[1]  # Messages without id are not shared
+
+
+def test_failed_save_is_exported_again_in_batch_mode(tmp_path, monkeypatch):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 10)
+    controller = VkExporterController(make_service(api))
+    args = get_arguments(f"--chats {CHAT_ID} --export-dir {tmp_path}")
+    write_history = VkHistoryStorage._write_history
+
+    def fail_to_write(self, f, history):
+        f.write(b"VKTGHIST")
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(VkHistoryStorage, "_write_history", fail_to_write)
+    with pytest.raises(OSError):
+        controller(args)
+    monkeypatch.setattr(VkHistoryStorage, "_write_history", write_history)
+    controller(args)
+
+    history = VkHistoryStorage().load_history(tmp_path / f"{CHAT_ID}.pickle")
+    assert [msg.conversation_message_id for msg in history.messages] == list(range(1, 11))
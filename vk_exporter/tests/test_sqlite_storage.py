@@ -0,0 +1,110 @@
+import sqlite3
+from datetime import datetime, timezone
+
+import pytest
+
+import vk_exporter.sqlite_storage
+import vk_exporter.types as vk
+from vk_exporter.service import VkExporterService
+from vk_exporter.sqlite_storage import SqliteMessages, SqliteVkHistoryStorage
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.fake_vk_api import FakeVkApi, make_raw_message
+from vk_exporter.vk_service import VkService
+
+CHAT_ID = 2_000_000_001
+
+
+def make_messages():
+    raw_messages = [make_raw_message(i, from_id=i % 3) for i in range(1, 1201)]
+    sticker = {"type": "sticker", "sticker": {"images": [{"url": "s.png", "width": 1, "height": 1}]}}
+    for raw_message in raw_messages[::10]:
+        raw_message["attachments"] = [sticker]
+    raw_messages[1]["reply_message"] = make_raw_message(1)
+    raw_messages[2]["fwd_messages"] = [
+        {**make_raw_message(1), "fwd_messages": [make_raw_message(2)]},
+        {**make_raw_message(2), "action": {"type": "chat_invite_user", "member_id": 5}},
+    ]
+    return [vk.Message.parse(raw_message) for raw_message in raw_messages]
+
+
+def test_round_trip(tmp_path):
+    messages = make_messages()
+    path = tmp_path / "history.sqlite"
+    VkHistoryStorage().save_history(vk.ChatHistory(messages, "title", vk.Photo("url", 1, 2)), path)
+
+    history = VkHistoryStorage().load_history(path)
+    assert (history.title_opt, history.photo_opt) == ("title", vk.Photo("url", 1, 2))
+    assert len(history.messages) == len(messages)
+    assert list(history.messages) == messages
+    assert history.messages[2] == messages[2]
+    assert history.messages[-1] == messages[-1]
+    assert history.messages[5:8] == messages[5:8]
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_queries(tmp_path):
+    messages = make_messages()
+    path = tmp_path / "history.db"
+    storage = SqliteVkHistoryStorage()
+    storage.save_history(vk.ChatHistory(messages, None, None), path)
+
+    assert list(storage.iter_messages(path, from_id_opt=2)) == [msg for msg in messages if msg.from_id == 2]
+    date_from, date_to = messages[100].date, messages[200].date
+    assert list(storage.iter_messages(path, date_from_opt=date_from, date_to_opt=date_to)) == messages[100:200]
+    assert list(storage.iter_messages(path, attachment_type_opt=vk.Sticker)) == messages[::10]
+    date_to = datetime(2020, 9, 13, 13, tzinfo=timezone.utc)
+    assert list(storage.iter_messages(path, from_id_opt=1, date_to_opt=date_to, attachment_type_opt=vk.Sticker)) == \
+           [msg for msg in messages[::10] if msg.from_id == 1 and msg.date < date_to]
+
+
+def test_update_in_place(tmp_path):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 10)
+    service = VkExporterService(VkService(api.get_api()), VkHistoryStorage())
+    path = tmp_path / "history.sqlite"
+    service.export_history(CHAT_ID, None, True, path)
+
+    api.chats[CHAT_ID] += [make_raw_message(i) for i in range(11, 16)]
+    service.update_history(CHAT_ID, None, True, path, path)
+
+    history = VkHistoryStorage().load_history(path)
+    assert [msg.conversation_message_id for msg in history.messages] == list(range(1, 16))
+
+
+def test_participants(tmp_path):
+    messages = make_messages()
+    path = tmp_path / "history.sqlite"
+    VkHistoryStorage().save_history(vk.ChatHistory(messages, None, None), path)
+
+    participants = VkHistoryStorage().load_participants(path)
+    assert participants == vk.ParticipantIndex({0: 400, 1: 400, 2: 400}, {1, 5})
+    assert participants == vk.ParticipantIndex.collect(messages)
+
+
+def test_connections_are_closed(tmp_path, monkeypatch):
+    connections = []
+
+    def connect(*args, **kwargs):
+        connections.append(real_connect(*args, **kwargs))
+        return connections[-1]
+
+    real_connect = vk_exporter.sqlite_storage.connect
+    monkeypatch.setattr(vk_exporter.sqlite_storage, "connect", connect)
+    storage = SqliteVkHistoryStorage()
+    storage.save_raw_history(vk.ChatRawHistory([make_raw_message(i) for i in range(1, 11)], None, None, None),
+                             tmp_path / "raw.sqlite")
+    storage.save_history(vk.ChatHistory(make_messages(), None, None), tmp_path / "history.sqlite")
+
+    raw_messages = storage.load_raw_history(tmp_path / "raw.sqlite").raw_messages
+    next(iter(raw_messages))
+    messages = storage.iter_messages(tmp_path / "history.sqlite", from_id_opt=1)
+    next(messages)
+    history_messages = storage.load_history(tmp_path / "history.sqlite").messages
+    assert isinstance(history_messages, SqliteMessages)
+    with history_messages:
+        assert history_messages[0] == make_messages()[0]
+    del raw_messages, messages  # Iterated over partially
+
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
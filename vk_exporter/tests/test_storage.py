@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+from typing import Callable
+
+import pytest
+
+from common.json_codec import IJsonCodec, MsgspecJsonCodec, OrjsonCodec, StdlibJsonCodec
+from vk_exporter.storage import VkHistoryStorage
+from vk_exporter.types import ChatHistory, ChatRawHistory, KickUserAction, Message, ParticipantIndex
+
+messages = [
+    {"conversation_message_id": 1, "from_id": 10, "date": 0, "text": "Привет"},
+    {"conversation_message_id": 2, "from_id": 20, "date": 1, "text": "Hi\nthere"},
+]
+
+
+@pytest.mark.parametrize("file_name", ["raw.json", "raw.json.gz", "raw.sqlite"])
+def test_raw_history_round_trip(tmp_path, file_name):
+    storage = VkHistoryStorage()
+    path = tmp_path / file_name
+    storage.save_raw_history(ChatRawHistory(iter(messages), "Чат", "url", 200), path)
+
+    loaded = storage.load_raw_history(path)
+    assert (loaded.title_opt, loaded.photo_url_opt, loaded.photo_size_opt) == ("Чат", "url", 200)
+    assert list(loaded.raw_messages) == messages
+    assert list(tmp_path.iterdir()) == [path]
+
+
+@pytest.mark.parametrize("file_name", ["raw.json", "raw.json.gz", "raw.sqlite"])
+def test_load_last_raw_message(tmp_path, file_name, monkeypatch):
+    monkeypatch.setattr(VkHistoryStorage, "_TAIL_READ_SIZE", 16)  # Shorter than a line
+    storage = VkHistoryStorage()
+    for count in [0, 1, 100]:
+        path = tmp_path / f"{count}.{file_name}"
+        raw_messages = [{**messages[1], "conversation_message_id": i} for i in range(1, count + 1)]
+        storage.save_raw_history(ChatRawHistory(raw_messages, "Чат", None, None), path)
+        assert storage.load_last_raw_message_opt(path) == (raw_messages[-1] if raw_messages else None)
+
+
+def test_zstd_compression(tmp_path):
+    pytest.importorskip("zstandard")
+    test_raw_history_round_trip(tmp_path, "raw.json.zst")
+
+
+def test_one_message_per_line(tmp_path):
+    storage = VkHistoryStorage()
+    path = tmp_path / "raw.json"
+    storage.save_raw_history(ChatRawHistory(messages, None, None, None), path)
+    assert path.read_text(encoding="utf-8").count("\n") == 1 + len(messages)
+
+
+def test_broken_export_is_not_saved(tmp_path):
+    def failing_messages():
+        yield messages[0]
+        raise ConnectionError("Network is down")
+
+    storage = VkHistoryStorage()
+    path = tmp_path / "raw.json"
+    with pytest.raises(ConnectionError):
+        storage.save_raw_history(ChatRawHistory(failing_messages(), None, None, None), path)
+    assert not path.exists()
+
+
+def test_load_legacy_raw_history(tmp_path):
+    path = tmp_path / "raw.json"
+    with path.open("w") as f:
+        dct = {"raw_messages": messages, "title_opt": "Title", "photo_url_opt": None, "photo_size_opt": None}
+        json.dump(dct, f, ensure_ascii=False, indent=2)
+
+    loaded = VkHistoryStorage().load_raw_history(path)
+    assert loaded.title_opt == "Title"
+    assert list(loaded.raw_messages) == messages
+
+
+# Everything json strings may contain: cyrillic, emoji, escaped characters, line separators
+tricky_messages = [
+    *messages,
+    {"conversation_message_id": 3, "from_id": -5, "date": 2, "text": "Ёжик 🦔 \"quoted\" \\ / \t\r\n\u0000\u2028 \u007f",
+     "attachments": [{"type": "poll", "poll": {"rate": 33.33, "votes": 0, "empty": {}, "items": [], "none": None}}],
+     "is_expired": True, "big": 2 ** 62},
+]
+
+
+CODEC_CLASSES: list[Callable[[], IJsonCodec]] = [StdlibJsonCodec, OrjsonCodec, MsgspecJsonCodec]
+
+
+def make_codec(codec_class):
+    try:
+        return codec_class()
+    except ImportError:
+        pytest.skip(f"{codec_class} is not installed")
+
+
+@pytest.mark.parametrize("codec_class", CODEC_CLASSES)
+def test_json_codec(tmp_path, codec_class):
+    codec = make_codec(codec_class)
+    assert codec.dumps(tricky_messages) == StdlibJsonCodec().dumps(tricky_messages)  # Files are the same
+    assert codec.loads(codec.dumps(tricky_messages)) == tricky_messages
+    assert codec.loads(codec.dumps([1e-7, 1e300])) == [1e-7, 1e300]  # Exponents may be written differently
+    assert "Ёжик".encode("utf-8") in codec.dumps(tricky_messages)  # Like ensure_ascii=False
+    with pytest.raises(ValueError):
+        codec.loads(b"not json")
+
+    path = tmp_path / "raw.json"
+    VkHistoryStorage(codec).save_raw_history(ChatRawHistory(tricky_messages, "Чат", None, None), path)
+    for other_codec_class in CODEC_CLASSES:
+        try:
+            other_codec = other_codec_class()
+        except ImportError:
+            continue
+        loaded = VkHistoryStorage(other_codec).load_raw_history(path)
+        assert loaded.title_opt == "Чат"
+        assert list(loaded.raw_messages) == tricky_messages
+
+
+@pytest.mark.parametrize("codec_class", CODEC_CLASSES)
+def test_load_raw_history_with_spaces(tmp_path, codec_class):
+    """Files written before json codecs were added have spaces after separators"""
+    path = tmp_path / "raw.json"
+    with path.open("w", encoding="utf-8") as f:
+        f.write(json.dumps({"version": 1, "title_opt": "Чат", "photo_url_opt": None, "photo_size_opt": None},
+                           ensure_ascii=False) + "\n")
+        for message in tricky_messages:
+            f.write(json.dumps(message, ensure_ascii=False) + "\n")
+    loaded = VkHistoryStorage(make_codec(codec_class)).load_raw_history(path)
+    assert list(loaded.raw_messages) == tricky_messages
+
+
+def test_participants_are_loaded_without_messages(tmp_path, monkeypatch):
+    date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    replied = Message(5, from_id=20, date=date, text="")
+    messages = [Message(1, from_id=10, date=date, text="", reply_message=replied),
+                Message(2, from_id=10, date=date, text="", action=KickUserAction(30))]
+    path, other_path = tmp_path / "history.pickle", tmp_path / "other.pickle"
+    VkHistoryStorage().save_history(ChatHistory(messages, None, None), path)
+    VkHistoryStorage().save_history(ChatHistory(messages[:1], None, None), other_path)
+    expected = ParticipantIndex({10: 2}, {20, 30})
+
+    storage = VkHistoryStorage()
+    assert storage.load_history(path).participants_opt == expected
+    os.utime(path, (0, 0))  # The index is tied to the content of the history, not to its modification time
+    assert storage.load_history(path).participants_opt == expected
+    monkeypatch.setattr(storage, "load_history", None)
+    assert storage.load_participants(path) == expected
+    monkeypatch.undo()
+
+    shutil.copyfile(other_path, path)  # The index belongs to the replaced history, it is not used
+    assert storage.load_history(path).participants_opt is None
+    assert storage.load_participants(path) == ParticipantIndex({10: 1}, {20})
+
+    # Records of the same length: only the sender differs
+    VkHistoryStorage().save_history(ChatHistory([Message(1, from_id=11, date=date, text="a")], None, None), path,
+                                    overwrite=True)
+    VkHistoryStorage().save_history(ChatHistory([Message(1, from_id=22, date=date, text="a")], None, None),
+                                    other_path, overwrite=True)
+    shutil.copyfile(other_path, path)
+    assert storage.load_participants(path) == ParticipantIndex({22: 1}, set())
@@ -0,0 +1,43 @@
+import pickle
+
+from common.lazy_sequence import LazySequence
+from vk_exporter.fake_vk_api import make_raw_message
+from vk_exporter.parser import MessageParser
+from vk_exporter.types import Geo, Message, Photo, Sticker
+
+photo = {"type": "photo", "photo": {"sizes": [{"type": "x", "url": "https://x/1.jpg", "width": 1, "height": 2}]}}
+geo = {"coordinates": {"latitude": 1.5, "longitude": 2.5}, "place": {"title": "Home"}}
+
+
+def test_lazy_attachments():
+    raw_message = {**make_raw_message(2), "geo": geo, "attachments": [photo],
+                   "reply_message": {**make_raw_message(1), "attachments": [photo]}}
+    message = MessageParser(lazy_attachments=True).parse(raw_message)
+    assert isinstance(message.attachments, LazySequence)
+    is_loaded_before = message.attachments.is_loaded
+
+    assert message.attachments == (Geo(1.5, 2.5, "Home"), Photo("https://x/1.jpg", 1, 2))
+    assert (is_loaded_before, message.attachments.is_loaded) == (False, True)
+    assert message == Message.parse(raw_message)
+    assert hash(message) == hash(Message.parse(raw_message))
+    assert pickle.loads(pickle.dumps(message)).attachments == message.attachments
+
+
+def test_no_attachments():
+    assert MessageParser(lazy_attachments=True).parse(make_raw_message(1)).attachments == ()
+
+
+def test_media_ids():
+    raw_photo = {"sizes": [{"type": "x", "url": "https://x/1.jpg", "width": 1, "height": 2}], "id": 7, "owner_id": -5}
+    assert Photo.parse(raw_photo) == Photo("https://x/1.jpg", 1, 2, id=7, owner_id=-5)
+    raw_sticker = {"sticker_id": 9, "images": [{"url": "https://x/s.png", "width": 1, "height": 1}]}
+    assert Sticker.parse(raw_sticker).sticker_id == 9
+
+
+def test_pickles_without_new_fields():
+    """Photos pickled before they got ids: as a dict (without slots) or as a shorter list of fields"""
+    for state in [{"url": "u", "width": 1, "height": 2}, ["u", 1, 2]]:
+        loaded = Photo.__new__(Photo)
+        getattr(loaded, "__setstate__")(state)
+        assert loaded == Photo("u", 1, 2)
+        assert (loaded.id, loaded.owner_id) == (0, 0)
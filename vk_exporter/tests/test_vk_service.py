@@ -0,0 +1,228 @@
+import math
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+import vk_api
+
+from vk_exporter.checkpoint import ExportCheckpoint
+from vk_exporter.fake_vk_api import FakeVkApi, make_raw_message
+from vk_exporter.tests.test_checkpoint import make_header
+from vk_exporter.vk_service import VkService, _ConversationInfo
+
+CHAT_ID = 2_000_000_001
+
+
+def make_message(conversation_message_id):
+    return {"conversation_message_id": conversation_message_id}
+
+
+class FakeVkService(VkService):
+    """Chat of 'total' messages with ids 1..total. Dies after 'fail_after_batches' batches"""
+
+    def __init__(self, total: int, batch_size: int, fail_after_batches: None | int = None, max_workers: int = 1):
+        super().__init__(api=None, max_workers=max_workers)
+        self.total = total
+        self._MESSAGES_PER_EXECUTE = batch_size
+        self.fail_after_batches = fail_after_batches
+        self.requested_offsets: list[int] = []
+
+    def _get_conversation_info(self, peer_id):
+        return _ConversationInfo(last_message_id=self.total, title_opt="Title", photo_url_opt=None,
+                                 photo_size_opt=None)
+
+    def _get_messages_count(self, peer_id):
+        return self.total
+
+    def _get_raw_messages_reversed_batch(self, peer_id, last_message_id, offset, count):
+        if self.fail_after_batches is not None and len(self.requested_offsets) == self.fail_after_batches:
+            raise ConnectionError("Network is down")
+        self.requested_offsets.append(offset)
+        first_id = last_message_id - offset
+        last_id = max(first_id - count, 0)
+        return [make_message(i) for i in range(first_id, last_id, -1)]
+
+
+def test_resume_export(tmp_path):
+    checkpoint = ExportCheckpoint(tmp_path / "checkpoint")
+    service = FakeVkService(total=10, batch_size=3, fail_after_batches=2)
+    with pytest.raises(ConnectionError):
+        list(service.get_raw_history(1, None, True, checkpoint).raw_messages)
+    assert service.requested_offsets == [9, 6]  # The oldest messages go first
+
+    service = FakeVkService(total=10, batch_size=3)
+    history = service.get_raw_history(1, None, True, checkpoint)
+    assert list(history.raw_messages) == [make_message(i) for i in range(1, 11)]
+    assert service.requested_offsets == [3, 0]  # Already loaded batches are not requested again
+    assert history.title_opt == "Title"
+
+
+def test_max_messages(tmp_path):
+    service = FakeVkService(total=10, batch_size=3)
+    history = service.get_raw_history(1, 4, True)
+    assert list(history.raw_messages) == [make_message(i) for i in range(7, 11)]
+    assert service.requested_offsets == [3, 0]
+
+
+def test_resume_another_chat(tmp_path):
+    checkpoint = ExportCheckpoint(tmp_path / "checkpoint")
+    checkpoint.start(make_header())
+    with pytest.raises(ValueError):
+        FakeVkService(total=10, batch_size=3).get_raw_history(2, None, True, checkpoint)
+
+
+def test_concurrent_batches_keep_order():
+    class SlowVkService(FakeVkService):
+        def __init__(self):
+            super().__init__(total=20, batch_size=3, max_workers=4)
+            self.lock = threading.Lock()
+            self.active = 0
+            self.max_active = 0
+
+        def _get_raw_messages_reversed_batch(self, peer_id, last_message_id, offset, count):
+            with self.lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(0.01 * (offset % 4))  # Batches finish in a different order
+            result = super()._get_raw_messages_reversed_batch(peer_id, last_message_id, offset, count)
+            with self.lock:
+                self.active -= 1
+            return result
+
+    service = SlowVkService()
+    history = service.get_raw_history(1, None, True)
+    assert list(history.raw_messages) == [make_message(i) for i in range(1, 21)]
+    assert sorted(service.requested_offsets, reverse=True) == [18, 15, 12, 9, 6, 3, 0]
+    assert 1 < service.max_active <= 4
+
+
+def test_overlapping_batches_are_deduplicated():
+    class ShiftingVkService(FakeVkService):
+        def _get_raw_messages_reversed_batch(self, peer_id, last_message_id, offset, count):
+            batch = super()._get_raw_messages_reversed_batch(peer_id, last_message_id, offset, count)
+            if offset == 3:  # Message was deleted, so the batch contains one message of the previous batch
+                batch.append(make_message(batch[-1]["conversation_message_id"] - 1))
+            return batch
+
+    history = ShiftingVkService(total=9, batch_size=3).get_raw_history(1, None, True)
+    assert list(history.raw_messages) == [make_message(i) for i in range(1, 10)]
+
+
+@pytest.mark.parametrize("messages_count, max_messages, expected_executes, expected_sub_calls", [
+    (10_000, 50, 1, 1),  # Only one small page is requested
+    (300, None, 1, 2),
+    (5_001, None, 2, 26),  # The oldest message is loaded by one request of size 1
+    (5_000, 7_000, 1, 25),
+])
+def test_history_is_not_over_fetched(messages_count, max_messages, expected_executes, expected_sub_calls):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, messages_count)
+    history = VkService(api.get_api()).get_raw_history(CHAT_ID, max_messages, True)
+
+    loaded_count = min(messages_count, max_messages or messages_count)
+    expected_ids = list(range(messages_count - loaded_count + 1, messages_count + 1))
+    assert [msg["conversation_message_id"] for msg in history.raw_messages] == expected_ids
+    assert history.title_opt == f"Chat {CHAT_ID}"
+    assert api.calls["execute"] == expected_executes
+    assert api.calls["messages.getHistory"] == 1 + expected_sub_calls  # One more to get the messages count
+
+
+def test_history_ends_earlier_than_expected():
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 1000)
+    service = VkService(api.get_api())
+    history = service.get_raw_history(CHAT_ID, None, True)
+    del api.chats[CHAT_ID][:500]  # Someone deleted messages during the export
+
+    assert len(list(history.raw_messages)) == 500
+    assert api.calls["messages.getHistory"] == 1 + 3  # The script stops after the first incomplete page
+
+
+def test_only_new_messages_are_loaded():
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 200_500)
+    history = VkService(api.get_api()).get_raw_history(CHAT_ID, None, True, after_cmid=200_000)
+
+    assert [msg["conversation_message_id"] for msg in history.raw_messages] == list(range(200_001, 200_501))
+    assert api.calls["execute"] == 1
+    assert api.calls["messages.getHistory"] == 2 + 3  # Messages count, the last message and the script pages
+
+
+def test_nothing_new_is_loaded():
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 100)
+    history = VkService(api.get_api()).get_raw_history(CHAT_ID, None, True, after_cmid=100)
+
+    assert list(history.raw_messages) == []
+    assert api.calls["execute"] == 0
+
+
+def message_date(conversation_message_id: int) -> datetime:
+    return datetime.fromtimestamp(make_raw_message(conversation_message_id)["date"], tz=timezone.utc)
+
+
+@pytest.mark.parametrize("date_from_cmid, date_to_cmid, expected_ids", [
+    (1_001, 2_001, range(1_001, 2_001)),
+    (None, 11, range(1, 11)),
+    (99_991, None, range(99_991, 100_001)),
+    (200_000, None, range(0)),
+])
+def test_date_range(date_from_cmid, date_to_cmid, expected_ids):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 100_000)
+    history = VkService(api.get_api()).get_raw_history(
+        CHAT_ID, None, True,
+        date_from_opt=None if date_from_cmid is None else message_date(date_from_cmid),
+        date_to_opt=None if date_to_cmid is None else message_date(date_to_cmid),
+    )
+
+    assert [msg["conversation_message_id"] for msg in history.raw_messages] == list(expected_ids)
+    assert api.calls["execute"] == (1 if expected_ids else 0)
+    binary_search_calls = 2 * (math.ceil(math.log2(100_000)) + 1)
+    assert api.calls["messages.getHistory"] <= 1 + binary_search_calls + 5
+
+
+def test_several_chats():
+    api = FakeVkApi()
+    peer_ids = [CHAT_ID + i for i in range(30)]
+    for i, peer_id in enumerate(peer_ids):
+        api.add_chat(peer_id, 100 * i)
+    histories = VkService(api.get_api(), max_workers=4).get_raw_histories(
+        peer_ids, None, True, [None] * len(peer_ids))
+
+    for i, history in enumerate(histories):
+        assert [msg["conversation_message_id"] for msg in history.raw_messages] == list(range(1, 100 * i + 1))
+        assert history.title_opt == f"Chat {peer_ids[i]}"
+    assert api.calls["messages.getConversationsById"] == 2  # 24 chats fit into one execute
+    assert api.calls["execute"] == 2 + 29  # Chats info and one batch per nonempty chat
+
+
+def test_several_chats_are_resumed(tmp_path):
+    api = FakeVkApi()
+    api.add_chat(CHAT_ID, 10)
+    api.add_chat(CHAT_ID + 1, 20)
+    checkpoint = ExportCheckpoint(tmp_path / "checkpoint")
+    list(VkService(api.get_api()).get_raw_history(CHAT_ID + 1, None, True, checkpoint).raw_messages)
+    api.calls.clear()
+
+    histories = VkService(api.get_api()).get_raw_histories([CHAT_ID, CHAT_ID + 1], None, True, [None, checkpoint])
+    assert [len(list(history.raw_messages)) for history in histories] == [10, 20]
+    assert api.calls["execute"] == 2  # Info and messages of the first chat only
+
+
+def test_fake_api_imitates_errors():
+    api = FakeVkApi(max_requests_per_second_opt=2)
+    api.add_chat(CHAT_ID, 10)
+    service = VkService(api.get_api())
+    service._get_messages_count(CHAT_ID)
+    service._get_messages_count(CHAT_ID)
+    with pytest.raises(vk_api.ApiError) as exc_info:
+        service._get_messages_count(CHAT_ID)
+    assert exc_info.value.code == 6
+
+    api = FakeVkApi(error_rate=1)
+    api.add_chat(CHAT_ID, 10)
+    with pytest.raises(vk_api.ApiError) as exc_info:
+        VkService(api.get_api()).get_raw_history(CHAT_ID, None, True)
+    assert exc_info.value.code == 10
@@ -1,45 +1,152 @@
+import dataclasses
+import sys
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Optional, TypeAlias, Union, cast
+from typing import Annotated, Any, Iterable, Optional, Sequence, TypeAlias, TypeVar, Union, cast
 
 from vk_api.vk_api import VkApiMethod
 
+from common.async_vk_client import AsyncVkApiMethod
+from common.history_file import Interned
+
+T = TypeVar("T")
+
+# Large histories keep millions of messages in memory, so messages and attachments are slotted dataclasses,
+# and strings which repeat a lot (stickers, links, short replies like "ok") are interned while parsing
+_MAX_INTERNED_TEXT_LENGTH = 16
+
+
+# Strings interned while parsing are interned when they are loaded from a history file too
+InternedStr: TypeAlias = Annotated[str, Interned()]
+InternedText: TypeAlias = Annotated[str, Interned(_MAX_INTERNED_TEXT_LENGTH)]  # See intern_text
+
+
+def intern_text(text: str) -> str:
+    """Texts of messages are interned if they are short: longer ones rarely repeat"""
+    return sys.intern(text) if len(text) <= _MAX_INTERNED_TEXT_LENGTH else text
+
+
+def _intern_opt(string_opt: Optional[str]) -> Optional[str]:
+    return None if string_opt is None else sys.intern(string_opt)
+
+
+def _loads_legacy_pickles(cls: type[T]) -> type[T]:
+    """
+    Frozen dataclasses with slots are pickled as lists of field values.
+    Histories pickled before the classes got slots have dicts instead, make __setstate__ accept them too.
+    Fields added to the end of a class since the history was pickled get their defaults
+    """
+    setstate = getattr(cls, "__setstate__")
+    fields = dataclasses.fields(cast(Any, cls))
+    field_names = [field.name for field in fields]
+    defaults = [field.default for field in fields]
+
+    def __setstate__(self: T, state: Any) -> None:
+        if isinstance(state, dict):
+            state = [state.get(name, default) for name, default in zip(field_names, defaults)]
+        elif len(state) < len(field_names):
+            state = [*state, *defaults[len(state):]]
+        setstate(self, state)
+
+    setattr(cls, "__setstate__", __setstate__)
+    return cls
+
 
 @dataclass(frozen=True)
 class ChatHistory:
-    messages: list["Message"]
+    messages: Sequence["Message"]  # Can be lazy: messages loaded from a file are decoded when accessed
     # Only valid for chats (not private messages):
     title_opt: Optional[str]  # All chats have title
     photo_opt: Optional["Photo"]  # Not all chats have photo
+    # Known if messages were just parsed or the history was loaded with its index. Otherwise it is collected on save
+    participants_opt: Optional["ParticipantIndex"] = dataclasses.field(default=None, compare=False)
+
+
+@dataclass(frozen=True)
+class ParticipantIndex:
+    """
+    Senders of messages with their numbers of messages, and ids which are referenced in the history:
+    senders of replied and forwarded messages, invited and kicked users (some of them may have no messages).
+    It is saved next to the history, so 'contacts prepare' does not have to load the messages
+    """
+    message_counts: dict[int, int]
+    referenced_ids: set[int]
+
+    def get_all_ids(self) -> set[int]:
+        return self.message_counts.keys() | self.referenced_ids
+
+    @staticmethod
+    def collect(messages: Iterable["Message"]) -> "ParticipantIndex":
+        message_counts: dict[int, int] = {}
+        referenced_ids: set[int] = set()
+        # Copies of a nested message have the same key and content (see Message.parse), they are visited once
+        visited_keys: set[tuple[int, int, datetime]] = set()
+
+        def add_references(message: Message) -> None:
+            if isinstance(message.action, InviteUserAction):
+                referenced_ids.add(message.action.invited_user_id)
+            elif isinstance(message.action, KickUserAction):
+                referenced_ids.add(message.action.kicked_user_id)
+            nested_messages = message.fwd_messages if message.reply_message is None \
+                else (message.reply_message, *message.fwd_messages)
+            for nested_message in nested_messages:
+                key = (nested_message.conversation_message_id, nested_message.from_id, nested_message.date)
+                if key[0]:  # Messages without conversation_message_id (0) can't be told apart
+                    if key in visited_keys:
+                        continue
+                    visited_keys.add(key)
+                referenced_ids.add(nested_message.from_id)
+                add_references(nested_message)
+
+        for message in messages:
+            message_counts[message.from_id] = message_counts.get(message.from_id, 0) + 1
+            if message.action is not None or message.reply_message is not None or message.fwd_messages:
+                add_references(message)
+        return ParticipantIndex(message_counts, referenced_ids)
+
+    @staticmethod
+    def merge(indices: Iterable["ParticipantIndex"]) -> "ParticipantIndex":
+        message_counts: dict[int, int] = {}
+        referenced_ids: set[int] = set()
+        for index in indices:
+            for from_id, count in index.message_counts.items():
+                message_counts[from_id] = message_counts.get(from_id, 0) + count
+            referenced_ids |= index.referenced_ids
+        return ParticipantIndex(message_counts, referenced_ids)
 
 
 @dataclass(frozen=True)
 class ChatRawHistory:
-    raw_messages: list[dict]
+    raw_messages: Iterable[dict]  # Can be lazy: messages are loaded while it is being iterated over
     title_opt: Optional[str]
     photo_url_opt: Optional[str]
     photo_size_opt: Optional[int]
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Message:
     """https://dev.vk.com/reference/objects/message"""
     conversation_message_id: int
     from_id: int
     date: datetime
-    text: str
+    text: InternedText
     is_expired: bool = False  # If true message would not have any content
-    attachments: tuple["Attachment", ...] = tuple()
+    attachments: Sequence["Attachment"] = tuple()  # Can be lazy: parsed or decoded on first access
     reply_message: Optional["Message"] = None
     fwd_messages: tuple["Message", ...] = tuple()
     action: Optional["Action"] = None  # E.g. add someone to the chat
 
     @staticmethod
     def parse(message_dict: dict) -> "Message":
-        attachments: tuple["Attachment", ...] = ()
-        if "geo" in message_dict:
-            attachments += (Geo.parse(message_dict["geo"]),)
-        attachments += tuple(parse_attachment(info) for info in message_dict.get("attachments", []))
+        """
+        The plain reference parser. Histories are parsed by MessageParser, which must give the same result
+        (see test_parser), but shares copies of nested messages and can parse attachments lazily
+        """
+        attachments: tuple[Attachment, ...] = ()
+        geo_dict_opt, attachment_dicts = message_dict.get("geo"), message_dict.get("attachments")
+        if geo_dict_opt or attachment_dicts:
+            attachments = Message._parse_attachments(geo_dict_opt, attachment_dicts)
         fwd_messages = tuple(Message.parse(info) for info in message_dict.get("fwd_messages", []))
         reply_message: Optional[Message] = None
         if "reply_message" in message_dict:
@@ -51,7 +158,7 @@ class Message:
             conversation_message_id=message_dict["conversation_message_id"],
             date=datetime.fromtimestamp(message_dict["date"], tz=timezone.utc),
             from_id=message_dict["from_id"],
-            text=message_dict["text"],
+            text=intern_text(message_dict["text"]),
             is_expired=message_dict.get("is_expired", False),
             attachments=attachments,
             fwd_messages=fwd_messages,
@@ -59,19 +166,28 @@ class Message:
             action=action,
         )
 
+    @staticmethod
+    def _parse_attachments(geo_dict_opt: Optional[dict], attachment_dicts: Optional[list[dict]]
+                           ) -> tuple["Attachment", ...]:
+        attachments: tuple[Attachment, ...] = ()
+        if geo_dict_opt is not None:
+            attachments += (Geo.parse(geo_dict_opt),)
+        return attachments + tuple(map(parse_attachment, attachment_dicts or []))
 
-@dataclass(frozen=True)
+
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Geo:
     latitude: float
     longitude: float
-    title: str
+    title: InternedStr
 
     @staticmethod
     def parse(geo_dict: dict) -> "Geo":
         return Geo(
             latitude=geo_dict["coordinates"]["latitude"],
             longitude=geo_dict["coordinates"]["longitude"],
-            title=geo_dict["place"]["title"],
+            title=sys.intern(geo_dict["place"]["title"]),
         )
 
 
@@ -112,15 +228,19 @@ def parse_attachment(attachment_dict: dict) -> Attachment:
             return Sticker.parse(attachment_dict)
         case "link":
             return Link.parse(attachment_dict)
-    return UnsupportedAttachment(type_name=type_name)
+    return UnsupportedAttachment(type_name=sys.intern(type_name))
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Photo:
     """https://dev.vk.com/reference/objects/photo"""
     url: str
     width: int
     height: int
+    # Identify the photo whatever its url is, e.g. in the media cache of the converter. 0 if unknown (chat photo)
+    id: int = 0
+    owner_id: int = 0
 
     @staticmethod
     def parse(photo_dict: dict) -> "Photo":
@@ -129,23 +249,28 @@ class Photo:
             url=best_size["url"],
             width=best_size["width"],
             height=best_size["height"],
+            id=photo_dict.get("id", 0),
+            owner_id=photo_dict.get("owner_id", 0),
         )
 
     @staticmethod
     def _pick_best_size(sizes_list: list[dict]) -> dict:
         def get_size_priority(size: dict) -> int:
-            # https://dev.vk.com/reference/objects/photo-sizes
-            priorities = {size_type: i for i, size_type in enumerate("wzyrqpoxms")}
-            return priorities.get(size["type"], len(priorities))
+            return _PHOTO_SIZE_PRIORITIES.get(size["type"], len(_PHOTO_SIZE_PRIORITIES))
 
         assert sizes_list, "Empty sizes"
         return min(sizes_list, key=get_size_priority)
 
 
-@dataclass(frozen=True)
+# https://dev.vk.com/reference/objects/photo-sizes
+_PHOTO_SIZE_PRIORITIES = {size_type: i for i, size_type in enumerate("wzyrqpoxms")}
+
+
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Video:
     """https://dev.vk.com/reference/objects/video"""
-    title: str
+    title: InternedStr
     id: int
     owner_id: int
     width: int
@@ -158,7 +283,7 @@ class Video:
     @staticmethod
     def parse(video_dict: dict) -> "Video":
         return Video(
-            title=video_dict["title"],
+            title=sys.intern(video_dict["title"]),
             id=video_dict["id"],
             owner_id=video_dict["owner_id"],
             width=video_dict.get("width", 0),
@@ -173,10 +298,21 @@ class Video:
         # NB: This url doesn't live too much. Use it quickly
         if self.content_restricted:
             return None
+        return self._parse_player_url(api.video.get(videos=self._make_video_key()))
+
+    async def try_get_player_url_async(self, api: AsyncVkApiMethod) -> Optional[str]:
+        if self.content_restricted:
+            return None
+        return self._parse_player_url(await api.video.get(videos=self._make_video_key()))
+
+    def _make_video_key(self) -> str:
         video_key = f"{self.owner_id}_{self.id}"
         if self.access_key is not None:  # For example, short videos (aka tik-toks) may not have this key
             video_key += f"_{self.access_key}"
-        response = api.video.get(videos=video_key)
+        return video_key
+
+    @staticmethod
+    def _parse_player_url(response: dict) -> Optional[str]:
         assert len(response["items"]) == 1, response
         url = response["items"][0].get("player")  # Video can be deleted or something. In this case 'player' is absent
         return cast(Optional[str], url)
@@ -191,13 +327,14 @@ class Video:
         return min(images_list, key=get_image_priority)
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Audio:
     """https://dev.vk.com/reference/objects/audio"""
     id: int
     owner_id: int
-    artist: str
-    title: str
+    artist: InternedStr
+    title: InternedStr
     duration: int
     content_restricted: bool  # If True, url will be empty. Actually, it is int, but I don't know what it means
     url: str  # link to mp3 file. TODO: it is always empty. Find another way to download audio
@@ -207,8 +344,8 @@ class Audio:
         return Audio(
             id=audio_dict["id"],
             owner_id=audio_dict["owner_id"],
-            artist=audio_dict["artist"],
-            title=audio_dict["title"],
+            artist=sys.intern(audio_dict["artist"]),
+            title=sys.intern(audio_dict["title"]),
             duration=audio_dict["duration"],
             content_restricted=audio_dict.get("content_restricted", False),
             url=audio_dict["url"],
@@ -220,7 +357,8 @@ class Audio:
         return None
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Voice:
     """https://dev.vk.com/reference/objects/audio-message"""
     link_ogg: str  # link_mp3 is also available
@@ -236,53 +374,61 @@ class Voice:
         )
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Document:
     """https://dev.vk.com/reference/objects/doc"""
     url: str
-    title: str
-    extension: str  # doesn't have leading period: "png" or "docx"
+    title: InternedStr
+    extension: InternedStr  # doesn't have leading period: "png" or "docx"
     type: int  # TODO: consider using it
+    id: int = 0  # 0 if unknown, e.g. in histories exported before ids were kept
+    owner_id: int = 0
 
     @staticmethod
     def parse(document_dict: dict) -> "Document":
         return Document(
             url=document_dict["url"],
-            title=document_dict["title"],
-            extension=document_dict["ext"],
+            title=sys.intern(document_dict["title"]),
+            extension=sys.intern(document_dict["ext"]),
             type=document_dict["type"],
+            id=document_dict.get("id", 0),
+            owner_id=document_dict.get("owner_id", 0),
         )
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Poll:
     """https://dev.vk.com/reference/objects/poll"""
-    question: str
+    question: InternedStr
     answers: tuple["Answer", ...]
     anonymous: bool
     multiple: bool
 
-    @dataclass(frozen=True)
+    @_loads_legacy_pickles
+    @dataclass(frozen=True, slots=True)
     class Answer:
-        text: str
+        text: InternedStr
         votes: int  # how many people have chosen this answer
         rate: float  # 0-100
 
     @staticmethod
     def parse(poll_dict: dict) -> "Poll":
         answers = tuple(
-            Poll.Answer(text=answer_dict["text"], votes=answer_dict["votes"], rate=answer_dict["rate"])
+            Poll.Answer(text=sys.intern(answer_dict["text"]), votes=answer_dict["votes"], rate=answer_dict["rate"])
             for answer_dict in poll_dict["answers"]
         )
         return Poll(
-            question=poll_dict["question"],
+            question=sys.intern(poll_dict["question"]),
             answers=answers,
             anonymous=poll_dict["anonymous"],
             multiple=poll_dict["multiple"],
         )
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Wall:
     """https://dev.vk.com/reference/objects/post"""
     id: int
@@ -299,39 +445,44 @@ class Wall:
         return f"https://vk.com/wall{self.owner_id}_{self.id}"
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Sticker:
     """https://dev.vk.com/reference/objects/sticker"""
-    image_url: str  # usually, .png file
-    animation_url: Optional[str] = None  # TODO: support animated stickers
+    image_url: InternedStr  # usually, .png file
+    animation_url: Annotated[Optional[str], Interned()] = None  # TODO: support animated stickers
+    sticker_id: int = 0  # 0 if unknown, e.g. in histories exported before ids were kept
 
     @staticmethod
     def parse(sticker_dict: dict) -> "Sticker":
         assert sticker_dict["images"], "Empty images"
         best_image = max(sticker_dict["images"], key=lambda img: img["width"] * img["height"])  # type: ignore
         return Sticker(
-            image_url=best_image["url"],
-            animation_url=sticker_dict.get("animation_url"),
+            image_url=sys.intern(best_image["url"]),
+            animation_url=_intern_opt(sticker_dict.get("animation_url")),
+            sticker_id=sticker_dict.get("sticker_id", 0),
         )
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class Link:
     """https://dev.vk.com/reference/objects/link"""
-    url: str
-    title: str
+    url: InternedStr
+    title: InternedStr
 
     @staticmethod
     def parse(link_dict: dict) -> "Link":
         return Link(
-            url=link_dict["url"],
-            title=link_dict["title"]
+            url=sys.intern(link_dict["url"]),
+            title=sys.intern(link_dict["title"]),
         )
 
 
-@dataclass(frozen=True)
+@_loads_legacy_pickles
+@dataclass(frozen=True, slots=True)
 class UnsupportedAttachment:
-    type_name: str
+    type_name: InternedStr
 
 
 # https://dev.vk.com/reference/objects/message#action
@@ -1,16 +1,37 @@
 import abc
+import itertools
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
 
 from tqdm import tqdm
-from vk_api.execute import VkFunction
 from vk_api.vk_api import VkApiMethod
 
+from vk_exporter.checkpoint import CheckpointHeader, IExportCheckpoint
 from vk_exporter.types import ChatRawHistory
 
 
 class IVkService(abc.ABC):
     @abc.abstractmethod
-    def get_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool) -> ChatRawHistory: ...
+    def get_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                        checkpoint_opt: None | IExportCheckpoint = None, after_cmid: int = 0,
+                        date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> ChatRawHistory:
+        """
+        If after_cmid is set, only messages with greater conversation_message_id are loaded.
+        If dates are set, only messages sent within [date_from, date_to) are loaded. max_messages is applied after that
+        """
+
+    @abc.abstractmethod
+    def get_raw_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                          checkpoints: list[Optional[IExportCheckpoint]],
+                          date_from_opt: None | datetime = None,
+                          date_to_opt: None | datetime = None) -> list[ChatRawHistory]:
+        """
+        Batches of all chats are loaded by one pool, the next chat is being loaded while the previous one is processed.
+        Hence, messages of the histories must be iterated over one history after another, in the order of peer_ids
+        """
 
 
 @dataclass
@@ -21,52 +42,296 @@ class _ConversationInfo:
     photo_size_opt: None | int
 
 
+# Loads up to 'count' messages starting from 'offset'. Stops as soon as the history is over.
+# batch_size is <= 200 due to https://dev.vk.com/method/messages.getHistory
+# max_iter is <= 25 due to https://dev.vk.com/method/execute
+GET_HISTORY_SCRIPT = """
+    var batch_size = 200;
+    var max_iter = 25;
+    var count = parseInt(Args.count);
+
+    var messages = [];
+    var offset = parseInt(Args.offset);
+    var i = 0;
+    while (i < max_iter && messages.length < count) {
+        var size = count - messages.length;
+        if (size > batch_size) {
+            size = batch_size;
+        }
+        var items = API.messages.getHistory({
+            "peer_id": parseInt(Args.peer_id),
+            "start_message_id": parseInt(Args.start_message_id),
+            "offset": offset,
+            "count": size,
+        }).items;
+        messages = messages + items;
+        offset = offset + size;
+        i = i + 1;
+        if (items.length < size) {
+            i = max_iter;
+        }
+    }
+    return messages;
+"""
+
+# Loads info and messages count of every chat in one request. One call is spent on conversations,
+# so up to 24 chats fit into one execute
+GET_CHATS_INFO_SCRIPT = """
+    var peer_ids = Args.peer_ids.split(",");
+    var conversations = API.messages.getConversationsById({"peer_ids": Args.peer_ids}).items;
+    var counts = [];
+    var i = 0;
+    while (i < peer_ids.length) {
+        counts.push(API.messages.getHistory({"peer_id": parseInt(peer_ids[i]), "count": 0}).count);
+        i = i + 1;
+    }
+    return {"conversations": conversations, "counts": counts};
+"""
+
+
 class VkService(IVkService):
-    def __init__(self, api: VkApiMethod) -> None:
+    def __init__(self, api: VkApiMethod, max_workers: int = 1) -> None:
         self.api = api
+        self.max_workers = max_workers  # How many batches are loaded simultaneously
 
-    def get_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool) -> ChatRawHistory:
-        conversation_info: _ConversationInfo = self._get_conversation_info(peer_id)
-        total_messages: int = self._get_messages_count(peer_id)  # Could have changed since the previous line
-        if max_messages is not None:
-            total_messages = min(max_messages, total_messages)
+    # GET_HISTORY_SCRIPT loads this many messages at once: batch_size * max_iter
+    _MESSAGES_PER_EXECUTE = 200 * 25
+    _CHATS_PER_EXECUTE = 24  # See GET_CHATS_INFO_SCRIPT
 
-        messages_reversed: list[dict] = []  # Last message is in the beginning of the list
-        messages_loaded = 0
-        with tqdm(total=total_messages, disable=disable_progress_bar, leave=True) as progress_bar:
-            while messages_loaded < total_messages:
-                new_batch = self._get_raw_messages_reversed_batch(
-                    peer_id, conversation_info.last_message_id, messages_loaded)
-                if not new_batch:
-                    break
-                messages_reversed += new_batch
-                messages_loaded += len(new_batch)
-                progress_bar.update(len(new_batch))
-        if max_messages is not None:
-            messages_reversed = messages_reversed[:max_messages]
+    def get_raw_history(self, peer_id: int, max_messages: None | int, disable_progress_bar: bool,
+                        checkpoint_opt: None | IExportCheckpoint = None, after_cmid: int = 0,
+                        date_from_opt: None | datetime = None, date_to_opt: None | datetime = None) -> ChatRawHistory:
+        header_opt = None if checkpoint_opt is None else checkpoint_opt.load_header()
+        if header_opt is not None:
+            # Resume the interrupted export. Its settings take precedence over the provided ones
+            if header_opt.peer_id != peer_id:
+                raise ValueError(f"Checkpoint belongs to another chat: {header_opt.peer_id}")
+            header = header_opt
+        else:
+            conversation_info = self._get_conversation_info(peer_id)
+            total_messages = self._get_messages_count(peer_id)  # Could have changed since the previous line
+            header = self._make_checkpoint_header(
+                peer_id, conversation_info, total_messages, max_messages, after_cmid, date_from_opt, date_to_opt)
+            if checkpoint_opt is not None:
+                checkpoint_opt.start(header)
+        offsets = self._get_offsets(header)
+        n_saved_batches = 0 if checkpoint_opt is None else self._count_saved_batches(checkpoint_opt)
+        loaded_batches = self._load_batches((header, offset) for offset in offsets[n_saved_batches:])
         return ChatRawHistory(
-            raw_messages=messages_reversed[::-1],
+            raw_messages=self._iter_raw_messages(header, disable_progress_bar, checkpoint_opt, loaded_batches),
+            title_opt=header.title_opt,
+            photo_url_opt=header.photo_url_opt,
+            photo_size_opt=header.photo_size_opt,
+        )
+
+    def get_raw_histories(self, peer_ids: list[int], max_messages: None | int, disable_progress_bar: bool,
+                          checkpoints: list[Optional[IExportCheckpoint]],
+                          date_from_opt: None | datetime = None,
+                          date_to_opt: None | datetime = None) -> list[ChatRawHistory]:
+        assert len(peer_ids) == len(checkpoints), (len(peer_ids), len(checkpoints))
+        headers: list[None | CheckpointHeader] = []
+        for peer_id, checkpoint_opt in zip(peer_ids, checkpoints):
+            header_opt = None if checkpoint_opt is None else checkpoint_opt.load_header()
+            if header_opt is not None and header_opt.peer_id != peer_id:
+                raise ValueError(f"Checkpoint belongs to another chat: {header_opt.peer_id}")
+            headers.append(header_opt)
+
+        new_peer_ids = [peer_id for peer_id, header_opt in zip(peer_ids, headers) if header_opt is None]
+        chats_info = self._get_chats_info(new_peer_ids)
+        for i, (peer_id, checkpoint_opt) in enumerate(zip(peer_ids, checkpoints)):
+            if headers[i] is None:
+                conversation_info, total_messages = chats_info[peer_id]
+                header = self._make_checkpoint_header(
+                    peer_id, conversation_info, total_messages, max_messages, 0, date_from_opt, date_to_opt)
+                if checkpoint_opt is not None:
+                    checkpoint_opt.start(header)
+                headers[i] = header
+
+        tasks: list[tuple[CheckpointHeader, int]] = []
+        n_remaining_batches: list[int] = []
+        for header_opt, checkpoint_opt in zip(headers, checkpoints):
+            assert header_opt is not None
+            offsets = self._get_offsets(header_opt)
+            n_saved_batches = 0 if checkpoint_opt is None else self._count_saved_batches(checkpoint_opt)
+            tasks += [(header_opt, offset) for offset in offsets[n_saved_batches:]]
+            n_remaining_batches.append(len(offsets) - n_saved_batches)
+        # All the batches are loaded in a row, so there is no pause between chats
+        loaded_batches = self._load_batches(tasks)
+
+        histories = []
+        for header_opt, checkpoint_opt, n_batches in zip(headers, checkpoints, n_remaining_batches):
+            assert header_opt is not None
+            histories.append(ChatRawHistory(
+                raw_messages=self._iter_raw_messages(header_opt, disable_progress_bar, checkpoint_opt,
+                                                     itertools.islice(loaded_batches, n_batches)),
+                title_opt=header_opt.title_opt,
+                photo_url_opt=header_opt.photo_url_opt,
+                photo_size_opt=header_opt.photo_size_opt,
+            ))
+        return histories
+
+    def _get_offsets(self, header: CheckpointHeader) -> list[int]:
+        # Offsets are counted backwards from the last message. The oldest batch goes first
+        end_offset = header.skip_messages + header.total_messages
+        return list(range(header.skip_messages, end_offset, self._MESSAGES_PER_EXECUTE))[::-1]
+
+    @staticmethod
+    def _count_saved_batches(checkpoint: IExportCheckpoint) -> int:
+        return sum(1 for _ in checkpoint.iter_batches())
+
+    def _iter_raw_messages(self, header: CheckpointHeader, disable_progress_bar: bool,
+                           checkpoint_opt: None | IExportCheckpoint,
+                           loaded_batches: Iterator[tuple[int, list[dict]]]) -> Iterator[dict]:
+        """Messages are loaded lazily, batch by batch, starting from the oldest one. So they come in chronological
+        order and can be written to disk right away, without holding the whole history in memory.
+        loaded_batches yields batches which are not saved in the checkpoint"""
+        end_offset = header.skip_messages + header.total_messages
+        offsets = self._get_offsets(header)
+        n_saved_batches = 0
+        # Offsets are shifted if some messages are deleted during the export, so neighbouring batches may overlap.
+        # Messages go in chronological order, hence their ids grow. Drop everything that is not newer than the last one
+        last_id = header.after_cmid
+        with tqdm(total=header.total_messages, disable=disable_progress_bar, leave=True) as progress_bar:
+            if checkpoint_opt is not None:
+                for offset, batch in checkpoint_opt.iter_batches():
+                    assert offset == offsets[n_saved_batches], "Checkpoint doesn't match the export plan"
+                    n_saved_batches += 1
+                    if batch:
+                        last_id = batch[-1]["conversation_message_id"]
+                    progress_bar.update(len(batch))
+                    yield from batch
+            for offset, batch_reversed in loaded_batches:
+                assert offset == offsets[n_saved_batches], "Batches don't match the export plan"
+                n_saved_batches += 1
+                batch = batch_reversed[:end_offset - offset][::-1]  # Do not exceed max_messages
+                batch = [msg for msg in batch
+                         if msg["conversation_message_id"] > last_id and self._is_in_range(header, msg)]
+                if batch:
+                    last_id = batch[-1]["conversation_message_id"]
+                if checkpoint_opt is not None:
+                    checkpoint_opt.append_batch(offset, batch)
+                progress_bar.update(len(batch))
+                yield from batch
+
+    def _load_batches(self, tasks: Iterable[tuple[CheckpointHeader, int]]) -> Iterator[tuple[int, list[dict]]]:
+        """Loads up to max_workers batches simultaneously, but yields them in the order of tasks"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending: deque[tuple[int, Future[list[dict]]]] = deque()
+            for header, offset in tasks:
+                end_offset = header.skip_messages + header.total_messages
+                count = min(self._MESSAGES_PER_EXECUTE, end_offset - offset)
+                future = executor.submit(
+                    self._get_raw_messages_reversed_batch, header.peer_id, header.last_message_id, offset, count)
+                pending.append((offset, future))
+                if len(pending) == self.max_workers:
+                    done_offset, done_future = pending.popleft()
+                    yield done_offset, done_future.result()
+            for done_offset, done_future in pending:
+                yield done_offset, done_future.result()
+
+    def _make_checkpoint_header(self, peer_id: int, conversation_info: _ConversationInfo, total_messages: int,
+                                max_messages: None | int, after_cmid: int,
+                                date_from_opt: None | datetime, date_to_opt: None | datetime) -> CheckpointHeader:
+        last_message_id = conversation_info.last_message_id
+        # Dates do not decrease with offset, so window boundaries are found by binary search
+        skip_messages = 0
+        if date_to_opt is not None:
+            skip_messages = self._find_first_offset_before(peer_id, last_message_id, total_messages, date_to_opt)
+        if date_from_opt is not None:
+            total_messages = self._find_first_offset_before(peer_id, last_message_id, total_messages, date_from_opt)
+        total_messages = max(total_messages - skip_messages, 0)
+        if max_messages is not None:
+            total_messages = min(max_messages, total_messages)
+        if after_cmid > 0 and total_messages > 0:
+            # conversation_message_id grows by one with every message. Some of them could be deleted, so it is
+            # the upper bound of new messages. Older ones are dropped while loading
+            last_cmid = self._get_conversation_message_id(peer_id, last_message_id)
+            total_messages = min(total_messages, max(last_cmid - after_cmid - skip_messages, 0))
+        return CheckpointHeader(
+            peer_id=peer_id,
+            last_message_id=last_message_id,
+            total_messages=total_messages,
+            after_cmid=after_cmid,
+            skip_messages=skip_messages,
+            date_from_opt=None if date_from_opt is None else int(date_from_opt.timestamp()),
+            date_to_opt=None if date_to_opt is None else int(date_to_opt.timestamp()),
             title_opt=conversation_info.title_opt,
             photo_url_opt=conversation_info.photo_url_opt,
             photo_size_opt=conversation_info.photo_size_opt,
         )
 
+    @staticmethod
+    def _is_in_range(header: CheckpointHeader, message: dict) -> bool:
+        # Offsets found by binary search could have shifted if messages were deleted. Check dates once again
+        if header.date_from_opt is not None and message["date"] < header.date_from_opt:
+            return False
+        if header.date_to_opt is not None and message["date"] >= header.date_to_opt:
+            return False
+        return True
+
+    def _find_first_offset_before(self, peer_id: int, last_message_id: int, total_messages: int,
+                                  date: datetime) -> int:
+        """Returns the smallest offset of a message sent before the date, or total_messages if there is none"""
+        timestamp = date.timestamp()
+        low, high = 0, total_messages
+        while low < high:
+            middle = (low + high) // 2
+            date_opt = self._get_message_date(peer_id, last_message_id, middle)
+            if date_opt is None or date_opt < timestamp:  # Missing messages were deleted from the end of the history
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _get_message_date(self, peer_id: int, last_message_id: int, offset: int) -> None | int:
+        response: dict = self.api.messages.getHistory(
+            peer_id=peer_id, start_message_id=last_message_id, offset=offset, count=1)
+        if not response["items"]:
+            return None
+        date = response["items"][0]["date"]
+        assert isinstance(date, int)
+        return date
+
     def _get_messages_count(self, peer_id: int) -> int:
         response: dict = self.api.messages.getHistory(peer_id=peer_id, count=0)
         count = response["count"]
         assert isinstance(count, int)
         return count
 
+    def _get_conversation_message_id(self, peer_id: int, message_id: int) -> int:
+        response: dict = self.api.messages.getHistory(peer_id=peer_id, start_message_id=message_id, count=1)
+        if not response["items"]:
+            return 0
+        cmid = response["items"][0]["conversation_message_id"]
+        assert isinstance(cmid, int)
+        return cmid
+
+    def _get_chats_info(self, peer_ids: list[int]) -> dict[int, tuple[_ConversationInfo, int]]:
+        """Returns conversation info and messages count of every chat"""
+        result: dict[int, tuple[_ConversationInfo, int]] = {}
+        for i in range(0, len(peer_ids), self._CHATS_PER_EXECUTE):
+            chunk = peer_ids[i:i + self._CHATS_PER_EXECUTE]
+            response: dict = self.api.execute(code=GET_CHATS_INFO_SCRIPT, peer_ids=",".join(map(str, chunk)))
+            conversations = {conversation["peer"]["id"]: conversation for conversation in response["conversations"]}
+            assert len(response["counts"]) == len(chunk), response["counts"]
+            for peer_id, count in zip(chunk, response["counts"]):
+                if peer_id not in conversations:
+                    raise ValueError(f"Chat is not available: {peer_id}")
+                result[peer_id] = (self._parse_conversation_info(conversations[peer_id]), count)
+        return result
+
     def _get_conversation_info(self, peer_id: int) -> _ConversationInfo:
+        response: dict = self.api.messages.getConversationsById(peer_ids=peer_id)
+        assert len(response["items"]) == 1, response
+        return self._parse_conversation_info(response["items"][0])
+
+    @staticmethod
+    def _parse_conversation_info(conversation: dict) -> _ConversationInfo:
         last_message_id: int
         title_opt: None | str = None
         photo_url_opt: None | str = None
         photo_size_opt: None | int = None
 
-        response: dict = self.api.messages.getConversationsById(peer_ids=peer_id)
-        assert len(response["items"]) == 1, response
-        conversation: dict = response["items"][0]
-
         last_message_id = conversation["last_message_id"]
         assert isinstance(last_message_id, int), type(last_message_id)
         if "chat_settings" in conversation:
@@ -89,30 +354,9 @@ class VkService(IVkService):
             photo_size_opt=photo_size_opt,
         )
 
-    def _get_raw_messages_reversed_batch(self, peer_id: int, last_message_id: int, offset: int) -> list[dict]:
-        # batch_size is <= 200 due to https://dev.vk.com/method/messages.getHistory
-        # max_iter is <= 25 due to https://dev.vk.com/method/execute
-        script_args = ("peer_id", "last_message_id", "initial_offset")
-        script = """
-            var batch_size = 200;
-            var max_iter = 25;
-
-            var messages = [];
-            var offset = %(initial_offset)s;
-            var i = 0;
-            while (i < max_iter) {
-                var history = API.messages.getHistory({
-                    "peer_id": %(peer_id)s,
-                    "start_message_id": %(last_message_id)s,
-                    "offset": offset,
-                    "count": batch_size,
-                });
-                messages = messages + history.items;
-                offset = offset + batch_size;
-                i = i + 1;
-            }
-            return messages;
-        """
-        func = VkFunction(code=script, args=script_args, clean_args=script_args)
-        messages_raw: list[dict] = func(self.api, peer_id, last_message_id, offset)
+    def _get_raw_messages_reversed_batch(self, peer_id: int, last_message_id: int,
+                                         offset: int, count: int) -> list[dict]:
+        assert 0 < count <= self._MESSAGES_PER_EXECUTE, count
+        messages_raw: list[dict] = self.api.execute(
+            code=GET_HISTORY_SCRIPT, peer_id=peer_id, start_message_id=last_message_id, offset=offset, count=count)
         return messages_raw
@@ -12,6 +12,9 @@ class ConverterArguments:
     export_file: Path
     media_export_dir: Path
     disable_progress_bar: bool
+    media_cache_dir_opt: None | Path  # None disables the cache
+    media_cache_size_mb: int
+    sequential_media: bool  # Download videos after other files, not simultaneously
 
 
 class ConverterArgumentsParser:
@@ -35,6 +38,16 @@ class ConverterArgumentsParser:
                             metavar="DIR", help="Directory to export media files into")
         parser.add_argument("--no-progress-bar", action="store_true")
 
+        group_3 = parser.add_mutually_exclusive_group()
+        group_3.add_argument("--media-cache-dir", type=Path, default=config.default_media_cache_dir, metavar="DIR",
+                             help="Directory where downloaded media files are kept, so the next conversions "
+                                  "do not download them again")
+        group_3.add_argument("--no-media-cache", action="store_true", help="Download all media files")
+        parser.add_argument("--media-cache-size-mb", type=int, default=config.vk.max_media_cache_size_mb,
+                            metavar="N", help="Least recently used files are removed when the cache grows larger")
+        parser.add_argument("--sequential-media", action="store_true",
+                            help="Download videos after all other media files, not simultaneously with them")
+
         return ConverterArgumentsParser(parser)
 
     def __init__(self, parser: argparse.ArgumentParser) -> None:
@@ -59,6 +72,14 @@ class ConverterArgumentsParser:
         assert isinstance(media_export_dir, Path)
         disable_progress_bar = namespace.no_progress_bar
         assert isinstance(disable_progress_bar, bool)
+        no_media_cache = namespace.no_media_cache
+        assert isinstance(no_media_cache, bool)
+        media_cache_dir_opt = None if no_media_cache else namespace.media_cache_dir
+        assert media_cache_dir_opt is None or isinstance(media_cache_dir_opt, Path)
+        media_cache_size_mb = namespace.media_cache_size_mb
+        assert isinstance(media_cache_size_mb, int)
+        sequential_media = namespace.sequential_media
+        assert isinstance(sequential_media, bool)
 
         args = ConverterArguments(
             input_file_opt=input_file_opt,
@@ -66,6 +87,9 @@ class ConverterArgumentsParser:
             export_file=export_file,
             media_export_dir=media_export_dir,
             disable_progress_bar=disable_progress_bar,
+            media_cache_dir_opt=media_cache_dir_opt,
+            media_cache_size_mb=media_cache_size_mb,
+            sequential_media=sequential_media,
         )
         self._validate(args)
         return args
@@ -88,5 +112,12 @@ class ConverterArgumentsParser:
                 self.parser.error(f"Output media path does not point to a directory: {args.media_export_dir}")
             if any(True for _ in args.media_export_dir.iterdir()):
                 self.parser.error(f"Output media directory is not empty: {args.media_export_dir}")
+        if args.media_cache_dir_opt is not None:
+            if args.media_cache_dir_opt.exists() and not args.media_cache_dir_opt.is_dir():
+                self.parser.error(f"Media cache path does not point to a directory: {args.media_cache_dir_opt}")
+            if args.media_cache_dir_opt.resolve() == args.media_export_dir.resolve():
+                self.parser.error("Media cache directory must differ from the output media directory")
+        if args.media_cache_size_mb < 0:
+            self.parser.error("--media-cache-size-mb must not be negative")
         if (args.contacts_file_opt is None) and (args.input_file_opt is None):
             self.parser.error("You must not use --skip-contacts if you use --dummy-input")
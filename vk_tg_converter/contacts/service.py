@@ -47,8 +47,9 @@ class ContactsService(IContactsService):
     async def make_contacts_mapping_file(self, vk_history_input: Path, contacts_mapping_output: Path) -> None:
         result: list[ContactInfo] = []
 
-        vk_messages: list[vk.Message] = self.vk_history_storage.load_history(vk_history_input).messages
-        vk_user_ids: list[int] = list({msg.from_id for msg in vk_messages})
+        # Senders of messages and users who are only replied to, forwarded, invited or kicked
+        participants: vk.ParticipantIndex = self.vk_history_storage.load_participants(vk_history_input)
+        vk_user_ids: list[int] = list(participants.get_all_ids())
         vk_ego_id: int = self.username_manager.get_ego_id()
 
         async with self.tg_client:
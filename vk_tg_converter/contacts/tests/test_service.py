@@ -7,7 +7,7 @@ from pyrogram import types
 
 from common.user_io import MemoryUserOutput
 from vk_exporter.storage import IVkHistoryStorage
-from vk_exporter.types import ChatHistory, Message
+from vk_exporter.types import ChatHistory, InviteUserAction, Message, ParticipantIndex
 from vk_tg_converter.contacts.service import ContactsService
 from vk_tg_converter.contacts.storage import IContactsStorage
 from vk_tg_converter.contacts.tg_client_adaptor import ITgClientAdaptor
@@ -56,11 +56,13 @@ def vk_history_storage():
         def __init__(self):
             self.messages = []
 
-        def save_raw_history(self, raw_history, path): raise NotImplementedError
+        def save_raw_history(self, raw_history, path, overwrite=False): raise NotImplementedError
 
         def load_raw_history(self, path): raise NotImplementedError
 
-        def save_history(self, history, path): raise NotImplementedError
+        def load_last_raw_message_opt(self, path): raise NotImplementedError
+
+        def save_history(self, history, path, overwrite=False): raise NotImplementedError
 
         def set_messages_from_users(self, user_ids: list[int]):
             ts = datetime.datetime(2007, 10, 10)
@@ -72,6 +74,9 @@ def vk_history_storage():
         def load_history(self, path):
             return ChatHistory(messages=self.messages, title_opt="Title", photo_opt=None)
 
+        def load_participants(self, path):
+            return ParticipantIndex.collect(self.messages)
+
     return FakeVkHistoryStorage()
 
 
@@ -172,3 +177,23 @@ async def test_mapping_add_ego(service, username_manager, tg_client, vk_history_
         ContactInfo(103, "C D", "C D"),
         ContactInfo(1000, "Vk Name", "Tg Name"),
     ]
+
+
+async def test_mapping_referenced_users(service, username_manager, tg_client, vk_history_storage, contacts_storage):
+    tg_client.contacts = [types.User(id=1, first_name="A", last_name="B")]
+    username_manager.ego_id = 1000
+    username_manager.name_by_id = {101: "A B", 102: "x", 103: "y"}
+    ts = datetime.datetime(2007, 10, 10)
+    forwarded = Message(conversation_message_id=0, from_id=102, date=ts, text="forwarded")
+    vk_history_storage.messages = [
+        Message(conversation_message_id=1, from_id=101, date=ts, text="", fwd_messages=(forwarded,)),
+        Message(conversation_message_id=2, from_id=101, date=ts, text="", action=InviteUserAction(103)),
+    ]
+
+    await service.make_contacts_mapping_file(Path(), Path())
+
+    assert contacts_storage.contacts == [
+        ContactInfo(vk_id=102, vk_name="x", tg_name_opt=None),
+        ContactInfo(vk_id=103, vk_name="y", tg_name_opt=None),
+        ContactInfo(101, "A B", "A B"),
+    ]
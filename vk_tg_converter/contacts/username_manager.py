@@ -1,9 +1,12 @@
 import abc
+import asyncio
 import dataclasses
 from typing import Any, Optional
 
 from vk_api.vk_api import VkApiMethod
 
+from common.async_vk_client import AsyncVkApiMethod
+
 
 @dataclasses.dataclass(frozen=True)
 class ContactInfo:
@@ -23,13 +26,19 @@ class IUsernameManager(abc.ABC):
         [full_name] = self.get_full_names([vk_user_id])
         return full_name
 
+    async def prefetch_full_names(self, vk_user_ids: list[int]) -> None:
+        """Loads names in advance, so later calls of get_full_names don't make requests and block the event loop"""
+        self.get_full_names(vk_user_ids)
+
     @abc.abstractmethod
     def get_ego_id(self) -> int: ...
 
 
 class UsernameManager(IUsernameManager):
-    def __init__(self, api: VkApiMethod, prepared_contacts: Optional[list[ContactInfo]] = None):
+    def __init__(self, api: VkApiMethod, prepared_contacts: Optional[list[ContactInfo]] = None,
+                 async_api_opt: Optional[AsyncVkApiMethod] = None):
         self.api = api
+        self.async_api_opt = async_api_opt
         self.contacts_cache: dict[int, ContactInfo] = dict()
         self.ego_id: None | int = None
         if prepared_contacts is not None:
@@ -42,25 +51,39 @@ class UsernameManager(IUsernameManager):
         return None
 
     def get_full_names(self, vk_ids: list[int]) -> list[str]:
-        if missing_ids := list(set(vk_id for vk_id in vk_ids if vk_id not in self.contacts_cache)):
-            user_ids = [vk_id for vk_id in missing_ids if vk_id >= 0]
-            group_ids = [vk_id for vk_id in missing_ids if vk_id < 0]
-
-            if user_ids:
-                request: str = ",".join(map(str, user_ids))
-                missing_users: list[dict[Any, Any]] = self.api.users.get(user_ids=request)
-                for user_id, user_data in zip(user_ids, missing_users):
-                    contact = ContactInfo(vk_id=user_id, vk_name=self._make_full_name(user_data), tg_name_opt=None)
-                    self.contacts_cache[user_id] = contact
-            if group_ids:
-                request = ",".join(str(-group_id) for group_id in group_ids)
-                missing_groups = self.api.groups.getById(group_ids=request)
-                for group_id, group_data in zip(group_ids, missing_groups):
-                    contact = ContactInfo(vk_id=group_id, vk_name=group_data["name"], tg_name_opt=None)
-                    self.contacts_cache[group_id] = contact
-
+        user_ids, group_ids = self._get_missing_ids(vk_ids)
+        if user_ids:
+            self._add_users(user_ids, self.api.users.get(user_ids=",".join(map(str, user_ids))))
+        if group_ids:
+            self._add_groups(group_ids, self.api.groups.getById(group_ids=",".join(str(-i) for i in group_ids)))
         return [self.contacts_cache[user_id].vk_name for user_id in vk_ids]
 
+    async def prefetch_full_names(self, vk_user_ids: list[int]) -> None:
+        if self.async_api_opt is None:
+            await asyncio.to_thread(self.get_full_names, vk_user_ids)
+            return
+        user_ids, group_ids = self._get_missing_ids(vk_user_ids)
+        if user_ids:
+            self._add_users(user_ids, await self.async_api_opt.users.get(user_ids=",".join(map(str, user_ids))))
+        if group_ids:
+            self._add_groups(group_ids,
+                             await self.async_api_opt.groups.getById(group_ids=",".join(str(-i) for i in group_ids)))
+
+    def _get_missing_ids(self, vk_ids: list[int]) -> tuple[list[int], list[int]]:
+        """Returns ids of users and ids of groups (they are negative)"""
+        missing_ids = list(set(vk_id for vk_id in vk_ids if vk_id not in self.contacts_cache))
+        return [vk_id for vk_id in missing_ids if vk_id >= 0], [vk_id for vk_id in missing_ids if vk_id < 0]
+
+    def _add_users(self, user_ids: list[int], users_data: list[dict[Any, Any]]) -> None:
+        for user_id, user_data in zip(user_ids, users_data):
+            contact = ContactInfo(vk_id=user_id, vk_name=self._make_full_name(user_data), tg_name_opt=None)
+            self.contacts_cache[user_id] = contact
+
+    def _add_groups(self, group_ids: list[int], groups_data: list[dict[Any, Any]]) -> None:
+        for group_id, group_data in zip(group_ids, groups_data):
+            contact = ContactInfo(vk_id=group_id, vk_name=group_data["name"], tg_name_opt=None)
+            self.contacts_cache[group_id] = contact
+
     def get_ego_id(self) -> int:
         if self.ego_id is None:
             [ego_user] = self.api.users.get()
@@ -5,9 +5,11 @@ from typing import Optional
 
 from vk_api.vk_api import VkApiMethod
 
+from common.async_vk_client import AsyncVkApiMethod
 from config import Config
 from vk_tg_converter.contacts.username_manager import ContactInfo, UsernameManager
 from vk_tg_converter.converters.history_converter import IHistoryConverter, HistoryConverter
+from vk_tg_converter.converters.media_cache import IMediaCache
 from vk_tg_converter.converters.media_converter import MediaConverter
 from vk_tg_converter.converters.message_converter import MessageConverter
 from vk_tg_converter.converters.video_downloader import VideoDownloader
@@ -20,20 +22,24 @@ class IHistoryConverterFactory(abc.ABC):
 
 
 class HistoryConverterFactory(IHistoryConverterFactory):
-    def __init__(self, vk_api: VkApiMethod, config: Config, logger: Logger) -> None:
+    def __init__(self, vk_api: VkApiMethod, async_vk_api: AsyncVkApiMethod, config: Config, logger: Logger,
+                 media_cache_opt: Optional[IMediaCache] = None, sequential_media: bool = False) -> None:
         self.vk_api = vk_api
+        self.async_vk_api = async_vk_api
         self.config = config
         self.logger = logger
+        self.media_cache_opt = media_cache_opt
+        self.sequential_media = sequential_media
 
     def create(self, contacts: Optional[list[ContactInfo]],
                media_export_dir: Path, disable_progress_bar: bool) -> HistoryConverter:
-        username_manager = UsernameManager(self.vk_api, contacts)
+        username_manager = UsernameManager(self.vk_api, contacts, self.async_vk_api)
         video_downloader = VideoDownloader(
             self.logger.getChild("YDL"),
             self.config.tg.allowed_video_formats, self.config.tg.video_conversion_format,
             self.config.vk.max_video_size_mb, self.config.vk.video_quality, self.config.vk.max_video_download_retries)
         media_converter = MediaConverter(
-            self.vk_api, video_downloader, self.logger.getChild("media_converter"),
-            media_export_dir, self.config, disable_progress_bar)
+            self.async_vk_api, video_downloader, self.logger.getChild("media_converter"),
+            media_export_dir, self.config, disable_progress_bar, self.media_cache_opt, self.sequential_media)
         message_converter = MessageConverter(self.config.vk.timezone, username_manager, media_converter)
         return HistoryConverter(message_converter, media_converter)
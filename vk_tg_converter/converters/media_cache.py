@@ -0,0 +1,94 @@
+import abc
+import os
+import shutil
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from common.atomic_file import is_tmp_path, write_aside
+
+
+class IMediaCache(abc.ABC):
+    @abc.abstractmethod
+    def try_get(self, key: str) -> Optional[Path]:
+        """Cached file of the media. Do not change it, link or copy it (see link_or_copy)"""
+
+    @abc.abstractmethod
+    def put(self, key: str, path: Path) -> None:
+        """Do not change the file afterwards: the cache may share it"""
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """Hard link takes no disk space, but it is impossible between file systems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class MediaCache(IMediaCache):
+    """
+    Keeps downloaded media between conversion runs. Files are named by keys which identify media in vk
+    (e.g. 'photo<owner_id>_<id>'), not by urls: urls of vk files expire. Keys must not contain dots.
+    Files are linked to and from export directories when possible, so a cached file takes no extra space
+    while its export exists. Every read touches the file.
+    When the cache grows over max_size_bytes, least recently used files are removed
+    """
+
+    def __init__(self, cache_dir: Path, max_size_bytes: int) -> None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._entries: OrderedDict[str, tuple[Path, int]] = OrderedDict()  # From the least recently used
+        self._total_size = 0
+        files = []
+        for path in cache_dir.iterdir():
+            if path.is_file() and not is_tmp_path(path):  # Not written completely
+                stat = path.stat()
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            key = path.name.split(".", 1)[0]
+            if key in self._entries:  # Saved with another extension earlier
+                self._entries[key][0].unlink()
+                self._remove(key)
+            self._add(key, path, size)
+
+    def try_get(self, key: str) -> Optional[Path]:
+        entry_opt = self._entries.get(key)
+        if entry_opt is None:
+            return None
+        path, _ = entry_opt
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # Removed by hand
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return path
+
+    def put(self, key: str, path: Path) -> None:
+        assert "." not in key, key
+        size = path.stat().st_size
+        if size > self.max_size_bytes:
+            return
+        cached_path = self.cache_dir / (key + path.suffix)
+        with write_aside(cached_path) as tmp_path:
+            link_or_copy(path, tmp_path)
+        if key in self._entries and self._entries[key][0] != cached_path:  # Another extension
+            self._entries[key][0].unlink(missing_ok=True)
+        self._remove(key)
+        self._add(key, cached_path, size)
+        while self._total_size > self.max_size_bytes:
+            oldest_key = next(iter(self._entries))
+            oldest_path, _ = self._entries[oldest_key]
+            oldest_path.unlink(missing_ok=True)
+            self._remove(oldest_key)
+
+    def _add(self, key: str, path: Path, size: int) -> None:
+        self._entries[key] = (path, size)
+        self._total_size += size
+
+    def _remove(self, key: str) -> None:
+        entry_opt = self._entries.pop(key, None)
+        if entry_opt is not None:
+            self._total_size -= entry_opt[1]
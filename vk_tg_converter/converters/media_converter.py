@@ -1,23 +1,26 @@
 import abc
 import asyncio
+import contextlib
+import multiprocessing
 import os.path
 import urllib.parse
 import urllib.request
 from asyncio import AbstractEventLoop
-from concurrent.futures import Executor, ThreadPoolExecutor
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from logging import Logger
 from pathlib import Path, PurePath
 from typing import Optional
 
-import PIL.Image
-from aiohttp import ClientSession
+from aiohttp import ClientSession, StreamReader
 from tqdm.asyncio import tqdm
 from tqdm.contrib.logging import logging_redirect_tqdm
-from vk_api.vk_api import VkApiMethod
 
 import tg_importer.types as tg
 import vk_exporter.types as vk
+from common.async_vk_client import AsyncVkApiMethod
 from config import Config
+from vk_tg_converter.converters.image_encoder import encode_webp
+from vk_tg_converter.converters.media_cache import IMediaCache, link_or_copy
 from vk_tg_converter.converters.video_downloader import IVideoDownloader
 
 
@@ -27,8 +30,9 @@ class IMediaConverter(abc.ABC):
 
 
 class MediaConverter(IMediaConverter):
-    def __init__(self, api: VkApiMethod, video_downloader: IVideoDownloader, logger: Logger,
-                 export_dir: Path, config: Config, disable_progress_bar: bool) -> None:
+    def __init__(self, api: AsyncVkApiMethod, video_downloader: IVideoDownloader, logger: Logger,
+                 export_dir: Path, config: Config, disable_progress_bar: bool,
+                 media_cache_opt: Optional[IMediaCache] = None, sequential: bool = False) -> None:
         export_dir.mkdir(parents=True, exist_ok=True)
         if any(True for _ in export_dir.iterdir()):
             raise ValueError(f"Directory is not empty: {export_dir}")
@@ -36,11 +40,17 @@ class MediaConverter(IMediaConverter):
         self.api = api
         self.video_downloader = video_downloader
         self.logger = logger
+        self.media_cache_opt = media_cache_opt  # Files downloaded by previous runs are taken from it
         self.n_files_demanded = 0
 
         self.max_video_workers = config.vk.max_video_workers
+        self.max_image_workers = config.vk.max_image_workers
         self.video_download_semaphore = asyncio.Semaphore(self.max_video_workers)
         self.non_video_download_semaphore = asyncio.Semaphore(config.vk.max_non_video_workers)
+        # Shared by videos and other files. Each kind also has its own limit above
+        self.connection_semaphore = asyncio.Semaphore(config.vk.max_media_connections)
+        self.sequential = sequential  # Videos are downloaded after all other files
+        self.download_chunk_size = config.vk.download_chunk_size_kb * 1024
         self.disable_progress_bar = disable_progress_bar
 
     async def try_convert(self, attachments: list[vk.Attachment]) -> list[None | tg.Media]:
@@ -48,7 +58,14 @@ class MediaConverter(IMediaConverter):
 
         videos_with_idx: list[tuple[vk.Video, int]] = []
         non_videos_with_idx: list[tuple[vk.Attachment, int]] = []
+        # The same file is often attached to many messages (e.g. re-sent). It is downloaded once
+        first_idx_by_identity: dict[str, int] = {}
+        duplicates: list[tuple[int, int]] = []  # Index of an attachment and of its first occurrence
         for i, attch in enumerate(attachments):
+            if (identity_opt := self._get_identity_opt(attch)) is not None:
+                if (first_idx := first_idx_by_identity.setdefault(identity_opt, i)) != i:
+                    duplicates.append((i, first_idx))
+                    continue
             if isinstance(attch, vk.Video):
                 videos_with_idx.append((attch, i))
             elif self._is_non_video_supported(attch):
@@ -56,9 +73,9 @@ class MediaConverter(IMediaConverter):
 
         loop = asyncio.get_running_loop()
 
-        async def non_videos_task(session: ClientSession) -> None:
+        async def non_videos_task(session: ClientSession, image_executor: Executor) -> None:
             async def one_task(attch: vk.Attachment, idx: int) -> None:
-                result[idx] = await self._try_convert_non_video(attch, session)
+                result[idx] = await self._try_convert_non_video(attch, session, image_executor)
 
             tasks = [one_task(attch, idx) for attch, idx in non_videos_with_idx]
             if tasks:
@@ -71,28 +88,77 @@ class MediaConverter(IMediaConverter):
             with ThreadPoolExecutor(max_workers=self.max_video_workers) as executor:
                 tasks = [one_task(video, idx, executor) for video, idx in videos_with_idx]
                 if tasks:
-                    await tqdm.gather(*tasks, desc="Video", disable=self.disable_progress_bar)
+                    await tqdm.gather(*tasks, desc="Video", disable=self.disable_progress_bar,
+                                      position=None if self.sequential else 1)
 
         # This is to prevent logger and tqdm outputs interfere
         # Why logger.parent? I don't know, but None or just logger or logger.root don't fix the issue
         with logging_redirect_tqdm([self.logger.parent]):
-            async with ClientSession() as session:
-                await asyncio.gather(non_videos_task(session))
-                # Running them in parallel doesn't really speed anything up
-                # Sequential run at least has better visualization
-                await asyncio.gather(videos_task(session))
+            # Images are encoded in processes, so the event loop is not blocked. Processes are started on first use.
+            # Files are written by threads at the same time, and forking a process with running threads is unsafe
+            with ProcessPoolExecutor(self.max_image_workers, multiprocessing.get_context("spawn")) as image_executor:
+                # Size of the read buffer bounds memory of every download: aiohttp pauses reading when it is full
+                async with ClientSession(read_bufsize=self.download_chunk_size) as session:
+                    if self.sequential:
+                        await non_videos_task(session, image_executor)
+                        await videos_task(session)
+                    else:
+                        # The network stays busy while either kind has files left: e.g. a few long videos do not wait
+                        # for thousands of photos
+                        await asyncio.gather(non_videos_task(session, image_executor), videos_task(session))
+        for idx, first_idx in duplicates:
+            result[idx] = result[first_idx]
+        self._report_duplicates([result[idx] for idx, _ in duplicates])
         return result
 
+    @staticmethod
+    def _get_cache_key_opt(attachment: vk.Attachment) -> Optional[str]:
+        """Identifies the file in vk. Histories exported by old versions have no ids of photos, stickers, documents"""
+        if isinstance(attachment, vk.Video):
+            return f"video{attachment.owner_id}_{attachment.id}"
+        if isinstance(attachment, vk.Photo) and attachment.id:
+            return f"photo{attachment.owner_id}_{attachment.id}"
+        if isinstance(attachment, vk.Sticker) and attachment.sticker_id:
+            return f"sticker{attachment.sticker_id}"
+        if isinstance(attachment, vk.Document) and attachment.id:
+            return f"doc{attachment.owner_id}_{attachment.id}"
+        return None
+
+    @classmethod
+    def _get_identity_opt(cls, attachment: vk.Attachment) -> Optional[str]:
+        """Attachments with the same identity are the same file. None if the attachment is not downloaded"""
+        if (cache_key_opt := cls._get_cache_key_opt(attachment)) is not None:
+            return cache_key_opt
+        if isinstance(attachment, vk.Photo):
+            return attachment.url
+        if isinstance(attachment, vk.Sticker):
+            return attachment.image_url
+        if isinstance(attachment, vk.Document):
+            return attachment.url
+        if isinstance(attachment, vk.Audio):
+            return attachment.url or None
+        if isinstance(attachment, vk.Voice):
+            return attachment.link_ogg
+        return None
+
+    def _report_duplicates(self, duplicate_media: list[Optional[tg.Media]]) -> None:
+        if not duplicate_media:
+            return
+        saved_bytes = sum(os.path.getsize(media.path) for media in duplicate_media if media is not None)
+        self.logger.info(f"{len(duplicate_media)} attachments are the same files as others. "
+                         f"They were not downloaded again, which saved {saved_bytes / 2 ** 20:.1f} MB")
+
     @staticmethod
     def _is_non_video_supported(attachment: vk.Attachment) -> bool:
         assert not isinstance(attachment, vk.Video)
         return isinstance(attachment, (vk.Photo, vk.Sticker, vk.Document, vk.Audio, vk.Voice))
 
-    async def _try_convert_non_video(self, attachment: vk.Attachment, session: ClientSession) -> Optional[tg.Media]:
+    async def _try_convert_non_video(self, attachment: vk.Attachment, session: ClientSession,
+                                     image_executor: Executor) -> Optional[tg.Media]:
         if isinstance(attachment, vk.Photo):
             return await self._try_convert_photo(attachment, session)
         if isinstance(attachment, vk.Sticker):
-            return await self._try_convert_sticker(attachment, session)
+            return await self._try_convert_sticker(attachment, session, image_executor)
         if isinstance(attachment, vk.Document):
             return await self._try_convert_document(attachment, session)
         if isinstance(attachment, vk.Audio):
@@ -104,16 +170,23 @@ class MediaConverter(IMediaConverter):
 
     async def _try_convert_video(self, video: vk.Video, session: ClientSession,
                                  loop: AbstractEventLoop, executor: Executor) -> Optional[tg.Video]:
+        cache_key = self._get_cache_key_opt(video)
+        assert cache_key is not None
         async with self.video_download_semaphore:
-            player_url_opt = video.try_get_player_url(self.api)
-            if player_url_opt is None:
-                self.logger.error(f"Couldn't get video url for '{video.title}'. Skipping")
-                return None
-            file_path_opt = await loop.run_in_executor(executor, self._try_download_video, player_url_opt)
+            file_path_opt: Optional[PurePath] = self._try_get_cached(cache_key)
             if file_path_opt is None:
-                self.logger.error(f"Couldn't download video '{video.title}'. Skipping")
-                return None
-            thumb_path = await self._try_download_file(video.image_url, session)
+                player_url_opt = await video.try_get_player_url_async(self.api)
+                if player_url_opt is None:
+                    self.logger.error(f"Couldn't get video url for '{video.title}'. Skipping")
+                    return None
+                async with self.connection_semaphore:
+                    file_path_opt = await loop.run_in_executor(executor, self._try_download_video, player_url_opt)
+                if file_path_opt is None:
+                    self.logger.error(f"Couldn't download video '{video.title}'. Skipping")
+                    return None
+                self._put_to_cache(cache_key, Path(file_path_opt))
+            thumb_path = await self._try_download_file(video.image_url, session, cache_key_opt=cache_key + "-thumb",
+                                                       in_video_worker=True)
             if thumb_path is None:
                 self.logger.warning(f"Couldn't download thumbnail for '{video.title}'. Skipping the thumbnail")
         return tg.Video(
@@ -126,26 +199,35 @@ class MediaConverter(IMediaConverter):
         )
 
     async def _try_convert_photo(self, photo: vk.Photo, session: ClientSession) -> Optional[tg.Photo]:
-        if file_opt := await self._try_download_file(photo.url, session):
+        cache_key_opt = self._get_cache_key_opt(photo)
+        if file_opt := await self._try_download_file(photo.url, session, cache_key_opt=cache_key_opt):
             return tg.Photo(file_opt)
         self.logger.error(f"Couldn't download photo. Skipping. Link {photo.url}")
         return None
 
-    async def _try_convert_sticker(self, sticker: vk.Sticker, session: ClientSession) -> Optional[tg.Sticker]:
-        # Vk uses .png for stickers, but tg doesn't support it. However, it supports .webp
-        if file_opt := await self._try_download_file(sticker.image_url, session):
-            if not file_opt.suffix == ".webp":
-                new_path = file_opt.with_suffix(".webp")
-                with PIL.Image.open(file_opt) as image:
-                    image.save(new_path, format="webp")
-                file_opt.unlink()
-                file_opt = new_path
-            return tg.Sticker(path=file_opt)
-        self.logger.error(f"Couldn't download sticker. Skipping. Link {sticker.image_url}")
-        return None
+    async def _try_convert_sticker(self, sticker: vk.Sticker, session: ClientSession,
+                                   image_executor: Executor) -> Optional[tg.Sticker]:
+        # Converted stickers are cached
+        cache_key_opt = self._get_cache_key_opt(sticker)
+        if cache_key_opt is not None and (cached_path_opt := self._try_get_cached(cache_key_opt)):
+            return tg.Sticker(path=cached_path_opt)
+        # Stickers are small, so they are converted in memory and only .webp is written
+        if (image_data_opt := await self._try_download_bytes(sticker.image_url, session)) is None:
+            self.logger.error(f"Couldn't download sticker. Skipping. Link {sticker.image_url}")
+            return None
+        loop = asyncio.get_running_loop()
+        if PurePath(urllib.parse.urlparse(sticker.image_url).path).suffix != ".webp":
+            image_data_opt = await loop.run_in_executor(image_executor, encode_webp, image_data_opt)
+        file_path = self._make_new_path(postfix=".webp")
+        await loop.run_in_executor(None, file_path.write_bytes, image_data_opt)
+        if cache_key_opt is not None:
+            self._put_to_cache(cache_key_opt, file_path)
+        return tg.Sticker(path=file_path)
 
     async def _try_convert_document(self, document: vk.Document, session: ClientSession) -> Optional[tg.Document]:
-        if file_opt := await self._try_download_file(document.url, session, extension_hint="." + document.extension):
+        cache_key_opt = self._get_cache_key_opt(document)
+        extension_hint = "." + document.extension
+        if file_opt := await self._try_download_file(document.url, session, extension_hint, cache_key_opt):
             return tg.Document(file_opt, title=document.title)
         self.logger.error(f"Couldn't download document '{document.title}'. Skipping")
         return None
@@ -165,18 +247,58 @@ class MediaConverter(IMediaConverter):
         self.logger.error(f"Couldn't download voice. Skipping. Link {voice.link_ogg}")
         return None
 
-    async def _try_download_file(self, url: str, session: ClientSession, extension_hint: str = "") -> Optional[Path]:
+    async def _try_download_file(self, url: str, session: ClientSession, extension_hint: str = "",
+                                 cache_key_opt: Optional[str] = None, in_video_worker: bool = False) -> Optional[Path]:
+        if cache_key_opt is not None and (cached_path_opt := self._try_get_cached(cache_key_opt)):
+            return cached_path_opt
         parsed_url: urllib.parse.ParseResult = urllib.parse.urlparse(url)
         extension: str = PurePath(parsed_url.path).suffix or extension_hint  # May be empty
         file_path: Path = self._make_new_path(postfix=extension)
-        async with self.non_video_download_semaphore:
+        # A video worker downloads its thumbnail itself, otherwise the video waits until all other files are downloaded
+        worker_semaphore = contextlib.nullcontext() if in_video_worker else self.non_video_download_semaphore
+        async with worker_semaphore, self.connection_semaphore:
             async with session.get(url) as resp:
                 if resp.status != 200:
                     return None
-                with file_path.open("xb") as dst:
-                    dst.write(await resp.content.read())
+                await self._write_stream(resp.content, file_path)
+        if cache_key_opt is not None:
+            self._put_to_cache(cache_key_opt, file_path)
         return file_path
 
+    async def _try_download_bytes(self, url: str, session: ClientSession) -> Optional[bytes]:
+        async with self.non_video_download_semaphore, self.connection_semaphore:
+            async with session.get(url) as resp:
+                if resp.status != 200:
+                    return None
+                return await resp.read()
+
+    async def _write_stream(self, stream: StreamReader, file_path: Path) -> None:
+        """Writes chunks in a thread, so the event loop is not blocked by the disk. Partial file is removed on error"""
+        loop = asyncio.get_running_loop()
+        dst = file_path.open("xb")
+        try:
+            with dst:
+                async for chunk in stream.iter_chunked(self.download_chunk_size):
+                    await loop.run_in_executor(None, dst.write, chunk)
+        except BaseException:
+            file_path.unlink(missing_ok=True)
+            raise
+
+    def _try_get_cached(self, cache_key: str) -> Optional[Path]:
+        """Links or copies the cached file to the export directory"""
+        if self.media_cache_opt is None:
+            return None
+        cached_path_opt = self.media_cache_opt.try_get(cache_key)
+        if cached_path_opt is None:
+            return None
+        file_path = self._make_new_path(postfix=cached_path_opt.suffix)
+        link_or_copy(cached_path_opt, file_path)
+        return file_path
+
+    def _put_to_cache(self, cache_key: str, file_path: Path) -> None:
+        if self.media_cache_opt is not None:
+            self.media_cache_opt.put(cache_key, file_path)
+
     def _try_download_video(self, player_url: str) -> Optional[PurePath]:
         path: PurePath = self._make_new_path(postfix="")
         dir_escaped = str(path.parent).replace("%", "%%")
@@ -3,7 +3,7 @@ import re
 from dataclasses import dataclass
 from datetime import datetime, tzinfo
 from itertools import chain
-from typing import Literal, Optional, Union
+from typing import Literal, Optional, Sequence, Union
 
 import tg_importer.types as tg
 import vk_exporter.types as vk
@@ -14,7 +14,7 @@ from vk_tg_converter.converters.media_converter import IMediaConverter
 
 class IMessageConverter(abc.ABC):
     @abc.abstractmethod
-    async def convert(self, messages: list[vk.Message]) -> list[tg.Message]: ...
+    async def convert(self, messages: Sequence[vk.Message]) -> list[tg.Message]: ...
 
 
 @dataclass
@@ -50,7 +50,9 @@ class MessageConverter(IMessageConverter):
         self.username_manager = username_manager
         self.media_converter = media_converter
 
-    async def convert(self, messages: list[vk.Message]) -> list[tg.Message]:
+    async def convert(self, messages: Sequence[vk.Message]) -> list[tg.Message]:
+        # Names are requested all at once and without blocking the event loop. Preparation only reads them from cache
+        await self.username_manager.prefetch_full_names(self._collect_user_ids(messages))
         messages_index: dict[int, _PreparedMessage] = {}
         prepared_messages: list[_PreparedMessage] = []
         for msg in messages:
@@ -64,6 +66,23 @@ class MessageConverter(IMessageConverter):
             result += self._convert_one_message(pm)
         return result
 
+    @staticmethod
+    def _collect_user_ids(messages: Sequence[vk.Message]) -> list[int]:
+        user_ids: set[int] = set()
+        for message in messages:  # Messages may be loaded lazily, so only one of them is held at a time
+            stack = [message]
+            while stack:
+                msg = stack.pop()
+                user_ids.add(msg.from_id)
+                if isinstance(msg.action, vk.InviteUserAction):
+                    user_ids.add(msg.action.invited_user_id)
+                if isinstance(msg.action, vk.KickUserAction):
+                    user_ids.add(msg.action.kicked_user_id)
+                if msg.reply_message is not None:
+                    stack.append(msg.reply_message)
+                stack += msg.fwd_messages
+        return sorted(user_ids)
+
     def _prepare_message(self, msg: vk.Message, messages_index: dict[int, _PreparedMessage]) -> _PreparedMessage:
         if msg.action is not None:
             return self._prepare_service_message(msg, messages_index)
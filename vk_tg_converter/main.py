@@ -1,5 +1,6 @@
 import logging
 
+from common.async_vk_client import AsyncVkClient
 from common.vk_client import VkClient
 from config import Config
 from tg_importer.storage import ITgHistoryStorage
@@ -8,6 +9,7 @@ from vk_tg_converter.arguments import ConverterArguments
 from vk_tg_converter.contacts.storage import ContactsStorage
 from vk_tg_converter.controller import ConverterController
 from vk_tg_converter.converters.history_converter_factory import HistoryConverterFactory
+from vk_tg_converter.converters.media_cache import MediaCache
 from vk_tg_converter.dummy_history_provider import DummyHistoryProvider
 from vk_tg_converter.service import ConverterService
 
@@ -15,13 +17,19 @@ from vk_tg_converter.service import ConverterService
 async def main(args: ConverterArguments, config: Config, vk_client: VkClient,
                tg_history_storage: ITgHistoryStorage, logger: logging.Logger) -> None:
     vk_api = vk_client.get_api()
-    service = ConverterService(
-        config.vk,
-        ContactsStorage(),
-        HistoryConverterFactory(vk_api, config, logger),
-        DummyHistoryProvider(),
-        VkHistoryStorage(),
-        tg_history_storage,
-    )
-    controller = ConverterController(service)
-    await controller(args)
+    media_cache_opt = None
+    if args.media_cache_dir_opt is not None:
+        media_cache_opt = MediaCache(args.media_cache_dir_opt, args.media_cache_size_mb * 2 ** 20)
+    # vk requests of the converter are made from the event loop, so they overlap with media downloads
+    async with AsyncVkClient(config.vk, vk_client.token["access_token"], vk_client.rate_limiter) as async_vk_client:
+        service = ConverterService(
+            config.vk,
+            ContactsStorage(),
+            HistoryConverterFactory(vk_api, async_vk_client.get_api(), config, logger, media_cache_opt,
+                                    args.sequential_media),
+            DummyHistoryProvider(),
+            VkHistoryStorage(),
+            tg_history_storage,
+        )
+        controller = ConverterController(service)
+        await controller(args)
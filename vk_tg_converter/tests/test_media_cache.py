@@ -0,0 +1,62 @@
+import logging
+import os
+from pathlib import Path
+from typing import Any
+
+import tg_importer.types as tg
+import vk_exporter.types as vk
+from config import Config
+from vk_tg_converter.converters.media_cache import MediaCache
+from vk_tg_converter.converters.media_converter import MediaConverter
+
+
+def make_file(path, size):
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def test_files_are_kept_between_runs(tmp_path):
+    cache = MediaCache(tmp_path / "cache", 100)
+    assert cache.try_get("photo1_2") is None
+    cache.put("photo1_2", make_file(tmp_path / "FILE-0001.jpg", 10))
+
+    cached_path = MediaCache(tmp_path / "cache", 100).try_get("photo1_2")
+    assert cached_path is not None and cached_path == tmp_path / "cache" / "photo1_2.jpg"
+    assert cached_path.read_bytes() == b"x" * 10
+    assert not list((tmp_path / "cache").glob("*.part*"))
+
+
+def test_least_recently_used_files_are_removed(tmp_path):
+    cache = MediaCache(tmp_path / "cache", 25)
+    for i in range(2):
+        cache.put(f"doc{i}", make_file(tmp_path / f"{i}.pdf", 10))
+        os.utime(tmp_path / "cache" / f"doc{i}.pdf", (i, i))
+    cache = MediaCache(tmp_path / "cache", 25)  # Order of use is restored from modification times
+    assert cache.try_get("doc0") is not None
+
+    cache.put("doc2", make_file(tmp_path / "2.pdf", 10))
+    assert cache.try_get("doc1") is None
+    assert cache.try_get("doc0") is not None
+    assert cache.try_get("doc2") is not None
+    assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == ["doc0.pdf", "doc2.pdf"]
+
+    cache.put("doc3", make_file(tmp_path / "3.pdf", 26))  # Larger than the whole cache
+    assert cache.try_get("doc3") is None
+    assert cache.try_get("doc0") is not None
+
+
+async def test_cached_media_is_not_downloaded(tmp_path):
+    cache = MediaCache(tmp_path / "cache", 100)
+    cache.put("photo-5_7", make_file(tmp_path / "photo.jpg", 10))
+    cache.put("sticker9", make_file(tmp_path / "sticker.webp", 20))
+    no_network: Any = None  # Neither vk api nor video downloader are used
+    converter = MediaConverter(no_network, no_network, logging.getLogger("test"), tmp_path / "media", Config(), True,
+                               cache)
+
+    photo = vk.Photo("https://unreachable.invalid/1.jpg", 1, 1, id=7, owner_id=-5)
+    sticker = vk.Sticker("https://unreachable.invalid/2.png", sticker_id=9)
+    tg_photo, tg_sticker = await converter.try_convert([photo, sticker])
+
+    assert isinstance(tg_photo, tg.Photo) and isinstance(tg_sticker, tg.Sticker)
+    assert tg_photo.path.parent == tmp_path / "media" and Path(tg_photo.path).read_bytes() == b"x" * 10
+    assert tg_sticker.path.suffix == ".webp" and Path(tg_sticker.path).read_bytes() == b"x" * 20
@@ -0,0 +1,141 @@
+import asyncio
+import io
+import logging
+import threading
+from pathlib import Path, PurePath
+from typing import Any, Optional
+
+import PIL.Image
+import pytest
+from aiohttp import ClientPayloadError, ClientSession, web
+from aiohttp.test_utils import TestServer
+
+import tg_importer.types as tg
+import vk_exporter.types as vk
+from config import Config
+from vk_tg_converter.converters.media_converter import MediaConverter
+from vk_tg_converter.converters.video_downloader import IVideoDownloader
+
+DOCUMENT = bytes(range(256)) * 4000  # About 1 MB, several chunks
+
+
+def make_converter(export_dir: Path, api: Any = None, video_downloader: Any = None,
+                   sequential: bool = False) -> MediaConverter:
+    config = Config()
+    config.vk.download_chunk_size_kb = 64
+    return MediaConverter(api, video_downloader, logging.getLogger("test"), export_dir, config, True,
+                          sequential=sequential)
+
+
+async def serve_document(request: web.Request) -> web.StreamResponse:
+    response = web.StreamResponse()
+    await response.prepare(request)
+    for start in range(0, len(DOCUMENT), 100_000):
+        await response.write(DOCUMENT[start:start + 100_000])
+    if request.path == "/broken.pdf":
+        raise ConnectionResetError  # The connection is closed before the whole file is sent
+    return response
+
+
+async def test_document_is_downloaded_in_chunks(tmp_path):
+    app = web.Application()
+    app.router.add_get("/{name}", serve_document)
+    async with TestServer(app) as server:
+        converter = make_converter(tmp_path / "media")
+        [tg_document] = await converter.try_convert([vk.Document(str(server.make_url("/doc.pdf")), "doc", "pdf", 1)])
+
+        assert isinstance(tg_document, tg.Document)
+        assert Path(tg_document.path).read_bytes() == DOCUMENT
+
+        async with ClientSession() as session:
+            with pytest.raises(ClientPayloadError):
+                await converter._try_download_file(str(server.make_url("/broken.pdf")), session)
+        assert list((tmp_path / "media").iterdir()) == [Path(tg_document.path)]  # Partial file is removed
+
+
+async def test_sticker_is_converted_to_webp(tmp_path):
+    png = io.BytesIO()
+    PIL.Image.new("RGBA", (64, 64), (255, 0, 0, 128)).save(png, format="png")
+
+    async def serve_sticker(request: web.Request) -> web.Response:
+        return web.Response(body=png.getvalue())
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_sticker)
+    async with TestServer(app) as server:
+        converter = make_converter(tmp_path / "media")
+        [tg_sticker] = await converter.try_convert([vk.Sticker(str(server.make_url("/sticker.png")))])
+
+    assert isinstance(tg_sticker, tg.Sticker)
+    assert [path.suffix for path in (tmp_path / "media").iterdir()] == [".webp"]  # Png is not written
+    with PIL.Image.open(tg_sticker.path) as image:
+        assert image.format == "WEBP" and image.size == (64, 64)
+
+
+async def test_same_files_are_downloaded_once(tmp_path, caplog):
+    requested_paths = []
+
+    async def serve_file(request: web.Request) -> web.Response:
+        requested_paths.append(request.path)
+        return web.Response(body=b"x" * 1000)
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_file)
+    async with TestServer(app) as server:
+        photo = vk.Photo(str(server.make_url("/photo.jpg")), 1, 1, id=7, owner_id=-5)
+        same_photo = vk.Photo(str(server.make_url("/photo.jpg?size=other")), 1, 1, id=7, owner_id=-5)
+        document = vk.Document(str(server.make_url("/doc.pdf")), "doc", "pdf", 1)  # Without id
+        converter = make_converter(tmp_path / "media")
+        with caplog.at_level(logging.INFO):
+            results = await converter.try_convert([photo, document, same_photo, document])
+
+    assert sorted(requested_paths) == ["/doc.pdf", "/photo.jpg"]
+    assert results[0] is results[2] and results[1] is results[3]
+    assert len(list((tmp_path / "media").iterdir())) == 2
+    assert "2 attachments are the same files as others" in caplog.text
+
+
+class FakeVideoApi:
+    class video:
+        @staticmethod
+        async def get(videos: str) -> dict[str, Any]:
+            return {"items": [{"player": f"https://vk.com/video_ext.php?{videos}"}]}
+
+
+class FakeVideoDownloader(IVideoDownloader):
+    def __init__(self) -> None:
+        self.started = threading.Event()
+
+    def try_download_video(self, player_url: str, output_template: str) -> Optional[PurePath]:
+        self.started.set()
+        path = Path(output_template.replace("%%", "%") % {"title": "video", "ext": "mp4"})
+        path.write_bytes(b"video")
+        return path
+
+
+async def download_photo_and_video(export_dir: Path, sequential: bool) -> list[Optional[tg.Media]]:
+    video_downloader = FakeVideoDownloader()
+
+    async def serve_photo(request: web.Request) -> web.Response:
+        # The photo is served only while the video is being downloaded
+        video_started = await asyncio.get_running_loop().run_in_executor(None, video_downloader.started.wait, 1)
+        return web.Response(body=b"photo", status=200 if video_started else 503)
+
+    app = web.Application()
+    app.router.add_get("/{name}", serve_photo)
+    async with TestServer(app) as server:
+        converter = make_converter(export_dir, FakeVideoApi(), video_downloader, sequential)
+        video = vk.Video("video", 1, 2, 640, 480, 10, False, str(server.make_url("/thumb.jpg")), None)
+        return await converter.try_convert([vk.Photo(str(server.make_url("/photo.jpg")), 1, 1), video])
+
+
+async def test_videos_are_downloaded_with_other_files(tmp_path):
+    tg_photo, tg_video = await download_photo_and_video(tmp_path / "media", sequential=False)
+    assert isinstance(tg_photo, tg.Photo) and Path(tg_photo.path).read_bytes() == b"photo"
+    assert isinstance(tg_video, tg.Video) and Path(tg_video.path).read_bytes() == b"video"
+
+
+async def test_videos_are_downloaded_after_other_files(tmp_path):
+    tg_photo, tg_video = await download_photo_and_video(tmp_path / "media", sequential=True)
+    assert tg_photo is None  # Video was not started while the photo was downloaded
+    assert isinstance(tg_video, tg.Video)